@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+#
+# Project:     weechat-notify-send
+# Homepage:    https://github.com/s3rvac/weechat-notify-send
+# Description: A stand-in for the weechat module for running the script
+#              outside of WeeChat.
+# License:     MIT (see below)
+#
+# Copyright (c) 2015 by Petr Zemek <s3rvac@gmail.com> and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import heapq
+import itertools
+import re
+import time
+
+
+class Hook(object):
+    """A hook created by the script."""
+
+    __slots__ = ('pointer', 'kind', 'target', 'callback', 'data', 'options')
+
+    def __init__(self, pointer, kind, target, callback, data, options=None):
+        self.pointer = pointer
+        self.kind = kind
+        self.target = target
+        self.callback = callback
+        self.data = data
+        self.options = options
+
+
+class FakeWeechat(object):
+    """A fast, stateful stand-in for the weechat module.
+
+    It models the parts of the WeeChat API that the script uses: buffers with
+    local variables, the hotlist, key bindings, plugin options (with hook_config
+    callbacks), print, signal, modifier, command, timer, and process hooks,
+    infolists, and hdata of buffers and their last lines. Time is virtual
+    (see VirtualClock and advance()), and processes are run by an injectable
+    handler with a configurable latency.
+
+    Unlike mock.Mock, it adds next to no overhead, so tools that push many
+    lines through the script measure the script itself.
+
+    Callbacks are looked up by their names in the loaded script (see
+    load_script()), like in WeeChat.
+    """
+
+    WEECHAT_RC_OK = 0
+    WEECHAT_RC_OK_EAT = 1
+    WEECHAT_RC_ERROR = -1
+
+    WEECHAT_HOOK_PROCESS_RUNNING = -1
+    WEECHAT_HOOK_PROCESS_ERROR = -2
+
+    # The name of the loaded script and its plugin.
+    SCRIPT_PREFIX = 'plugins.var.python.notify_send.'
+
+    # Color codes in strings (a subset of the codes of WeeChat: \x19 followed
+    # by a color number, and \x1c, which resets the color).
+    COLOR_CODE_RE = re.compile(r'\x19\d\d|\x1c')
+
+    def __init__(self, clock=None):
+        self.clock = clock or VirtualClock()
+        self.config = {}
+        self.descriptions = {}
+        self.buffers = {}
+        self.lines = {}
+        self.hotlist = {}
+        # Commands that keys are bound to (in the default context).
+        self.keys = {}
+        self.current = ''
+        self.data_dir = ''
+        self.script = None
+        self.shutdown_func = ''
+        self.hooks = {}
+        self.print_hooks = []
+        self.timers = []
+        self.hook_ids = itertools.count(1)
+        self.output = []
+        self.commands = []
+        # A function (command, options) -> (return code, stdout, stderr) that
+        # runs processes for process hooks, and the delay (in seconds) after
+        # which their callbacks are called.
+        self.process_handler = lambda command, options: (0, '', '')
+        self.process_latency = 0.0
+
+    # Scripts.
+
+    def load_script(self, script):
+        """Loads the given script (a module with a main() function)."""
+        self.script = script
+        script.main()
+
+    def unload_script(self):
+        """Unloads the script: calls its shutdown function and removes its
+        hooks.
+        """
+        if self.shutdown_func:
+            self.call(self.shutdown_func)
+        for pointer in list(self.hooks):
+            self.unhook(pointer)
+        self.script = None
+
+    def call(self, callback, *args):
+        """Calls the given callback (a name of a function in the loaded
+        script or a callable, e.g. a callback of another script).
+        """
+        if callable(callback):
+            return callback(*args)
+        return getattr(self.script, callback)(*args)
+
+    def register(self, name, author, version, license, description,
+                 shutdown_func, charset):
+        self.shutdown_func = shutdown_func
+        return 1
+
+    # Buffers.
+
+    @property
+    def buffers(self):
+        """Buffers (a FakeBuffers mapping pointers to their properties)."""
+        return self._buffers
+
+    @buffers.setter
+    def buffers(self, buffers):
+        self._buffers = FakeBuffers(buffers)
+
+    def add_buffer(self, pointer, name, short_name, **localvars):
+        properties = {'name': name, 'short_name': short_name}
+        for localvar, value in localvars.items():
+            properties['localvar_' + localvar] = value
+        self.buffers[pointer] = properties
+
+    def close_buffer(self, pointer):
+        """Closes the given buffer (sending the buffer_closed signal)."""
+        self.buffers.pop(pointer, None)
+        self.lines.pop(pointer, None)
+        self.hotlist.pop(pointer, None)
+        self.hook_signal_send('buffer_closed', 'pointer', pointer)
+
+    def switch_to_buffer(self, pointer):
+        """Makes the given buffer current (sending the buffer_switch signal)."""
+        self.current = pointer
+        self.hotlist.pop(pointer, None)
+        self.hook_signal_send('buffer_switch', 'pointer', pointer)
+
+    def buffer_get_string(self, buffer, property):
+        properties = self.buffers.get(buffer)
+        if properties is None:
+            return ''
+        if property == 'full_name' and 'full_name' not in properties:
+            property = 'name'
+        return properties.get(property, '')
+
+    def buffer_set(self, buffer, property, value):
+        if property.startswith('localvar_set_'):
+            property = 'localvar_' + property[len('localvar_set_'):]
+        elif property == 'display':
+            self.switch_to_buffer(buffer)
+            return
+        elif property == 'hotlist':
+            if value == '-1':
+                self.hotlist.pop(buffer, None)
+            return
+        self.buffers.setdefault(buffer, {})[property] = value
+
+    def buffer_search(self, plugin, name):
+        for pointer in self.buffers:
+            if plugin == '==':
+                if self.buffer_get_string(pointer, 'full_name') == name:
+                    return pointer
+            elif self.buffers[pointer].get('name') == name:
+                return pointer
+        return ''
+
+    def buffer_search_main(self):
+        return next(iter(self.buffers), '')
+
+    def current_buffer(self):
+        return self.current
+
+    # Lines.
+
+    def print_line(self, buffer, message, prefix='', tags=(), displayed=1,
+                   highlight=0, date=None):
+        """Prints a line into the given buffer.
+
+        The line is passed to print hooks, added to the hotlist, and sent in
+        the weechat_highlight and weechat_pv signals, like in WeeChat. The
+        prefix and message may contain color codes (see COLOR_CODE_RE), which
+        are removed for print hooks that ask for it and for the signals.
+        """
+        if date is None:
+            date = int(self.clock.now)
+        tags_string = ','.join(tags)
+        self.lines[buffer] = {
+            'date': date,
+            'date_printed': int(self.clock.now),
+            'displayed': displayed,
+            'highlight': highlight,
+            'tags_array': tags,
+            'prefix': prefix,
+            'message': message,
+        }
+
+        if buffer != self.current:
+            if highlight:
+                level = 3
+            elif 'notify_private' in tags:
+                level = 2
+            elif 'notify_message' in tags:
+                level = 1
+            else:
+                level = 0
+            counts = self.hotlist.get(buffer)
+            if counts is None:
+                counts = self.hotlist[buffer] = [0, 0, 0, 0]
+            counts[level] += 1
+
+        plain_prefix = self.string_remove_color(prefix, '')
+        plain_message = self.string_remove_color(message, '')
+        for hook in self.print_hooks:
+            if hook.target and hook.target != buffer:
+                continue
+            if hook.options:
+                self.call(hook.callback, hook.data, buffer, str(date), tags_string,
+                          str(displayed), str(highlight), plain_prefix, plain_message)
+            else:
+                self.call(hook.callback, hook.data, buffer, str(date), tags_string,
+                          str(displayed), str(highlight), prefix, message)
+
+        if highlight or 'notify_private' in tags:
+            # Like gui_line_build_string_prefix_message() in WeeChat, the data
+            # of the signals have no colors.
+            signal = 'weechat_highlight' if highlight else 'weechat_pv'
+            self.hook_signal_send(signal, 'string', plain_prefix + '\t' + plain_message)
+
+    def prnt(self, buffer, message):
+        self.output.append((buffer, message))
+
+    def prefix(self, prefix):
+        return ''
+
+    def color(self, name):
+        return ''
+
+    def string_remove_color(self, string, replacement):
+        return self.COLOR_CODE_RE.sub(replacement, string)
+
+    def string_match(self, string, mask, case_sensitive):
+        pattern = '.*'.join(re.escape(part) for part in mask.split('*'))
+        flags = 0 if case_sensitive else re.IGNORECASE
+        return 1 if re.match(pattern + r'\Z', string, flags) else 0
+
+    # Options.
+
+    def config_get_plugin(self, option):
+        return self.config.get(option, '')
+
+    def config_is_set_plugin(self, option):
+        return 1 if option in self.config else 0
+
+    def config_set_plugin(self, option, value):
+        self.config[option] = value
+        full_name = self.SCRIPT_PREFIX + option
+        for hook in self.hooks_of_kind('config'):
+            if self.string_match(full_name, hook.target, 1):
+                self.call(hook.callback, hook.data, full_name, value)
+        return 1
+
+    def config_unset_plugin(self, option):
+        self.config.pop(option, None)
+        return 1
+
+    def config_set_desc_plugin(self, option, description):
+        self.descriptions[option] = description
+
+    def info_get(self, name, arguments):
+        if name == 'weechat_data_dir':
+            return self.data_dir
+        return ''
+
+    # Hooks.
+
+    def add_hook(self, kind, target, callback, data, options=None):
+        pointer = '0xh{}'.format(next(self.hook_ids))
+        hook = self.hooks[pointer] = Hook(pointer, kind, target, callback, data, options)
+        return hook
+
+    def hooks_of_kind(self, kind):
+        return [hook for hook in list(self.hooks.values()) if hook.kind == kind]
+
+    def unhook(self, pointer):
+        hook = self.hooks.pop(pointer, None)
+        if hook is not None and hook.kind == 'print':
+            self.print_hooks.remove(hook)
+
+    def hook_print(self, buffer, tags, message, strip_colors, callback, data):
+        hook = self.add_hook('print', buffer, callback, data, strip_colors)
+        self.print_hooks.append(hook)
+        return hook.pointer
+
+    def hook_signal(self, signal, callback, data):
+        return self.add_hook('signal', signal, callback, data).pointer
+
+    def hook_signal_send(self, signal, type_data, signal_data):
+        for hook in self.hooks_of_kind('signal'):
+            if self.string_match(signal, hook.target, 1):
+                self.call(hook.callback, hook.data, signal, signal_data)
+        return self.WEECHAT_RC_OK
+
+    def hook_config(self, option, callback, data):
+        return self.add_hook('config', option, callback, data).pointer
+
+    def hook_modifier(self, modifier, callback, data):
+        return self.add_hook('modifier', modifier, callback, data).pointer
+
+    def hook_modifier_exec(self, modifier, modifier_data, string):
+        for hook in self.hooks_of_kind('modifier'):
+            if hook.target == modifier:
+                string = self.call(hook.callback, hook.data, modifier, modifier_data, string)
+        return string
+
+    def hook_command(self, command, description, args, args_description,
+                     completion, callback, data):
+        return self.add_hook('command', command, callback, data).pointer
+
+    def command(self, buffer, command):
+        """Runs the given command. Commands of the script are dispatched to
+        it, /key bind and /key unbind change keys, and other commands are only
+        recorded (in commands).
+        """
+        self.commands.append(command)
+        if command.startswith('/mute '):
+            command = command[len('/mute '):]
+        name, _, args = command[1:].partition(' ')
+        if name == 'key':
+            action, _, args = args.partition(' ')
+            key, _, key_command = args.partition(' ')
+            if action == 'bind':
+                self.keys[key] = key_command
+            elif action == 'unbind':
+                self.keys.pop(key, None)
+            return self.WEECHAT_RC_OK
+        for hook in self.hooks_of_kind('command'):
+            if hook.target == name:
+                return self.call(hook.callback, hook.data, buffer, args)
+        return self.WEECHAT_RC_OK
+
+    def hook_timer(self, interval, align_second, max_calls, callback, data):
+        hook = self.add_hook('timer', interval, callback, data, [max_calls])
+        self.schedule(interval / 1000, hook)
+        return hook.pointer
+
+    def hook_process(self, command, timeout, callback, data):
+        return self.hook_process_hashtable(command, {}, timeout, callback, data)
+
+    def hook_process_hashtable(self, command, options, timeout, callback, data):
+        hook = self.add_hook('process', command, callback, data, options)
+        result = self.process_handler(command, options)
+        if result is not None:
+            self.schedule(self.process_latency, hook, result)
+        return hook.pointer
+
+    def process_output(self, pointer, out, return_code=WEECHAT_HOOK_PROCESS_RUNNING,
+                       err=''):
+        """Passes the given output of a running process to its hook."""
+        hook = self.hooks[pointer]
+        if return_code != self.WEECHAT_HOOK_PROCESS_RUNNING:
+            self.hooks.pop(pointer)
+        self.call(hook.callback, hook.data, hook.target, return_code, out, err)
+
+    # Timers.
+
+    def schedule(self, delay, hook, result=None):
+        heapq.heappush(
+            self.timers,
+            (self.clock.now + delay, next(self.hook_ids), hook.pointer, result)
+        )
+
+    def advance(self, seconds):
+        """Moves the virtual time forward, running timers and process
+        callbacks that are due.
+        """
+        end = self.clock.now + seconds
+        while self.timers and self.timers[0][0] <= end:
+            when, _, pointer, result = heapq.heappop(self.timers)
+            self.clock.now = max(self.clock.now, when)
+            hook = self.hooks.get(pointer)
+            if hook is None:
+                # Unhooked in the meantime.
+                continue
+            if hook.kind == 'process':
+                return_code, out, err = result
+                self.process_output(pointer, out, return_code, err)
+                continue
+            max_calls = hook.options[0]
+            if max_calls > 0:
+                hook.options[0] = remaining_calls = max_calls - 1
+                if remaining_calls == 0:
+                    self.hooks.pop(pointer)
+            else:
+                remaining_calls = -1
+            if pointer in self.hooks:
+                self.schedule(hook.target / 1000, hook)
+            self.call(hook.callback, hook.data, str(remaining_calls))
+        self.clock.now = end
+
+    # Infolists.
+
+    def infolist_get(self, name, pointer, arguments):
+        if name == 'option':
+            # Only options of the script are supported.
+            return FakeInfolist([
+                {'full_name': self.SCRIPT_PREFIX + option, 'value': value}
+                for option, value in sorted(self.config.items())
+                if self.string_match(self.SCRIPT_PREFIX + option, arguments, 1)
+            ])
+        elif name == 'hotlist':
+            return FakeInfolist([
+                {'buffer_pointer': buffer, 'count_00': counts[0],
+                 'count_01': counts[1], 'count_02': counts[2], 'count_03': counts[3]}
+                for buffer, counts in self.hotlist.items()
+            ])
+        elif name == 'key':
+            return FakeInfolist([
+                {'key': key, 'command': command}
+                for key, command in sorted(self.keys.items())
+            ])
+        elif name == 'hook':
+            return FakeInfolist([
+                {hook.kind: hook.target}
+                for hook in self.hooks_of_kind(arguments.split(',')[0])
+            ])
+        return ''
+
+    def infolist_next(self, infolist):
+        return infolist.next()
+
+    def infolist_string(self, infolist, var):
+        return infolist.current()[var]
+
+    def infolist_integer(self, infolist, var):
+        return infolist.current()[var]
+
+    def infolist_pointer(self, infolist, var):
+        return infolist.current()[var]
+
+    def infolist_free(self, infolist):
+        pass
+
+    # Hdata (buffers and their last lines).
+
+    def hdata_get(self, name):
+        return name
+
+    def hdata_get_list(self, hdata, name):
+        return next(iter(self.buffers), '')
+
+    def hdata_move(self, hdata, pointer, count):
+        return self.buffers.move(pointer, count)
+
+    def hdata_pointer(self, hdata, pointer, name):
+        if hdata == 'buffer':
+            # Lines of a buffer are represented by the buffer itself.
+            return pointer
+        elif hdata == 'lines':
+            return pointer if pointer in self.lines else ''
+        return self.lines.get(pointer, '')
+
+    def hdata_string(self, hdata, line_data, name):
+        if '|' in name:
+            index, name = name.split('|')
+            return line_data[name][int(index)]
+        return line_data[name]
+
+    def hdata_integer(self, hdata, line_data, name):
+        if name == 'tags_count':
+            return len(line_data['tags_array'])
+        return line_data[name]
+
+    hdata_char = hdata_integer
+    hdata_time = hdata_integer
+
+
+class FakeInfolist(object):
+    """A list of items that is iterated like a WeeChat infolist."""
+
+    def __init__(self, items):
+        self.items = items
+        self.position = -1
+
+    def next(self):
+        self.position += 1
+        return 1 if self.position < len(self.items) else 0
+
+    def current(self):
+        return self.items[self.position]
+
+
+class FakeBuffers(dict):
+    """Buffers (pointers mapped to their properties) that can be walked like
+    the linked list of buffers in WeeChat.
+
+    Positions of buffers are kept in an index, so moving from a buffer to
+    another one does not look through all buffers. The index is rebuilt only
+    after a buffer is removed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pointers = None
+        self.indexes = None
+
+    def __setitem__(self, pointer, properties):
+        if pointer not in self and self.pointers is not None:
+            self.indexes[pointer] = len(self.pointers)
+            self.pointers.append(pointer)
+        super().__setitem__(pointer, properties)
+
+    def __delitem__(self, pointer):
+        self.pointers = self.indexes = None
+        super().__delitem__(pointer)
+
+    def setdefault(self, pointer, default=None):
+        if pointer not in self:
+            self[pointer] = default
+        return self[pointer]
+
+    def update(self, *args, **kwargs):
+        for pointer, properties in dict(*args, **kwargs).items():
+            self[pointer] = properties
+
+    def pop(self, pointer, *default):
+        self.pointers = self.indexes = None
+        return super().pop(pointer, *default)
+
+    def popitem(self):
+        self.pointers = self.indexes = None
+        return super().popitem()
+
+    def clear(self):
+        self.pointers = self.indexes = None
+        super().clear()
+
+    def move(self, pointer, count):
+        """Returns the buffer that is count buffers from the given one ('' when
+        there is no such buffer).
+        """
+        if self.pointers is None:
+            self.pointers = list(self)
+            self.indexes = {p: i for i, p in enumerate(self.pointers)}
+        index = self.indexes[pointer] + count
+        return self.pointers[index] if 0 <= index < len(self.pointers) else ''
+
+
+class VirtualClock(object):
+    """A stand-in for the time module whose time() returns a settable time.
+
+    All other functions are delegated to the time module.
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
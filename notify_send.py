@@ -27,11 +27,27 @@
 # SOFTWARE.
 #
 
+import cProfile
+import collections
+import json
+import mmap
+import os
 import re
+import shlex
+import string
+import struct
 import subprocess
 import sys
 import time
 
+try:
+    # Python >= 3.11.
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
 
 # Ensure that we are running under WeeChat.
 try:
@@ -56,7 +72,7 @@ SCRIPT_LICENSE = 'MIT'
 SCRIPT_DESC = 'Sends highlight and message notifications through notify-send.'
 
 # Name of a function to be called when the script is unloaded.
-SCRIPT_SHUTDOWN_FUNC = ''
+SCRIPT_SHUTDOWN_FUNC = 'shutdown_callback'
 
 # Used character set (utf-8 by default).
 SCRIPT_CHARSET = ''
@@ -87,6 +103,17 @@ OPTIONS = {
         'off',
         'Send a notification on all messages in the currently active buffer.'
     ),
+    'notify_only_when_terminal_unfocused': (
+        'off',
+        'Send notifications only when the terminal with WeeChat is not '
+        'focused (requires a terminal that supports focus reporting).'
+    ),
+    'suppress_while_typing': (
+        '0',
+        'Do not send notifications while you are typing in WeeChat: when you '
+        'changed the input within the given number of seconds (0 means never '
+        'suppress notifications).'
+    ),
     'notify_on_all_messages_in_buffers': (
         '',
         'A comma-separated list of buffers for which you want to receive '
@@ -107,6 +134,13 @@ OPTIONS = {
         'A minimal delay between successive notifications from the same '
         'buffer (in milliseconds; set to 0 to show all notifications).'
     ),
+    'max_notification_delay': (
+        '0',
+        'When greater than min_notification_delay, the delay between '
+        'notifications from a buffer doubles while they keep coming, up to '
+        'this value (in milliseconds), and halves again when the buffer is '
+        'quiet (0 means that the delay is always min_notification_delay).'
+    ),
     'ignore_messages_tagged_with': (
         ','.join([
             'notify_none',    # Buffer with line is not added to hotlist
@@ -150,6 +184,18 @@ OPTIONS = {
         ': ',
         'A separator between a nick and a message.'
     ),
+    'summary_template': (
+        '',
+        'A template of the summary of notifications, with fields ${nick}, '
+        '${buffer}, ${server}, ${message}, ${time}, and ${matched_keyword} '
+        '(empty means the nick for private messages and the buffer otherwise).'
+    ),
+    'body_template': (
+        '',
+        'A template of the body of notifications, with the same fields as '
+        'summary_template (empty means the message, preceded by the nick and '
+        'nick_separator when not in a private buffer).'
+    ),
     'escape_html': (
         'on',
         "Escapes the '<', '>', and '&' characters in notification messages."
@@ -166,6 +212,13 @@ OPTIONS = {
         '/usr/share/icons/hicolor/32x32/apps/weechat.png',
         'Path to an icon to be shown in notifications.'
     ),
+    'icon_dirs': (
+        '',
+        'Comma-separated list of directories with icons. Private messages get '
+        'the avatar <dir>/<server>/<nick>.png and other messages the icon of '
+        'their network, <dir>/<server>.png (.svg and .jpg files work too). '
+        'When found, it is used instead of the icon option.'
+    ),
     'desktop_entry': (
         'weechat',
         'Name of the desktop entry for WeeChat.'
@@ -193,15 +246,411 @@ OPTIONS = {
         'off',
         'When printing a message in a buffer, automatically close any prior '
         'notification associated with that buffer.'
-    )
+    ),
+    'command': (
+        'notify-send',
+        'Command used to send notifications, optionally followed by extra '
+        'arguments (notify-send and dunstify are supported).'
+    ),
+    'engine': (
+        'print',
+        'How to find out about new messages: print (look at every printed '
+        'message), signals (look only at highlights and private messages; '
+        'when the same line is printed into several buffers within a second, '
+        'the wrong buffer may be picked), '
+        'auto (signals when no option needs to look at other messages, print '
+        'otherwise), or hotlist (periodically look at the hotlist, which is '
+        'cheaper but supports fewer options).'
+    ),
+    'hotlist_poll_interval': (
+        '5',
+        'How often the hotlist is looked at when engine is hotlist (in '
+        'seconds).'
+    ),
+    'quiet_hours': (
+        '',
+        'A comma-separated list of daily periods (e.g. 23:00-07:00) during '
+        'which no notifications should be shown.'
+    ),
+    'dnd_digest': (
+        'off',
+        'When do-not-disturb ends, send a notification summarizing buffers '
+        'with new highlights or private messages.'
+    ),
+    'away_digest': (
+        'off',
+        'While you are away, collect notifications instead of sending them, '
+        'and when you come back, send a digest: on (a single notification) or '
+        'buffer (a notification for every buffer). It takes precedence over '
+        'notify_when_away. Coming back is detected on IRC servers.'
+    ),
+    'away_digest_lines': (
+        '3',
+        'Number of the most recent messages of every buffer to show in away '
+        'digests.'
+    ),
+    'history_size': (
+        '0',
+        'Number of sent notifications to remember for /notify_send history '
+        '(0 means no history).'
+    ),
+    'trace_size': (
+        '0',
+        'Number of recent notification decisions to remember for '
+        '/notify_send why (0 means no tracing).'
+    ),
+    'regex_time_budget': (
+        '0',
+        'Maximal time (in milliseconds) that a regular expression from the '
+        'options may take to match a message. Regular expressions that take '
+        'longer are disabled (see /notify_send lint). 0 means no limit.'
+    ),
+    'actions': (
+        'off',
+        'Add actions to notifications: clicking a notification or choosing '
+        '"Open" switches to its buffer, "Mark read" removes the buffer from '
+        'the hotlist. Notifications are then sent via D-Bus (requires gdbus) '
+        'instead of via the command from option command.'
+    ),
+    'shadow_profile': (
+        '',
+        'Name of a config profile (options shadow.<name>.<option>) whose '
+        'decisions are compared with the decisions of the options, without '
+        'sending notifications (see /notify_send shadow).'
+    ),
+    'shadow_max_rate': (
+        '100',
+        'Maximal number of messages per second for which the shadow profile '
+        'is evaluated. When more messages come, they are sampled, and the '
+        'messages that are not evaluated are reported as skipped.'
+    ),
 }
 
 NOTIFICATION_ID_VAR = 'notify_send_notification_id'
 
+# Time when the last notification sent for a buffer expires (0 when it does not
+# expire or when its expiration is unknown).
+NOTIFICATION_EXPIRATION_VAR = 'notify_send_notification_expiration'
+
+# We store the time of the last notification and the current delay between
+# notifications (see max_notification_delay) in buffer-local variables to make
+# them persistent over the lifetime of this script.
+LAST_NOTIFICATION_TIME_VAR = 'notify_send_last_notification_time'
+NOTIFICATION_DELAY_VAR = 'notify_send_notification_delay'
+
+# Options that can be overridden for buffers whose names match a mask by
+# setting plugins.var.python.notify_send.<option>.<buffer-mask>.
+BUFFER_OPTIONS = ('urgency', 'timeout', 'min_notification_delay',
+                  'max_notification_delay', 'max_length', 'ellipsis', 'icon',
+                  'transient')
+
+# Buffer overrides as a list of (option, mask, value) triples, from the most
+# specific (longest) mask (see apply_buffer_overrides_config()).
+BUFFER_OVERRIDES = []
+
+# Cache of buffer overrides that apply to a buffer (a dictionary mapping
+# option names to their values) indexed by buffer pointers.
+BUFFER_POLICIES = {}
+
+# Extensions of icons in icon_dirs, in the order of preference.
+ICON_EXTENSIONS = ('.png', '.svg', '.jpg')
+
+# Directories with icons (see apply_icons_config()).
+ICON_DIRS = []
+
+# Resolved icons (paths, or '' when there is no icon) indexed by (server,
+# nick) pairs, where nick is '' for icons of networks.
+ICON_CACHE = {}
+
+# Listings of directories with icons (pairs of the modification time, or None
+# when the directory does not exist, and a set of names of files) indexed by
+# their paths.
+ICON_DIR_LISTINGS = {}
+
+# How often (in seconds) should the listed directories be checked for
+# changes?
+ICON_DIRS_CHECK_INTERVAL = 60
+
+# Time of the last check of the listed directories for changes.
+ICON_DIRS_CHECKED = 0.0
+
+# Maximal time (in seconds) that a regular expression from the options may
+# take to match a text (0 means no limit; see apply_regex_time_budget_config()).
+REGEX_TIME_BUDGET = 0
+
+# Regular expressions from the options that have been disabled because they
+# took longer than REGEX_TIME_BUDGET.
+SLOW_PATTERNS = set()
+
+# Texts on which /notify_send lint measures the cost of regular expressions
+# that match messages and buffer names.
+LINT_SAMPLE_MESSAGES = (
+    'hi',
+    'john: are you around?',
+    'the build is broken again, see https://ci.example.com/job/1234/console',
+    'deploy of api-server v2.3.1 to production finished in 4m12s',
+    '<b>html</b> & "quotes" and some unicode: \u017elu\u0165ou\u010dk\u00fd k\u016f\u0148',
+    'lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua. ' * 4,
+)
+LINT_SAMPLE_BUFFER_NAMES = (
+    'irc.libera.#weechat',
+    '#weechat',
+    'irc.server.libera',
+    'python.slack.myteam.#general',
+    'irc.oftc.nickserv',
+)
+
+# Lengths of crafted texts on which /notify_send lint looks for catastrophic
+# backtracking. Measuring stops at the first length on which matching takes
+# longer than LINT_SLOW_MATCH_TIME (in seconds), so that /notify_send lint
+# does not hang WeeChat on the patterns it is supposed to find.
+LINT_CRAFTED_TEXT_LENGTHS = (8, 12, 16, 20, 24, 28, 32)
+LINT_SLOW_MATCH_TIME = 0.001
+
+# Conditions of notification rules that take an argument, mapped to the
+# attributes of Rule that hold their arguments (see parse_rule()).
+RULE_CONDITIONS = {
+    'buffer': 'buffer_masks',
+    'server': 'servers',
+    'nick': 'nick_masks',
+    'tag': 'tags',
+    'message': 'message_patterns',
+}
+
+# Notification rules compiled into a RuleTable (see apply_rules_config()), or
+# None when there are no rules.
+NOTIFICATION_RULES = None
+
+# The urgency that the rule that decided the last message set for its
+# notification ('' when no rule set it).
+RULE_URGENCY = ''
+
+# The text that a pattern from notify_on_messages_that_match matched in the
+# last message, when the pattern decided that it is notified ('' otherwise).
+# It is the value of ${matched_keyword} in templates.
+MATCHED_KEYWORD = ''
+
+# Templates of the summary and body of notifications (NotificationTemplates),
+# or None when the default format is used (see apply_templates_config()).
+SUMMARY_TEMPLATE = None
+BODY_TEMPLATE = None
+
+# Arguments that the supported commands use for the individual parts of a
+# notification.
+COMMAND_ARGUMENTS = {
+    'notify-send': {
+        'print_id': ['--print-id'],
+        'app_name': '--app-name',
+        'icon': '--icon',
+        'hint': '--hint',
+        'timeout': '--expire-time',
+        'urgency': '--urgency',
+        'replace_id': '--replace-id',
+        # The "im.received" category means "A received instant message
+        # notification".
+        'category': ['--category', 'im.received'],
+    },
+    'dunstify': {
+        'print_id': ['--printid'],
+        'app_name': '--appname',
+        'icon': '--icon',
+        'hint': '--hints',
+        'timeout': '--timeout',
+        'urgency': '--urgency',
+        'replace_id': '--replace',
+        # dunstify has no parameter for the category, so pass it as a hint.
+        'category': ['--hints', 'string:category:im.received'],
+    },
+}
+
+# Cache of parts of commands for sending notifications that depend only on the
+# configuration (see notify_cmd_parts()). It is cleared in apply_config().
+# Icons are a part of the key, and with icon_dirs, there can be an icon for
+# every nick, so only the most recently used parts are kept.
+NOTIFY_CMD_PARTS = collections.OrderedDict()
+NOTIFY_CMD_PARTS_SIZE = 32
+
+# The D-Bus interface of notification daemons
+# (https://specifications.freedesktop.org/notification-spec/).
+DBUS_NOTIFICATIONS = [
+    '--session',
+    '--dest', 'org.freedesktop.Notifications',
+    '--object-path', '/org/freedesktop/Notifications',
+]
+
+# Actions of notifications (see option actions) as a list of pairs (key,
+# label). The "default" action is invoked by clicking a notification.
+NOTIFICATION_ACTIONS = [
+    ('default', 'Open'),
+    ('open', 'Open'),
+    ('read', 'Mark read'),
+]
+
+# Values of the urgency hint for the urgency option.
+URGENCY_LEVELS = {
+    'low': 0,
+    'normal': 1,
+    'critical': 2,
+}
+
+# A process hook that listens to signals of the notification daemon when
+# notifications have actions (see start_action_monitor()).
+ACTION_MONITOR_HOOK = ''
+
+# Output of the action monitor that does not yet form a complete line.
+ACTION_MONITOR_OUTPUT = ''
+
+# Full names of buffers of notifications with actions, indexed by notification
+# IDs. It is bounded by MAX_ACTION_NOTIFICATIONS.
+ACTION_NOTIFICATIONS = {}
+
+# Maximal number of notifications whose actions are handled.
+MAX_ACTION_NOTIFICATIONS = 1000
+
+# Modifiers that other scripts can hook to veto notifications
+# (SHOULD_NOTIFY_MODIFIER) or to change them (NOTIFICATION_MODIFIER).
+SHOULD_NOTIFY_MODIFIER = 'notify_send_should_notify'
+NOTIFICATION_MODIFIER = 'notify_send_notification'
+
+# Our modifiers that are hooked by other scripts (see
+# refresh_modifier_hooks()). Modifiers that nobody hooked are not run at all.
+HOOKED_MODIFIERS = frozenset()
+
+# The decision trace (None when tracing is disabled, see apply_config()).
+DECISION_TRACE = None
+
+# Name of the file with the history of sent notifications (in WeeChat's data
+# directory).
+HISTORY_FILE_NAME = 'notify_send_history.dat'
+
+# The history of sent notifications (None when disabled, see apply_config()).
+NOTIFICATION_HISTORY = None
+
+# Hooks that catch messages to notify about (see hook_notifications()).
+NOTIFICATION_HOOKS = []
+
+# Configuration of the hooks in NOTIFICATION_HOOKS (engine, poll interval).
+NOTIFICATION_HOOKS_CONFIG = None
+
+# Hotlist counts from the last poll (when engine is hotlist).
+HOTLIST_SNAPSHOT = {}
+
+# Time when do-not-disturb ends (0 when it lasts until turned off, None when it
+# is not active).
+DND_UNTIL = None
+
+# A timer that ends do-not-disturb.
+DND_TIMER = ''
+
+# Hotlist counts from the moment do-not-disturb started (for the digest).
+DND_HOTLIST = {}
+
+# For how long (in seconds) after the input changed are notifications
+# suppressed (0 means that input activity is not tracked).
+SUPPRESS_WHILE_TYPING = 0
+
+# Time of the last change of the input.
+LAST_INPUT_TIME = 0.0
+
+# A signal hook that tracks changes of the input ('' when not tracking).
+INPUT_ACTIVITY_HOOK = ''
+
+# A profiler (cProfile.Profile) of the callbacks that catch messages while
+# profiling is on, or None (see /notify_send profile).
+PROFILER = None
+
+# Only every PROFILE_EVERY-th call of the callbacks is profiled.
+PROFILE_EVERY = 1
+
+# Number of calls of the callbacks since profiling started.
+PROFILE_CALLS = 0
+
+# A timer that stops profiling after the requested time ('' when there is
+# none).
+PROFILE_TIMER = ''
+
+# The last snapshot of memory allocations taken by /notify_send profile memory
+# (a tracemalloc.Snapshot), or None.
+MEMORY_SNAPSHOT = None
+
+# Number of the biggest differences in memory allocations to print.
+MEMORY_DIFF_PRINT_LIMIT = 10
+
+# A config profile evaluated alongside the options (a ShadowProfile), or None
+# when the shadow_profile option is empty.
+SHADOW_PROFILE = None
+
+# Options that can be set in shadow profiles. Other options do not change
+# whether a notification is sent.
+SHADOW_OPTIONS = (
+    'notify_on_highlights',
+    'notify_on_privmsgs',
+    'notify_on_filtered_messages',
+    'notify_when_away',
+    'notify_for_current_buffer',
+    'notify_on_all_messages_in_current_buffer',
+    'notify_only_when_terminal_unfocused',
+    'notify_on_all_messages_in_buffers',
+    'notify_on_all_messages_in_buffers_that_match',
+    'notify_on_messages_that_match',
+    'ignore_messages_tagged_with',
+    'ignore_buffers',
+    'ignore_buffers_starting_with',
+    'ignore_nicks',
+    'ignore_nicks_starting_with',
+    'suppress_while_typing',
+    'away_digest',
+)
+
+# Number of the most recent examples to keep for every kind of difference
+# between decisions of the shadow profile and of the options.
+SHADOW_EXAMPLES = 3
+
+# Notifications collected while away (an AwayDigest), or None when the
+# away_digest option is off.
+AWAY_DIGEST = None
+
+# A signal hook that finds out when you come back on IRC servers ('' when the
+# away_digest option is off).
+AWAY_DIGEST_HOOK = ''
+
+# Messages longer than this are shortened in away digests, so they do not
+# take much memory.
+MAX_AWAY_DIGEST_LINE_LENGTH = 200
+
+# A timer that starts do-not-disturb at the beginning of quiet hours.
+QUIET_HOURS_TIMER = ''
+
+# The currently active buffer, kept up to date by focus_changed_callback()
+# (None when it is not tracked).
+CURRENT_BUFFER = None
+
+# Is the terminal with WeeChat focused? It is known only when focus reporting
+# is on (see apply_focus_config()). Otherwise, the terminal is assumed to be
+# focused.
+TERMINAL_FOCUSED = True
+
+# Is focus reporting of the terminal on?
+FOCUS_REPORTING = False
+
+# Keys sent by the terminal when it gains or loses focus (CSI I and CSI O).
+FOCUS_KEYS = {
+    'in': 'meta2-I',
+    'out': 'meta2-O',
+}
+
+# Commands that the keys from FOCUS_KEYS were bound to before focus reporting
+# started ('' when a key was not bound), so they can be restored.
+FOCUS_KEY_BINDINGS = {}
+
 
 class Notification(object):
     """A representation of a notification."""
 
+    __slots__ = ('source', 'message', 'icon', 'desktop_entry', 'timeout',
+                 'transient', 'urgency', 'replace_id')
+
     def __init__(self, source, message, icon,
                  desktop_entry, timeout, transient, urgency, replace_id):
         self.source = source
@@ -214,6 +663,415 @@ class Notification(object):
         self.replace_id = replace_id
 
 
+class DecisionTrace(object):
+    """A fixed-size ring buffer of recent notification decisions.
+
+    All the storage is allocated upfront, so recording a decision only
+    overwrites the oldest slot.
+    """
+
+    __slots__ = ('size', 'next', 'count', 'times', 'durations',
+                 'buffers', 'nicks', 'results', 'reasons')
+
+    def __init__(self, size):
+        self.size = size
+        self.next = 0
+        self.count = 0
+        self.times = [0.0] * size
+        self.durations = [0.0] * size
+        self.buffers = [''] * size
+        self.nicks = [''] * size
+        self.results = [False] * size
+        self.reasons = [''] * size
+
+    def record(self, time, duration, buffer, nick, result, reason):
+        """Records a decision, overwriting the oldest one when full."""
+        i = self.next
+        self.times[i] = time
+        self.durations[i] = duration
+        self.buffers[i] = buffer
+        self.nicks[i] = nick
+        self.results[i] = result
+        self.reasons[i] = reason
+        self.next = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def entries(self, limit=None):
+        """Returns a list of recorded decisions, from the oldest to the newest.
+
+        Each decision is a tuple (time, duration, buffer, nick, result,
+        reason). When limit is given, only that many newest decisions are
+        returned.
+        """
+        count = self.count if limit is None else min(limit, self.count)
+        start = self.next - count
+        return [
+            (self.times[i], self.durations[i], self.buffers[i],
+             self.nicks[i], self.results[i], self.reasons[i])
+            for i in (j % self.size for j in range(start, self.next))
+        ]
+
+
+class NotificationHistory(object):
+    """A history of sent notifications stored in a memory-mapped ring file.
+
+    The file consists of a header and a fixed number of fixed-size records, so
+    appending a notification overwrites the oldest record in place and the
+    size of the file is bounded. Texts that do not fit into their fields are
+    truncated. Changes are written back to the file by the OS.
+    """
+
+    MAGIC = b'NSHIST01'
+
+    # Magic, record size, capacity, index of the next record, record count.
+    HEADER = struct.Struct('<8sIIII')
+
+    # Time, notification ID, buffer, nick, message.
+    RECORD = struct.Struct('<dI64s32s160s')
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        # Create the file when it does not exist.
+        open(path, 'ab').close()
+        self.file = open(path, 'r+b')
+        size = self.HEADER.size + capacity * self.RECORD.size
+        self.file.seek(0)
+        header = self.file.read(self.HEADER.size)
+        if (len(header) != self.HEADER.size or
+                self.HEADER.unpack(header)[:3] !=
+                (self.MAGIC, self.RECORD.size, capacity)):
+            # A new file or a file from a different configuration.
+            self.file.truncate(0)
+            self.file.write(self.HEADER.pack(self.MAGIC, self.RECORD.size,
+                                             capacity, 0, 0))
+        self.file.truncate(size)
+        self.file.flush()
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        _, _, _, self.next, self.count = self.HEADER.unpack_from(self.mmap)
+
+    def append(self, time, notification_id, buffer, nick, message):
+        """Appends a notification, overwriting the oldest one when full."""
+        self.RECORD.pack_into(
+            self.mmap,
+            self.HEADER.size + self.next * self.RECORD.size,
+            time,
+            notification_id,
+            encode_history_field(buffer, 64),
+            encode_history_field(nick, 32),
+            encode_history_field(message, 160)
+        )
+        self.next = (self.next + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        self.HEADER.pack_into(self.mmap, 0, self.MAGIC, self.RECORD.size,
+                              self.capacity, self.next, self.count)
+
+    def entries(self):
+        """Returns a list of remembered notifications, from the oldest to the
+        newest.
+
+        Each notification is a tuple (time, notification ID, buffer, nick,
+        message).
+        """
+        entries = []
+        for j in range(self.next - self.count, self.next):
+            offset = self.HEADER.size + (j % self.capacity) * self.RECORD.size
+            time, notification_id, buffer, nick, message = \
+                self.RECORD.unpack_from(self.mmap, offset)
+            entries.append((time, notification_id, decode_history_field(buffer),
+                            decode_history_field(nick), decode_history_field(message)))
+        return entries
+
+    def close(self):
+        """Closes the history file."""
+        self.mmap.close()
+        self.file.close()
+
+
+class AwayDigest(object):
+    """Notifications collected while away, summarized per buffer.
+
+    For every buffer, it keeps the number of collected notifications, the time
+    of the first one, and the given number of the most recent lines.
+    """
+
+    __slots__ = ('lines', 'buffers')
+
+    def __init__(self, lines):
+        self.lines = lines
+        # Lists [count, first time, deque of lines] indexed by buffers.
+        self.buffers = {}
+
+    def add(self, buffer, time, line):
+        """Adds a notification with the given line into the digest."""
+        summary = self.buffers.get(buffer)
+        if summary is None:
+            summary = self.buffers[buffer] = [
+                0, time, collections.deque(maxlen=self.lines)
+            ]
+        summary[0] += 1
+        summary[2].append(line)
+
+    def pop(self, buffer):
+        """Removes the summary of the given buffer from the digest and returns
+        it as a tuple (count, first time, list of lines).
+        """
+        count, first_time, lines = self.buffers.pop(buffer)
+        return count, first_time, list(lines)
+
+
+class ShadowProfile(object):
+    """A config profile that is evaluated alongside the options.
+
+    The options and rules of the profile are read into a ShadowConfig when
+    the config is applied. For every difference between the decisions of the
+    profile and of the options, given by the outcome and the reasons of both
+    decisions, it counts the messages and keeps a few examples. Messages for
+    which the profile is not evaluated (see should_evaluate()) are counted as
+    skipped.
+    """
+
+    __slots__ = ('name', 'config', 'max_rate', 'evaluated', 'skipped',
+                 'differences', 'second', 'second_messages', 'second_evaluated',
+                 'sample_every')
+
+    def __init__(self, name, config, max_rate):
+        self.name = name
+        # A ShadowConfig.
+        self.config = config
+        self.max_rate = max_rate
+        self.reset()
+
+    def reset(self):
+        """Resets the counters."""
+        self.evaluated = 0
+        self.skipped = 0
+        # Lists [count, deque of examples] indexed by (shadow result, shadow
+        # reason, reason).
+        self.differences = {}
+        self.second = 0
+        self.second_messages = 0
+        self.second_evaluated = 0
+        self.sample_every = 1
+
+    def should_evaluate(self, time):
+        """Should the profile be evaluated for a message that came at the
+        given time?
+
+        Every n-th message is evaluated, where n follows from the number of
+        messages in the previous second, and at most max_rate messages per
+        second.
+        """
+        second = int(time)
+        if second != self.second:
+            self.sample_every = max(-(-self.second_messages // self.max_rate), 1)
+            self.second = second
+            self.second_messages = 0
+            self.second_evaluated = 0
+        self.second_messages += 1
+        if (self.second_evaluated >= self.max_rate or
+                self.second_messages % self.sample_every):
+            self.skipped += 1
+            return False
+        self.second_evaluated += 1
+        self.evaluated += 1
+        return True
+
+    def record(self, buffer_name, nick, message, decision, shadow_decision):
+        """Records the decisions of the options and of the profile for the
+        given message.
+        """
+        result, reason = decision
+        shadow_result, shadow_reason = shadow_decision
+        if shadow_result == result:
+            return
+        key = (shadow_result, shadow_reason, reason)
+        difference = self.differences.get(key)
+        if difference is None:
+            difference = self.differences[key] = [
+                0, collections.deque(maxlen=SHADOW_EXAMPLES)
+            ]
+        difference[0] += 1
+        difference[1].append((buffer_name, nick, message))
+
+
+class ShadowConfig(object):
+    """Everything that decisions with a shadow profile depend on besides
+    messages, read when the config is applied.
+
+    It is passed to notification_decision_disregarding_time() and the
+    functions that look up options instead of WeeChat, so it provides
+    config_get_plugin() like the weechat module.
+    """
+
+    __slots__ = ('options', 'rules', 'suppress_while_typing', 'away_digest')
+
+    def __init__(self, options, rules, suppress_while_typing, away_digest):
+        self.options = options
+        # A RuleTable (the rules of the options when the profile has no rules
+        # of its own), or None.
+        self.rules = rules
+        self.suppress_while_typing = suppress_while_typing
+        self.away_digest = away_digest
+
+    def config_get_plugin(self, option):
+        return self.options.get(option, '')
+
+
+class Rule(object):
+    """A notification rule: conditions on messages and an action.
+
+    All conditions have to hold for the rule to match a message.
+    """
+
+    __slots__ = ('name', 'number', 'buffer_masks', 'servers', 'private',
+                 'nick_masks', 'tags', 'highlight', 'message_patterns',
+                 'notify', 'urgency')
+
+    def __init__(self, name, number):
+        self.name = name
+        self.number = number
+        self.buffer_masks = []
+        self.servers = []
+        self.private = False
+        self.nick_masks = []
+        self.tags = []
+        self.highlight = False
+        self.message_patterns = []
+        self.notify = True
+        self.urgency = ''
+
+    def matches_buffer(self, buffer):
+        """Do the conditions on the buffer hold for the given buffer?"""
+        if self.private and not is_private_message(buffer):
+            return False
+
+        server = weechat.buffer_get_string(buffer, 'localvar_server')
+        for expected_server in self.servers:
+            if server != expected_server:
+                return False
+
+        buffer_names = names_for_buffer(buffer)
+        for mask in self.buffer_masks:
+            if not any(weechat.string_match(name, mask, 0) for name in buffer_names):
+                return False
+
+        return True
+
+    def matches_message(self, tags, nick, is_highlight, message):
+        """Do the conditions on the message hold for the given message?"""
+        if self.highlight and not is_highlight:
+            return False
+
+        for tag in self.tags:
+            if tag not in tags:
+                return False
+
+        for mask in self.nick_masks:
+            if not weechat.string_match(nick, mask, 0):
+                return False
+
+        for pattern in self.message_patterns:
+            if not pattern_search(pattern, message):
+                return False
+
+        return True
+
+
+class RuleTable(object):
+    """Notification rules compiled for evaluation.
+
+    Conditions on buffers are evaluated only once for every buffer: the rules
+    that can match messages in a buffer are bucketed by their first tag
+    condition (rules without tag conditions share a bucket). For a message,
+    only the rules in the buckets of its buffer and tags are looked at.
+    """
+
+    __slots__ = ('rules', 'buckets')
+
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: rule.number)
+        # Buckets of buffers (pairs of a list of rules without tag conditions
+        # and a dictionary mapping tags to lists of rules) indexed by buffer
+        # pointers. Rules are stored as (position, rule) pairs.
+        self.buckets = {}
+
+    def buffer_buckets(self, buffer):
+        """Returns buckets of the rules that can match messages in the given
+        buffer.
+        """
+        buckets = self.buckets.get(buffer)
+        if buckets is None:
+            untagged_rules = []
+            tagged_rules = {}
+            for position, rule in enumerate(self.rules):
+                if not rule.matches_buffer(buffer):
+                    continue
+                if rule.tags:
+                    tagged_rules.setdefault(rule.tags[0], []).append((position, rule))
+                else:
+                    untagged_rules.append((position, rule))
+            buckets = self.buckets[buffer] = (untagged_rules, tagged_rules)
+        return buckets
+
+    def forget_buffer(self, buffer):
+        """Forgets buckets of the given buffer (e.g. when it is renamed)."""
+        self.buckets.pop(buffer, None)
+
+    def match(self, buffer, tags, nick, is_highlight, message):
+        """Returns the first rule that matches the given message, or None."""
+        rules, tagged_rules = self.buffer_buckets(buffer)
+        if tagged_rules:
+            rules_for_tags = [
+                rule for tag in tags for rule in tagged_rules.get(tag, ())
+            ]
+            if rules_for_tags:
+                rules = sorted(rules + rules_for_tags, key=lambda rule: rule[0])
+
+        for _, rule in rules:
+            if rule.matches_message(tags, nick, is_highlight, message):
+                return rule
+        return None
+
+
+class NotificationTemplate(object):
+    """A template of a part of notifications, compiled into pieces.
+
+    Every piece is either a literal string or a function that computes the
+    value of a field from a message (see TEMPLATE_FIELDS), so only the fields
+    that the template uses are computed.
+    """
+
+    __slots__ = ('pieces',)
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def render(self, buffer, nick, message, date=None):
+        """Returns the text of the template for the given message."""
+        return ''.join([
+            piece if piece.__class__ is str else piece(buffer, nick, message, date)
+            for piece in self.pieces
+        ])
+
+
+def encode_history_field(text, size):
+    """Encodes the given text into at most size bytes, without splitting a
+    multibyte character.
+    """
+    encoded = text.encode('utf-8', 'replace')
+    if len(encoded) <= size:
+        return encoded
+    return encoded[:size].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def decode_history_field(field):
+    """Decodes a field encoded by encode_history_field()."""
+    return field.rstrip(b'\0').decode('utf-8', 'replace')
+
+
 def buffer_get_notification_id(buffer):
     """Returns the ID of the last notification sent for a buffer,
     or '0' if none have been sent.
@@ -228,11 +1086,43 @@ def buffer_set_notification_id(buffer, notification_id):
     weechat.buffer_set(buffer, property, notification_id)
 
 
+def buffer_set_notification_expiration(buffer, timeout):
+    """Saves the time when the last notification sent for a buffer expires,
+    based on its timeout (in milliseconds).
+    """
+    try:
+        timeout = int(timeout)
+    except ValueError:
+        timeout = 0
+    # With a zero timeout, the notification does not expire. With a negative
+    # or an invalid timeout, the notification daemon chooses when it expires.
+    expiration = time.time() + timeout / 1000 if timeout > 0 else 0
+    buffer_set_float(buffer, 'localvar_set_' + NOTIFICATION_EXPIRATION_VAR, expiration)
+
+
+def buffer_notification_has_expired(buffer):
+    """Has the last notification sent for a buffer expired?"""
+    expiration = buffer_get_float(buffer, 'localvar_' + NOTIFICATION_EXPIRATION_VAR)
+    return 0 < expiration <= time.time()
+
+
 def default_value_of(option):
     """Returns the default value of the given option."""
     return OPTIONS[option][0]
 
 
+def int_option(option):
+    """Returns the value of the given numeric option.
+
+    When the option is not set to a valid integer, its default value is
+    returned.
+    """
+    try:
+        return int(weechat.config_get_plugin(option))
+    except ValueError:
+        return int(default_value_of(option))
+
+
 def add_default_value_to(description, default_value):
     """Adds the given default value to the given option description."""
     # All descriptions end with a period, so do not add another period.
@@ -279,9 +1169,18 @@ def message_printed_callback(data, buffer, date, tags, is_displayed,
     tags = parse_tags(tags)
     nick = nick_that_sent_message(tags, prefix)
 
-    if notification_should_be_sent(buffer, tags, nick, is_displayed, is_highlight, message):
-        notification = prepare_notification(buffer, nick, message)
-        send_notification(buffer, notification)
+    if (notification_should_be_sent(buffer, tags, nick, is_displayed, is_highlight, message) and
+            (not HOOKED_MODIFIERS or
+             modifiers_allow_notification(buffer, tags, nick, is_highlight, message))):
+        notification = prepare_notification(buffer, nick, message, date)
+        if RULE_URGENCY:
+            notification.urgency = RULE_URGENCY
+        if HOOKED_MODIFIERS:
+            notification = modify_notification(buffer, notification)
+            if notification is None:
+                return weechat.WEECHAT_RC_OK
+        notification_id = send_notification(buffer, notification)
+        record_notification(buffer, notification_id, nick, message)
     elif (i_am_author_of_message(buffer, nick) and
           auto_close_prior_notification_for_buffer(buffer)):
         close_notification(buffer)
@@ -289,87 +1188,270 @@ def message_printed_callback(data, buffer, date, tags, is_displayed,
     return weechat.WEECHAT_RC_OK
 
 
+def record_notification(buffer, notification_id, nick, message):
+    """Appends a sent notification to the history (when it is enabled)."""
+    if NOTIFICATION_HISTORY is not None:
+        NOTIFICATION_HISTORY.append(
+            time.time(),
+            int(notification_id),
+            weechat.buffer_get_string(buffer, 'name'),
+            nick,
+            message
+        )
+
+
+def refresh_modifier_hooks():
+    """Finds out which of our modifiers are hooked by other scripts."""
+    global HOOKED_MODIFIERS
+    modifiers = set()
+    infolist = weechat.infolist_get('hook', '', 'modifier')
+    if infolist:
+        while weechat.infolist_next(infolist):
+            modifier = weechat.infolist_string(infolist, 'modifier')
+            if modifier in (SHOULD_NOTIFY_MODIFIER, NOTIFICATION_MODIFIER):
+                modifiers.add(modifier)
+        weechat.infolist_free(infolist)
+    HOOKED_MODIFIERS = frozenset(modifiers)
+
+
+def script_loaded_callback(data, signal, signal_data):
+    """A callback when a script is loaded or unloaded."""
+    refresh_modifier_hooks()
+    return weechat.WEECHAT_RC_OK
+
+
+def modifiers_allow_notification(buffer, tags, nick, is_highlight, message):
+    """Do other scripts allow a notification about the given message?
+
+    The notify_send_should_notify modifier gets the buffer pointer as its data
+    and the message as a JSON object. Returning an empty string vetoes the
+    notification.
+    """
+    if SHOULD_NOTIFY_MODIFIER not in HOOKED_MODIFIERS:
+        return True
+    string = json.dumps({
+        'nick': nick,
+        'tags': list(tags),
+        'highlight': bool(is_highlight),
+        'message': message,
+    })
+    return weechat.hook_modifier_exec(SHOULD_NOTIFY_MODIFIER, buffer, string) != ''
+
+
+def modify_notification(buffer, notification):
+    """Lets other scripts change the given notification.
+
+    The notify_send_notification modifier gets the buffer pointer as its data
+    and the notification as a JSON object, and returns the (changed)
+    notification in the same form. Returning an empty string drops the
+    notification.
+
+    Returns the notification to be sent, or None when it should be dropped.
+    """
+    if NOTIFICATION_MODIFIER not in HOOKED_MODIFIERS:
+        return notification
+    fields = {name: getattr(notification, name) for name in Notification.__slots__}
+    string = weechat.hook_modifier_exec(NOTIFICATION_MODIFIER, buffer, json.dumps(fields))
+    if string == '':
+        return None
+    try:
+        changes = json.loads(string)
+        fields.update(
+            (name, changes[name]) for name in Notification.__slots__ if name in changes
+        )
+        for name, value in fields.items():
+            if not isinstance(value, bool if name == 'transient' else str):
+                raise ValueError('invalid value of {}: {!r}'.format(name, value))
+    except (ValueError, TypeError, KeyError) as ex:
+        print_error('invalid notification from modifier {}: {}'.format(
+            NOTIFICATION_MODIFIER, ex
+        ))
+        return notification
+    return Notification(**fields)
+
+
 def notification_should_be_sent(buffer, tags, nick, is_displayed, is_highlight, message):
     """Should a notification be sent?"""
-    if notification_should_be_sent_disregarding_time(buffer, tags, nick,
-                                                     is_displayed, is_highlight, message):
+    if DECISION_TRACE is not None:
+        return traced_notification_should_be_sent(buffer, tags, nick, is_displayed,
+                                                  is_highlight, message)
+
+    should_be_sent, _ = notification_decision(buffer, tags, nick, is_displayed,
+                                              is_highlight, message)
+    return should_be_sent
+
+
+def traced_notification_should_be_sent(buffer, tags, nick, is_displayed,
+                                       is_highlight, message):
+    """A variant of notification_should_be_sent() that records the decision
+    into the decision trace.
+    """
+    start_time = time.perf_counter()
+    should_be_sent, reason = notification_decision(buffer, tags, nick, is_displayed,
+                                                   is_highlight, message)
+    DECISION_TRACE.record(time.time(), time.perf_counter() - start_time,
+                          buffer, nick, should_be_sent, reason)
+    return should_be_sent
+
+
+def notification_decision(buffer, tags, nick, is_displayed, is_highlight, message):
+    """Decides whether a notification should be sent.
+
+    Returns a pair (should_be_sent, reason), where reason is a short
+    description of the check that decided the outcome.
+    """
+    should_be_sent, reason = notification_decision_disregarding_time(
+        buffer, tags, nick, is_displayed, is_highlight, message
+    )
+    if SHADOW_PROFILE is not None and SHADOW_PROFILE.should_evaluate(time.time()):
+        shadow_notification_decision(buffer, tags, nick, is_displayed,
+                                     is_highlight, message, (should_be_sent, reason))
+    if should_be_sent:
+        if AWAY_DIGEST is not None and is_away(buffer):
+            add_to_away_digest(buffer, nick, message)
+            return False, 'away_digest'
         # The following function should be called only when the notification
         # should be sent (it updates the last notification time).
-        if not is_below_min_notification_delay(buffer):
-            return True
-    return False
+        if is_below_min_notification_delay(buffer):
+            return False, 'min_notification_delay'
+    return should_be_sent, reason
+
+
+def shadow_notification_decision(buffer, tags, nick, is_displayed, is_highlight,
+                                 message, decision):
+    """Decides whether a notification would be sent with the shadow profile
+    and records the difference from the given decision of the options.
+
+    Nothing is sent and no state is updated.
+    """
+    shadow_decision = notification_decision_disregarding_time(
+        buffer, tags, nick, is_displayed, is_highlight, message, SHADOW_PROFILE.config
+    )
+    SHADOW_PROFILE.record(weechat.buffer_get_string(buffer, 'full_name'),
+                          nick, message, decision, shadow_decision)
 
 
 def notification_should_be_sent_disregarding_time(buffer, tags, nick,
                                                   is_displayed, is_highlight, message):
     """Should a notification be sent when not considering time?"""
+    should_be_sent, _ = notification_decision_disregarding_time(
+        buffer, tags, nick, is_displayed, is_highlight, message
+    )
+    return should_be_sent
+
+
+def notification_decision_disregarding_time(buffer, tags, nick, is_displayed,
+                                            is_highlight, message, config=None):
+    """Decides whether a notification should be sent when not considering
+    time.
+
+    Returns a pair (should_be_sent, reason) like notification_decision().
+    When config (a ShadowConfig) is given, the decision is made with it
+    instead of with the options, and no state is updated.
+    """
+    global RULE_URGENCY, MATCHED_KEYWORD
+    if config is None:
+        MATCHED_KEYWORD = ''
+        rules = NOTIFICATION_RULES
+        suppress_while_typing = SUPPRESS_WHILE_TYPING
+        away_digest = AWAY_DIGEST is not None
+    else:
+        rules = config.rules
+        suppress_while_typing = config.suppress_while_typing
+        away_digest = config.away_digest
+
     if not nick:
         # A nick is required to form a correct notification source/message.
-        return False
+        return False, 'no nick'
 
     if i_am_author_of_message(buffer, nick):
-        return False
+        return False, 'own message'
+
+    # Focus reporting is on whenever notify_only_when_terminal_unfocused is on
+    # (see apply_focus_config()), so the option is looked up only then.
+    if (FOCUS_REPORTING and TERMINAL_FOCUSED and
+            notify_only_when_terminal_unfocused(config)):
+        return False, 'notify_only_when_terminal_unfocused'
+
+    if suppress_while_typing and user_is_typing(suppress_while_typing):
+        return False, 'suppress_while_typing'
+
+    if rules is not None:
+        rule = rules.match(buffer, tags, nick, is_highlight, message)
+        if config is None:
+            RULE_URGENCY = rule.urgency if rule is not None else ''
+        if rule is not None:
+            return rule.notify, rule.name
 
     if not is_displayed:
-        if not notify_on_filtered_messages():
-            return False
+        if not notify_on_filtered_messages(config):
+            return False, 'notify_on_filtered_messages'
 
     if is_away(buffer):
-        if not notify_when_away():
-            return False
+        if not notify_when_away(config) and not away_digest:
+            return False, 'notify_when_away'
 
-    if ignore_notifications_from_messages_tagged_with(tags):
-        return False
+    if ignore_notifications_from_messages_tagged_with(tags, config):
+        return False, 'ignore_messages_tagged_with'
 
-    if ignore_notifications_from_nick(nick):
-        return False
+    if ignore_notifications_from_nick(nick, config):
+        return False, 'ignore_nicks'
 
-    if ignore_notifications_from_buffer(buffer):
-        return False
+    if ignore_notifications_from_buffer(buffer, config):
+        return False, 'ignore_buffers'
 
-    if buffer == weechat.current_buffer():
-        if not notify_for_current_buffer():
-            return False
-        elif notify_on_all_messages_in_current_buffer():
-            return True
+    if buffer == current_buffer():
+        if not notify_for_current_buffer(config):
+            # When the terminal is not focused, the user cannot see the
+            # buffer, so treat it like any other buffer.
+            if TERMINAL_FOCUSED:
+                return False, 'notify_for_current_buffer'
+        elif notify_on_all_messages_in_current_buffer(config):
+            return True, 'notify_on_all_messages_in_current_buffer'
 
     if is_private_message(buffer):
-        return notify_on_private_messages()
+        return notify_on_private_messages(config), 'notify_on_privmsgs'
 
     if is_highlight:
-        return notify_on_highlights()
+        return notify_on_highlights(config), 'notify_on_highlights'
 
-    if notify_on_messages_that_match(message):
-        return True
+    match = notify_on_messages_that_match(message, config)
+    if match:
+        if config is None:
+            MATCHED_KEYWORD = match.group(0)
+        return True, 'notify_on_messages_that_match'
 
-    if notify_on_all_messages_in_buffer(buffer):
-        return True
+    if notify_on_all_messages_in_buffer(buffer, config):
+        return True, 'notify_on_all_messages_in_buffers'
 
-    return False
+    return False, 'no matching option'
 
 
 def is_below_min_notification_delay(buffer):
     """Is a notification in the given buffer below the minimal delay between
     successive notifications from the same buffer?
 
-    When called, this function updates the time of the last notification.
+    When called, this function updates the time of the last notification
+    (with an adaptive delay, only when the notification is not below it).
     """
-    # We store the time of the last notification in a buffer-local variable to
-    # make it persistent over the lifetime of this script.
-    LAST_NOTIFICATION_TIME_VAR = 'notify_send_last_notification_time'
     last_notification_time = buffer_get_float(
         buffer,
         'localvar_' + LAST_NOTIFICATION_TIME_VAR
     )
 
-    min_notification_delay = weechat.config_get_plugin('min_notification_delay')
-    # min_notification_delay is in milliseconds (str). To compare it with
-    # last_notification_time (float in seconds), we have to convert it to
-    # seconds (float).
-    min_notification_delay = float(min_notification_delay) / 1000
+    min_notification_delay, max_notification_delay = notification_delay_limits(buffer)
 
     current_time = time.time()
 
+    if max_notification_delay > min_notification_delay > 0:
+        return is_below_adaptive_notification_delay(
+            buffer,
+            current_time,
+            last_notification_time,
+            min_notification_delay,
+            max_notification_delay
+        )
+
     # We have to update the last notification time before returning the result.
     buffer_set_float(
         buffer,
@@ -381,6 +1463,110 @@ def is_below_min_notification_delay(buffer):
             current_time - last_notification_time < min_notification_delay)
 
 
+def is_below_adaptive_notification_delay(buffer, current_time,
+                                         last_notification_time,
+                                         min_notification_delay,
+                                         max_notification_delay):
+    """Is a notification in the given buffer below the current delay between
+    notifications from the buffer (see max_notification_delay)?
+
+    Unlike with a fixed delay, the time of the last notification is updated
+    only when the notification is not below the delay, so a flooding buffer
+    still gets a notification once in a while.
+    """
+    notification_delay = current_notification_delay(
+        buffer,
+        min_notification_delay,
+        max_notification_delay
+    )
+    elapsed_time = current_time - last_notification_time
+    if elapsed_time < notification_delay:
+        return True
+
+    buffer_set_float(
+        buffer,
+        'localvar_set_' + NOTIFICATION_DELAY_VAR,
+        next_notification_delay(
+            notification_delay,
+            elapsed_time,
+            min_notification_delay,
+            max_notification_delay
+        )
+    )
+    buffer_set_float(
+        buffer,
+        'localvar_set_' + LAST_NOTIFICATION_TIME_VAR,
+        current_time
+    )
+    return False
+
+
+def next_notification_delay(notification_delay, elapsed_time,
+                            min_notification_delay, max_notification_delay):
+    """Returns the delay (in seconds) after a notification that came the given
+    time after the previous one.
+
+    When notifications keep coming (the notification came before twice the
+    delay passed), the delay doubles. Otherwise, it halves for every period
+    of the length of the delay during which the buffer was quiet.
+    """
+    if elapsed_time < 2 * notification_delay:
+        return min(2 * notification_delay, max_notification_delay)
+    quiet_periods = int(elapsed_time / notification_delay) - 1
+    return max(notification_delay * 0.5 ** quiet_periods, min_notification_delay)
+
+
+def current_notification_delay(buffer, min_notification_delay,
+                               max_notification_delay):
+    """Returns the current delay (in seconds) between notifications from the
+    given buffer."""
+    notification_delay = buffer_get_float(buffer, 'localvar_' + NOTIFICATION_DELAY_VAR)
+    return min(max(notification_delay, min_notification_delay),
+               max_notification_delay)
+
+
+def notification_delay_limits(buffer):
+    """Returns a pair (minimal delay, maximal delay) between successive
+    notifications from the given buffer (in seconds)."""
+    # Both options are in milliseconds (str). To compare them with times
+    # (float in seconds), we have to convert them to seconds (float).
+    return (float(buffer_option(buffer, 'min_notification_delay')) / 1000,
+            float(buffer_option(buffer, 'max_notification_delay')) / 1000)
+
+
+def buffer_option(buffer, option):
+    """Returns the value of the given option for the given buffer.
+
+    It is either the value of the most specific override for the buffer (see
+    BUFFER_OPTIONS) or the value of the option.
+    """
+    if BUFFER_OVERRIDES:
+        policy = BUFFER_POLICIES.get(buffer)
+        if policy is None:
+            policy = BUFFER_POLICIES[buffer] = buffer_policy(buffer)
+        value = policy.get(option)
+        if value is not None:
+            return value
+    return weechat.config_get_plugin(option)
+
+
+def buffer_policy(buffer):
+    """Returns a dictionary mapping options to their overridden values for the
+    given buffer.
+    """
+    policy = {}
+    buffer_names = names_for_buffer(buffer)
+    for option, mask, value in BUFFER_OVERRIDES:
+        if option in policy:
+            # A more specific override has already been applied.
+            continue
+        for buffer_name in buffer_names:
+            if weechat.string_match(buffer_name, mask, 0):
+                policy[option] = value
+                break
+    return policy
+
+
 def buffer_get_float(buffer, property):
     """A variant of weechat.buffer_get_x() for floats.
 
@@ -429,34 +1615,46 @@ def names_for_buffer(buffer):
     return buffer_names
 
 
-def notify_for_current_buffer():
+def notify_for_current_buffer(config=None):
     """Should we also send notifications for the current buffer?"""
-    return weechat.config_get_plugin('notify_for_current_buffer') == 'on'
+    return (config or weechat).config_get_plugin('notify_for_current_buffer') == 'on'
+
+
+def notify_only_when_terminal_unfocused(config=None):
+    """Should we send notifications only when the terminal is not focused?"""
+    return (config or weechat).config_get_plugin('notify_only_when_terminal_unfocused') == 'on'
+
+
+def current_buffer():
+    """Returns the currently active buffer."""
+    if CURRENT_BUFFER is None:
+        return weechat.current_buffer()
+    return CURRENT_BUFFER
 
 
-def notify_on_all_messages_in_current_buffer():
+def notify_on_all_messages_in_current_buffer(config=None):
     """Should we send a notication on all messages in the current buffer?"""
-    return weechat.config_get_plugin('notify_on_all_messages_in_current_buffer') == 'on'
+    return (config or weechat).config_get_plugin('notify_on_all_messages_in_current_buffer') == 'on'
 
 
-def notify_on_highlights():
+def notify_on_highlights(config=None):
     """Should we send notifications on highlights?"""
-    return weechat.config_get_plugin('notify_on_highlights') == 'on'
+    return (config or weechat).config_get_plugin('notify_on_highlights') == 'on'
 
 
-def notify_on_private_messages():
+def notify_on_private_messages(config=None):
     """Should we send notifications on private messages?"""
-    return weechat.config_get_plugin('notify_on_privmsgs') == 'on'
+    return (config or weechat).config_get_plugin('notify_on_privmsgs') == 'on'
 
 
-def notify_on_filtered_messages():
+def notify_on_filtered_messages(config=None):
     """Should we also send notifications for filtered (hidden) messages?"""
-    return weechat.config_get_plugin('notify_on_filtered_messages') == 'on'
+    return (config or weechat).config_get_plugin('notify_on_filtered_messages') == 'on'
 
 
-def notify_when_away():
+def notify_when_away(config=None):
     """Should we also send notifications when away?"""
-    return weechat.config_get_plugin('notify_when_away') == 'on'
+    return (config or weechat).config_get_plugin('notify_when_away') == 'on'
 
 
 def is_away(buffer):
@@ -474,11 +1672,13 @@ def i_am_author_of_message(buffer, nick):
     return weechat.buffer_get_string(buffer, 'localvar_nick') == nick
 
 
-def split_option_value(option, separator=','):
+def split_option_value(option, separator=',', config=None):
     """Splits the value of the given plugin option by the given separator and
     returns the result in a list.
+
+    The value is looked up in config (a ShadowConfig) when it is given.
     """
-    values = weechat.config_get_plugin(option)
+    values = (config or weechat).config_get_plugin(option)
     if not values:
         # When there are no values, return the empty list instead of [''].
         return []
@@ -486,11 +1686,11 @@ def split_option_value(option, separator=','):
     return [value.strip() for value in values.split(separator)]
 
 
-def ignore_notifications_from_messages_tagged_with(tags):
+def ignore_notifications_from_messages_tagged_with(tags, config=None):
     """Should notifications be ignored for a message tagged with the given
     tags?
     """
-    ignored_tags = split_option_value('ignore_messages_tagged_with')
+    ignored_tags = split_option_value('ignore_messages_tagged_with', config=config)
     for ignored_tag in ignored_tags:
         for tag in tags:
             if tag == ignored_tag:
@@ -498,104 +1698,137 @@ def ignore_notifications_from_messages_tagged_with(tags):
     return False
 
 
-def ignore_notifications_from_buffer(buffer):
+def ignore_notifications_from_buffer(buffer, config=None):
     """Should notifications from the given buffer be ignored?"""
     buffer_names = names_for_buffer(buffer)
 
     for buffer_name in buffer_names:
-        if buffer_name and buffer_name in ignored_buffers():
+        if buffer_name and buffer_name in ignored_buffers(config):
             return True
 
     for buffer_name in buffer_names:
-        for prefix in ignored_buffer_prefixes():
+        for prefix in ignored_buffer_prefixes(config):
             if prefix and buffer_name.startswith(prefix):
                 return True
 
     return False
 
 
-def ignored_buffers():
+def ignored_buffers(config=None):
     """A generator of buffers from which notifications should be ignored."""
-    for buffer in split_option_value('ignore_buffers'):
+    for buffer in split_option_value('ignore_buffers', config=config):
         yield buffer
 
 
-def ignored_buffer_prefixes():
+def ignored_buffer_prefixes(config=None):
     """A generator of buffer prefixes from which notifications should be
     ignored.
     """
-    for prefix in split_option_value('ignore_buffers_starting_with'):
+    for prefix in split_option_value('ignore_buffers_starting_with', config=config):
         yield prefix
 
 
-def ignore_notifications_from_nick(nick):
+def ignore_notifications_from_nick(nick, config=None):
     """Should notifications from the given nick be ignored?"""
-    if nick in ignored_nicks():
+    if nick in ignored_nicks(config):
         return True
 
-    for prefix in ignored_nick_prefixes():
+    for prefix in ignored_nick_prefixes(config):
         if prefix and nick.startswith(prefix):
             return True
 
     return False
 
 
-def ignored_nicks():
+def ignored_nicks(config=None):
     """A generator of nicks from which notifications should be ignored."""
-    for nick in split_option_value('ignore_nicks'):
+    for nick in split_option_value('ignore_nicks', config=config):
         yield nick
 
 
-def ignored_nick_prefixes():
+def ignored_nick_prefixes(config=None):
     """A generator of nick prefixes from which notifications should be
     ignored.
     """
-    for prefix in split_option_value('ignore_nicks_starting_with'):
+    for prefix in split_option_value('ignore_nicks_starting_with', config=config):
         yield prefix
 
 
-def notify_on_messages_that_match(message):
+def notify_on_messages_that_match(message, config=None):
     """Should we send a notification for the given message, provided it matches
     any of the requested patterns?
+
+    Returns the match of the first matching pattern (None when there is none).
     """
-    message_patterns = split_option_value('notify_on_messages_that_match')
+    message_patterns = split_option_value('notify_on_messages_that_match', config=config)
     for pattern in message_patterns:
-        if re.search(pattern, message):
-            return True
+        match = pattern_search(pattern, message)
+        if match:
+            return match
 
-    return False
+    return None
+
+
+def pattern_search(pattern, text):
+    """A variant of re.search() for regular expressions from the options.
+
+    When regex_time_budget is set, a regular expression that takes longer to
+    match is disabled (it no longer matches anything), so that it cannot keep
+    blocking WeeChat.
+    """
+    if not REGEX_TIME_BUDGET:
+        return re.search(pattern, text)
 
+    if pattern in SLOW_PATTERNS:
+        return None
+    start_time = time.perf_counter()
+    match = re.search(pattern, text)
+    duration = time.perf_counter() - start_time
+    if duration > REGEX_TIME_BUDGET:
+        SLOW_PATTERNS.add(pattern)
+        print_error('regular expression {} took {:.1f} ms (over regex_time_budget), so '
+                    'it has been disabled (see /notify_send lint)'.format(
+                        pattern_text(pattern), duration * 1000))
+    return match
 
-def buffers_to_notify_on_all_messages():
+
+def pattern_text(pattern):
+    """Returns the text of the given (possibly compiled) regular expression."""
+    return getattr(pattern, 'pattern', pattern)
+
+
+def buffers_to_notify_on_all_messages(config=None):
     """A generator of buffer names in which the user wants to be notified for
     all messages.
     """
-    for buffer in split_option_value('notify_on_all_messages_in_buffers'):
+    for buffer in split_option_value('notify_on_all_messages_in_buffers', config=config):
         yield buffer
 
 
-def buffer_patterns_to_notify_on_all_messages():
+def buffer_patterns_to_notify_on_all_messages(config=None):
     """A generator of buffer-name patterns in which the user wants to be
     notifier for all messages.
     """
-    for pattern in split_option_value('notify_on_all_messages_in_buffers_that_match'):
+    patterns = split_option_value('notify_on_all_messages_in_buffers_that_match',
+                                  config=config)
+    for pattern in patterns:
         yield pattern
 
 
-def notify_on_all_messages_in_buffer(buffer):
+def notify_on_all_messages_in_buffer(buffer, config=None):
     """Does the user want to be notified for all messages in the given buffer?
     """
     buffer_names = names_for_buffer(buffer)
 
     # Option notify_on_all_messages_in_buffers:
-    for buf in buffers_to_notify_on_all_messages():
+    for buf in buffers_to_notify_on_all_messages(config):
         if buf in buffer_names:
             return True
 
     # Option notify_on_all_messages_in_buffers_that_match:
-    for pattern in buffer_patterns_to_notify_on_all_messages():
+    for pattern in buffer_patterns_to_notify_on_all_messages(config):
         for buf in buffer_names:
-            if re.search(pattern, buf):
+            if pattern_search(pattern, buf):
                 return True
 
     return False
@@ -615,7 +1848,7 @@ def hide_message_in_buffer(buffer):
 
     for pattern in buffer_patterns_to_hide_messages():
         for buf in buffer_names:
-            if re.search(pattern, buf):
+            if pattern_search(pattern, buf):
                 return True
 
     return False
@@ -633,33 +1866,54 @@ def auto_close_prior_notification_for_buffer(buffer):
     return weechat.config_get_plugin('auto_close_prior_buffer_notification') == 'on'
 
 
-def prepare_notification(buffer, nick, message):
-    """Prepares a notification from the given data."""
-    if is_private_message(buffer):
-        source = nick
-    else:
-        source = (weechat.buffer_get_string(buffer, 'short_name') or
-                  weechat.buffer_get_string(buffer, 'name'))
-        message = nick + nick_separator() + message
-
-    if hide_message_in_buffer(buffer):
-        message = ''
+def prepare_notification(buffer, nick, message, date=None):
+    """Prepares a notification from the given data.
 
-    max_length = int(weechat.config_get_plugin('max_length'))
+    The date of the message is in seconds since the epoch (a number, or a
+    string like in print hooks). When it is None, the message is from now.
+    """
+    max_length = int(buffer_option(buffer, 'max_length'))
     if max_length > 0:
-        ellipsis = weechat.config_get_plugin('ellipsis')
-        message = shorten_message(message, max_length, ellipsis)
+        # Only the beginning of a long message can end up in the notification,
+        # so do not even copy the rest (see format_message()).
+        message = message[:message_window(max_length) + 1]
 
-    if weechat.config_get_plugin('escape_html') == 'on':
-        message = escape_html(message)
+    is_hidden = hide_message_in_buffer(buffer)
+    if is_hidden:
+        message = ''
 
-    message = escape_slashes(message)
+    ellipsis = buffer_option(buffer, 'ellipsis') if max_length > 0 else ''
+    if SUMMARY_TEMPLATE is not None:
+        source = shorten_message(
+            SUMMARY_TEMPLATE.render(buffer, nick, message, date),
+            max_length,
+            ellipsis
+        )
+    elif is_private_message(buffer):
+        source = nick
+    else:
+        source = buffer_short_name(buffer)
+
+    if not is_hidden:
+        if BODY_TEMPLATE is not None:
+            message = BODY_TEMPLATE.render(buffer, nick, message, date)
+        elif not is_private_message(buffer):
+            message = nick + nick_separator() + message
+
+    message = format_message(
+        message,
+        max_length,
+        ellipsis,
+        weechat.config_get_plugin('escape_html') == 'on'
+    )
 
-    icon = weechat.config_get_plugin('icon')
+    icon = buffer_option(buffer, 'icon')
+    if ICON_DIRS:
+        icon = icon_for(buffer, nick) or icon
     desktop_entry = weechat.config_get_plugin('desktop_entry')
-    timeout = weechat.config_get_plugin('timeout')
-    transient = should_notifications_be_transient()
-    urgency = weechat.config_get_plugin('urgency')
+    timeout = buffer_option(buffer, 'timeout')
+    transient = buffer_option(buffer, 'transient') == 'on'
+    urgency = buffer_option(buffer, 'urgency')
 
     if replace_notification_for_buffer(buffer):
         replace_id = buffer_get_notification_id(buffer)
@@ -671,6 +1925,94 @@ def prepare_notification(buffer, nick, message):
                         desktop_entry, timeout, transient, urgency, replace_id)
 
 
+def icon_for(buffer, nick):
+    """Returns the path to the icon from icon_dirs for a message from the
+    given nick in the given buffer, or the empty string when there is none.
+
+    Private messages get the avatar of the nick (or the icon of the network
+    when there is no avatar), other messages the icon of the network.
+    """
+    global ICON_DIRS_CHECKED
+    current_time = time.time()
+    if current_time - ICON_DIRS_CHECKED >= ICON_DIRS_CHECK_INTERVAL:
+        ICON_DIRS_CHECKED = current_time
+        forget_changed_icon_dirs()
+
+    server = (weechat.buffer_get_string(buffer, 'localvar_server') or
+              weechat.buffer_get_string(buffer, 'localvar_plugin'))
+    if not is_private_message(buffer):
+        nick = ''
+    key = (server, nick)
+    icon = ICON_CACHE.get(key)
+    if icon is None:
+        icon = ICON_CACHE[key] = resolve_icon(server, nick)
+    return icon
+
+
+def resolve_icon(server, nick):
+    """Finds the icon for the given server and nick in icon_dirs.
+
+    Returns the path to the icon, or the empty string when there is none.
+    """
+    if not is_safe_file_name(server):
+        return ''
+
+    candidates = []
+    if is_safe_file_name(nick):
+        candidates.append((server, nick))
+    candidates.append(('', server))
+    for subdir, name in candidates:
+        for icon_dir in ICON_DIRS:
+            path = os.path.join(icon_dir, subdir) if subdir else icon_dir
+            names = icon_dir_listing(path)
+            for extension in ICON_EXTENSIONS:
+                if name + extension in names:
+                    return os.path.join(path, name + extension)
+    return ''
+
+
+def is_safe_file_name(name):
+    """Can the given name (e.g. a nick) be used as a name of a file in a
+    directory with icons?
+
+    The name must not contain a path separator (also the alternative one, like
+    / on Windows) or '..', and it must not be hidden.
+    """
+    return (bool(name) and not name.startswith('.') and '..' not in name and
+            os.sep not in name and not (os.altsep and os.altsep in name))
+
+
+def icon_dir_listing(path):
+    """Returns a set of names of files in the given directory.
+
+    The listing is cached, so every directory is listed only once (until it
+    changes).
+    """
+    listing = ICON_DIR_LISTINGS.get(path)
+    if listing is None:
+        try:
+            listing = (os.stat(path).st_mtime, frozenset(os.listdir(path)))
+        except OSError:
+            listing = (None, frozenset())
+        ICON_DIR_LISTINGS[path] = listing
+    return listing[1]
+
+
+def forget_changed_icon_dirs():
+    """Forgets resolved icons when any of the listed directories has
+    changed (its modification time differs from the one when it was listed).
+    """
+    for path, (mtime, _) in ICON_DIR_LISTINGS.items():
+        try:
+            current_mtime = os.stat(path).st_mtime
+        except OSError:
+            current_mtime = None
+        if current_mtime != mtime:
+            ICON_DIR_LISTINGS.clear()
+            ICON_CACHE.clear()
+            return
+
+
 def should_notifications_be_transient():
     """Should the sent notifications be transient, i.e. should they be removed
     from the notification bar once they expire or are dismissed?
@@ -684,12 +2026,97 @@ def nick_separator():
     return separator if separator else default_value_of('nick_separator')
 
 
-def shorten_message(message, max_length, ellipsis):
-    """Shortens the message to at most max_length characters by using the given
-    ellipsis.
+def buffer_short_name(buffer):
+    """Returns the short name of the given buffer (or its name when it has
+    no short name).
     """
-    if max_length <= 0 or len(message) <= max_length:
-        # Nothing to shorten.
+    return (weechat.buffer_get_string(buffer, 'short_name') or
+            weechat.buffer_get_string(buffer, 'name'))
+
+
+def buffer_server(buffer, nick, message, date):
+    """Returns the server of the given buffer for ${server} in templates."""
+    return weechat.buffer_get_string(buffer, 'localvar_server')
+
+
+def message_time(buffer, nick, message, date):
+    """Returns the local time of the message for ${time} in templates."""
+    if date is None:
+        date = time.time()
+    return time.strftime('%H:%M', time.localtime(float(date)))
+
+
+# Fields of notification templates, mapped to functions that compute their
+# values from a message (buffer, nick, message, date).
+TEMPLATE_FIELDS = {
+    'nick': lambda buffer, nick, message, date: nick,
+    'buffer': lambda buffer, nick, message, date: buffer_short_name(buffer),
+    'server': buffer_server,
+    'message': lambda buffer, nick, message, date: message,
+    'time': message_time,
+    'matched_keyword': lambda buffer, nick, message, date: MATCHED_KEYWORD,
+}
+
+
+def parse_template(text):
+    """Parses a notification template with ${field} placeholders ($$ is a
+    literal $) into a NotificationTemplate.
+
+    Raises ValueError when the template is invalid.
+    """
+    pieces = []
+    literal = ''
+    position = 0
+    for match in string.Template.pattern.finditer(text):
+        literal += text[position:match.start()]
+        position = match.end()
+        if match.group('escaped') is not None:
+            literal += '$'
+            continue
+        field = match.group('named') or match.group('braced')
+        if field is None:
+            raise ValueError('invalid placeholder at position {}'.format(match.start()))
+        if field not in TEMPLATE_FIELDS:
+            raise ValueError('unknown field: {}'.format(field))
+        if literal:
+            pieces.append(literal)
+            literal = ''
+        pieces.append(TEMPLATE_FIELDS[field])
+    literal += text[position:]
+    if literal:
+        pieces.append(literal)
+    return NotificationTemplate(pieces)
+
+
+def apply_templates_config():
+    """Parses the templates of notifications (summary_template and
+    body_template).
+    """
+    global SUMMARY_TEMPLATE, BODY_TEMPLATE
+    SUMMARY_TEMPLATE = template_option('summary_template')
+    BODY_TEMPLATE = template_option('body_template')
+
+
+def template_option(option):
+    """Returns the template from the given option, or None when the option is
+    empty or the template is invalid.
+    """
+    text = weechat.config_get_plugin(option)
+    if not text:
+        return None
+    try:
+        return parse_template(text)
+    except ValueError as ex:
+        print_error('invalid {}: {}'.format(option, ex))
+        return None
+
+
+def shorten_message(message, max_length, ellipsis):
+    """Shortens the message to at most max_length characters by using the given
+    ellipsis.
+    """
+    if max_length <= 0 or len(message) <= max_length:
+        # Nothing to shorten.
         return message
 
     if len(ellipsis) >= max_length:
@@ -699,14 +2126,98 @@ def shorten_message(message, max_length, ellipsis):
     return message[:max_length - len(ellipsis)] + ellipsis
 
 
+# Only the following characters need to be escaped
+# (https://wiki.ubuntu.com/NotificationDevelopmentGuidelines).
+HTML_ESCAPES = {
+    ord('&'): '&amp;',
+    ord('<'): '&lt;',
+    ord('>'): '&gt;',
+}
+
+# Length of the longest escaped HTML character.
+MAX_HTML_ESCAPE_LENGTH = max(len(escape) for escape in HTML_ESCAPES.values())
+
+# A translation table that removes control characters (except for tabs and
+# newlines) and escapes backslashes (see escape_slashes()).
+MESSAGE_ESCAPES = dict.fromkeys(
+    [c for c in range(0x20) if chr(c) not in '\t\n'] + [0x7f]
+)
+MESSAGE_ESCAPES[ord('\\')] = '\\\\'
+
+# The same as MESSAGE_ESCAPES, but also escapes HTML characters.
+MESSAGE_HTML_ESCAPES = dict(MESSAGE_ESCAPES)
+MESSAGE_HTML_ESCAPES.update(HTML_ESCAPES)
+
+# Number of characters looked at past max_length, so that removed control
+# characters do not make the message shorter than needed.
+MESSAGE_WINDOW_MARGIN = 64
+
+
+def message_window(max_length):
+    """Returns the number of characters of a message that are looked at when
+    shortening it to max_length characters.
+    """
+    return max_length + MESSAGE_WINDOW_MARGIN
+
+
+def format_message(message, max_length, ellipsis, html):
+    """Returns the message for a notification.
+
+    Control characters are removed, backslashes are escaped, HTML characters
+    are escaped when html is True, and the result is shortened to at most
+    max_length characters (0 means no limit) by using the given ellipsis. An
+    escape sequence is never cut in half.
+
+    When the message is shortened, only its first characters are looked at
+    (see message_window()), so the cost does not depend on its length.
+    """
+    table = MESSAGE_HTML_ESCAPES if html else MESSAGE_ESCAPES
+    if max_length <= 0:
+        return message.translate(table)
+
+    window = message_window(max_length)
+    text = message[:window].translate(table)
+    if len(text) <= max_length and len(message) <= window:
+        # Nothing to shorten.
+        return text
+
+    ellipsis = ellipsis.translate(table)
+    if len(ellipsis) >= max_length:
+        # We cannot include any part of the message.
+        return cut_escaped_text(ellipsis, max_length, html)
+
+    return cut_escaped_text(text, max_length - len(ellipsis), html) + ellipsis
+
+
+def cut_escaped_text(text, length, html):
+    """Cuts the given text escaped by format_message() to at most the given
+    length without leaving a part of an escape sequence at its end.
+    """
+    text = text[:length]
+
+    # Escaped backslashes come in pairs, so an odd number of trailing
+    # backslashes means that the last pair has been cut in half.
+    trailing_backslashes = len(text) - len(text.rstrip('\\'))
+    if trailing_backslashes % 2:
+        return text[:-1]
+
+    # With escaped HTML characters, every '&' starts an escape sequence, which
+    # is complete only when it ends with ';'.
+    if html:
+        amp = text.rfind('&', max(len(text) - MAX_HTML_ESCAPE_LENGTH + 1, 0))
+        if amp != -1 and ';' not in text[amp:]:
+            return text[:amp]
+
+    # Do not leave a high surrogate without its low surrogate.
+    if text and '\ud800' <= text[-1] <= '\udbff':
+        return text[:-1]
+
+    return text
+
+
 def escape_html(message):
     """Escapes HTML characters in the given message."""
-    # Only the following characters need to be escaped
-    # (https://wiki.ubuntu.com/NotificationDevelopmentGuidelines).
-    message = message.replace('&', '&amp;')
-    message = message.replace('<', '&lt;')
-    message = message.replace('>', '&gt;')
-    return message
+    return message.translate(HTML_ESCAPES)
 
 
 def escape_slashes(message):
@@ -717,47 +2228,114 @@ def escape_slashes(message):
     return message.replace('\\', r'\\')
 
 
-def send_notification(buffer, notification):
-    """Sends the given notification to the user."""
-    notify_cmd = ['notify-send', '--print-id', '--app-name', 'weechat']
-    if notification.icon:
-        notify_cmd += ['--icon', notification.icon]
-    if notification.desktop_entry:
-        notify_cmd += ['--hint', 'string:desktop-entry:{}'.format(notification.desktop_entry)]
-    if notification.timeout:
-        notify_cmd += ['--expire-time', str(notification.timeout)]
-    if notification.transient:
-        notify_cmd += ['--hint', 'int:transient:1']
-    if notification.urgency:
-        notify_cmd += ['--urgency', notification.urgency]
-    if notification.replace_id != '0':
-        notify_cmd += ['--replace-id', notification.replace_id]
-    # The "im.received" category means "A received instant message
-    # notification".
-    notify_cmd += ['--category', 'im.received']
+def notify_command():
+    """Returns a pair (command, arguments) for sending notifications.
+
+    The command is a list of the program and extra arguments from the
+    configuration. The arguments are taken from COMMAND_ARGUMENTS based on the
+    program name (unknown programs are assumed to accept the arguments of
+    notify-send).
+    """
+    try:
+        command = shlex.split(weechat.config_get_plugin('command'))
+    except ValueError:
+        # E.g. "No closing quotation".
+        command = []
+    if not command:
+        command = [default_value_of('command')]
+    program = os.path.basename(command[0])
+    arguments = COMMAND_ARGUMENTS.get(program, COMMAND_ARGUMENTS['notify-send'])
+    return command, arguments
+
+
+def build_notify_cmd_parts(icon, desktop_entry, timeout, transient, urgency):
+    """Builds the parts of a command for sending notifications that come before
+    and after the replace ID.
+
+    Returns a tuple (head, replace_id_argument, tail).
+    """
+    command, arguments = notify_command()
+    head = command + arguments['print_id'] + [arguments['app_name'], 'weechat']
+    if icon:
+        head += [arguments['icon'], icon]
+    if desktop_entry:
+        head += [arguments['hint'], 'string:desktop-entry:{}'.format(desktop_entry)]
+    if timeout:
+        head += [arguments['timeout'], str(timeout)]
+    if transient:
+        head += [arguments['hint'], 'int:transient:1']
+    if urgency:
+        head += [arguments['urgency'], urgency]
     # We need to add '--' before the source and message to ensure that
     # notify-send considers the remaining parameters as the source and the
     # message. This prevents errors when a source or message starts with '--'.
-    notify_cmd += [
-        '--',
-        # notify-send fails with "No summary specified." when no source is
-        # specified, so ensure that there is always a non-empty source.
-        notification.source or '-',
-        notification.message
-    ]
+    tail = arguments['category'] + ['--']
+    return head, arguments['replace_id'], tail
+
+
+def notify_cmd_parts(notification):
+    """Returns the parts of a command for sending the given notification that
+    depend only on the configuration.
+
+    The parts are built only once per combination of their inputs and
+    configuration, so sending a notification only needs to add the replace ID,
+    source, and message.
+    """
+    key = (notification.icon, notification.desktop_entry, notification.timeout,
+           notification.transient, notification.urgency)
+    parts = NOTIFY_CMD_PARTS.get(key)
+    if parts is None:
+        parts = NOTIFY_CMD_PARTS[key] = build_notify_cmd_parts(*key)
+        if len(NOTIFY_CMD_PARTS) > NOTIFY_CMD_PARTS_SIZE:
+            NOTIFY_CMD_PARTS.popitem(last=False)
+    else:
+        NOTIFY_CMD_PARTS.move_to_end(key)
+    return parts
+
+
+def notifications_have_actions():
+    """Should notifications have actions?"""
+    return weechat.config_get_plugin('actions') == 'on'
+
+
+def send_notification(buffer, notification):
+    """Sends the given notification to the user.
+
+    Returns the ID of the sent notification, or '0' when it is unknown.
+    """
+    actions = notifications_have_actions()
+    if actions:
+        notify_cmd = dbus_notify_cmd(notification)
+    else:
+        head, replace_id_argument, tail = notify_cmd_parts(notification)
+        if notification.replace_id != '0':
+            head = head + [replace_id_argument, notification.replace_id]
+        notify_cmd = head + tail + [
+            # notify-send fails with "No summary specified." when no source is
+            # specified, so ensure that there is always a non-empty source.
+            notification.source or '-',
+            notification.message
+        ]
 
     try:
         output = subprocess.check_output(notify_cmd,
                                          stderr=subprocess.STDOUT,
                                          universal_newlines=True)
 
-        notification_id = output.strip('\n')
+        if actions:
+            notification_id = parse_dbus_notification_id(output)
+        else:
+            notification_id = output.strip('\n')
         try:
             _ = int(notification_id)
         except ValueError:
             notification_id = '0'
         if notification_id != notification.replace_id:
             buffer_set_notification_id(buffer, notification_id)
+        buffer_set_notification_expiration(buffer, notification.timeout)
+        if actions and notification_id != '0':
+            remember_action_notification(notification_id, buffer)
+        return notification_id
 
     except Exception as ex:
         error_message = '{} (reason: {!r}). {}'.format(
@@ -766,6 +2344,7 @@ def send_notification(buffer, notification):
             'Ensure that you have notify-send installed in your system.',
         )
         print(error_message, file=sys.stderr)
+        return '0'
 
 
 def close_notification(buffer):
@@ -776,22 +2355,1669 @@ def close_notification(buffer):
     if notification_id == '0':
         return
 
-    # Close the last notification by replacing it with a blank one that
-    # quickly times out.
-    notification = Notification(
-        source=' ',  # single space (not '')
-        message='',
+    if buffer_notification_has_expired(buffer):
+        # The notification is no longer visible.
+        pass
+    elif notifications_have_actions():
+        # Notifications have been sent via D-Bus, so they can be closed in the
+        # same way.
+        close_dbus_notification(notification_id)
+    else:
+        # Close the last notification by replacing it with a blank one that
+        # quickly times out.
+        notification = Notification(
+            source=' ',  # single space (not '')
+            message='',
+            icon=buffer_option(buffer, 'icon'),
+            desktop_entry=weechat.config_get_plugin('desktop_entry'),
+            timeout='5',  # 5ms
+            transient=buffer_option(buffer, 'transient') == 'on',
+            urgency=buffer_option(buffer, 'urgency'),
+            replace_id=notification_id,
+        )
+        send_notification(buffer, notification)
+
+    # Forget the closed notification, so that we do not try to close it again.
+    buffer_set_notification_id(buffer, '0')
+
+
+def gvariant_string(string):
+    """Returns the given string as a GVariant string literal (for gdbus).
+
+    Backslashes in the string are expected to be escaped already.
+    """
+    return "'" + string.replace("'", "\\'") + "'"
+
+
+def dbus_notify_cmd(notification):
+    """Returns a command that sends the given notification with actions via
+    D-Bus and prints its ID.
+    """
+    actions = []
+    for key, label in NOTIFICATION_ACTIONS:
+        actions += [key, label]
+    hints = ["'category': <'im.received'>"]
+    if notification.desktop_entry:
+        hints.append("'desktop-entry': <{}>".format(
+            gvariant_string(escape_slashes(notification.desktop_entry))
+        ))
+    if notification.transient:
+        hints.append("'transient': <true>")
+    if notification.urgency in URGENCY_LEVELS:
+        hints.append("'urgency': <byte {}>".format(
+            URGENCY_LEVELS[notification.urgency]
+        ))
+    try:
+        timeout = int(notification.timeout)
+    except ValueError:
+        # The default timeout of the notification daemon.
+        timeout = -1
+
+    return ['gdbus', 'call'] + DBUS_NOTIFICATIONS + [
+        '--method', 'org.freedesktop.Notifications.Notify',
+        '--',
+        gvariant_string('weechat'),
+        'uint32 {}'.format(int(notification.replace_id or 0)),
+        gvariant_string(escape_slashes(notification.icon)),
+        gvariant_string(escape_slashes(notification.source or '-')),
+        gvariant_string(notification.message),
+        '[{}]'.format(', '.join(gvariant_string(action) for action in actions)),
+        '{{{}}}'.format(', '.join(hints)),
+        'int32 {}'.format(timeout),
+    ]
+
+
+def parse_dbus_notification_id(output):
+    """Returns the notification ID from the output of gdbus (e.g.
+    "(uint32 42,)"), or '' when there is none.
+    """
+    match = re.search(r'\buint32 (\d+)', output)
+    return match.group(1) if match else ''
+
+
+def close_dbus_notification(notification_id):
+    """Closes the notification with the given ID via D-Bus."""
+    close_cmd = ['gdbus', 'call'] + DBUS_NOTIFICATIONS + [
+        '--method', 'org.freedesktop.Notifications.CloseNotification',
+        notification_id,
+    ]
+    try:
+        subprocess.check_output(close_cmd,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+    except Exception as ex:
+        print('Failed to close the notification via gdbus (reason: {!r}).'.format(
+            '{}: {}'.format(ex.__class__.__name__, ex)
+        ), file=sys.stderr)
+
+
+def remember_action_notification(notification_id, buffer):
+    """Remembers the buffer of the given notification with actions so that
+    its actions can be handled.
+    """
+    ACTION_NOTIFICATIONS.pop(notification_id, None)
+    if len(ACTION_NOTIFICATIONS) >= MAX_ACTION_NOTIFICATIONS:
+        # Forget the oldest notification.
+        del ACTION_NOTIFICATIONS[next(iter(ACTION_NOTIFICATIONS))]
+    ACTION_NOTIFICATIONS[notification_id] = weechat.buffer_get_string(buffer, 'full_name')
+    start_action_monitor()
+
+
+def start_action_monitor():
+    """Starts listening to signals of the notification daemon (unless it is
+    already being listened to).
+
+    A single process serves all notifications, and its output is handled by
+    action_monitor_callback() as it arrives, so WeeChat is never blocked.
+    """
+    global ACTION_MONITOR_HOOK, ACTION_MONITOR_OUTPUT
+    if ACTION_MONITOR_HOOK:
+        return
+    ACTION_MONITOR_OUTPUT = ''
+    ACTION_MONITOR_HOOK = weechat.hook_process_hashtable(
+        ' '.join(['gdbus', 'monitor'] + DBUS_NOTIFICATIONS),
+        {'buffer_flush': '1'},
+        0,
+        'action_monitor_callback',
+        ''
+    )
+
+
+def stop_action_monitor():
+    """Stops listening to signals of the notification daemon."""
+    global ACTION_MONITOR_HOOK
+    if ACTION_MONITOR_HOOK:
+        weechat.unhook(ACTION_MONITOR_HOOK)
+        ACTION_MONITOR_HOOK = ''
+    ACTION_NOTIFICATIONS.clear()
+
+
+# Signals of the notification daemon in the output of gdbus monitor, e.g.
+# "/org/freedesktop/Notifications: org.freedesktop.Notifications.ActionInvoked
+# (uint32 42, 'read')".
+DBUS_SIGNAL_RE = re.compile(
+    r"\.(ActionInvoked|NotificationClosed) \(uint32 (\d+), (?:'([^']*)'|uint32 \d+)\)"
+)
+
+
+def action_monitor_callback(data, command, return_code, out, err):
+    """A callback for output of the process that listens to signals of the
+    notification daemon.
+    """
+    global ACTION_MONITOR_HOOK, ACTION_MONITOR_OUTPUT
+    lines = (ACTION_MONITOR_OUTPUT + out).split('\n')
+    ACTION_MONITOR_OUTPUT = lines.pop()
+    for line in lines:
+        match = DBUS_SIGNAL_RE.search(line)
+        if match:
+            signal, notification_id, action = match.groups()
+            if signal == 'ActionInvoked':
+                handle_notification_action(notification_id, action)
+            else:
+                handle_notification_closed(notification_id)
+
+    if return_code != weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+        # The process has ended (e.g. the session bus is gone). It is
+        # started again when the next notification with actions is sent.
+        ACTION_MONITOR_HOOK = ''
+    return weechat.WEECHAT_RC_OK
+
+
+def handle_notification_action(notification_id, action):
+    """Handles the given action invoked on the notification with the given
+    ID.
+    """
+    buffer_name = ACTION_NOTIFICATIONS.get(notification_id)
+    if buffer_name is None:
+        # Not our notification (or a forgotten one).
+        return
+    buffer = weechat.buffer_search('==', buffer_name)
+    if not buffer:
+        # The buffer has been closed.
+        return
+    if action in ('default', 'open'):
+        weechat.buffer_set(buffer, 'display', '1')
+    elif action == 'read':
+        weechat.buffer_set(buffer, 'hotlist', '-1')
+
+
+def handle_notification_closed(notification_id):
+    """Handles the notification with the given ID being closed by the
+    notification daemon (e.g. dismissed by the user).
+    """
+    buffer_name = ACTION_NOTIFICATIONS.pop(notification_id, None)
+    if buffer_name is None:
+        return
+    buffer = weechat.buffer_search('==', buffer_name)
+    if buffer and buffer_get_notification_id(buffer) == notification_id:
+        # There is nothing to close anymore.
+        buffer_set_notification_id(buffer, '0')
+
+
+def apply_actions_config():
+    """Starts or stops listening to actions of notifications."""
+    if notifications_have_actions():
+        start_action_monitor()
+    else:
+        stop_action_monitor()
+
+
+def apply_config():
+    """Applies the options whose values are not looked up on every message."""
+    global DECISION_TRACE
+    NOTIFY_CMD_PARTS.clear()
+
+    trace_size = int_option('trace_size')
+    if trace_size <= 0:
+        DECISION_TRACE = None
+    elif DECISION_TRACE is None or DECISION_TRACE.size != trace_size:
+        DECISION_TRACE = DecisionTrace(trace_size)
+
+    apply_buffer_overrides_config()
+    apply_regex_time_budget_config()
+    apply_rules_config()
+    apply_shadow_config()
+    apply_templates_config()
+    apply_icons_config()
+    apply_history_config()
+    apply_away_digest_config()
+    apply_focus_config()
+    apply_input_activity_config()
+    apply_actions_config()
+    apply_engine_config()
+
+
+def apply_buffer_overrides_config():
+    """Reads buffer overrides of options (see BUFFER_OPTIONS)."""
+    overrides = []
+    prefix = 'plugins.var.python.{}.'.format(SCRIPT_NAME)
+    infolist = weechat.infolist_get('option', '', prefix + '*')
+    if infolist:
+        while weechat.infolist_next(infolist):
+            name = weechat.infolist_string(infolist, 'full_name')[len(prefix):]
+            option, _, mask = name.partition('.')
+            if option in BUFFER_OPTIONS and mask:
+                value = weechat.infolist_string(infolist, 'value')
+                overrides.append((option, mask, value))
+        weechat.infolist_free(infolist)
+
+    # The longest (most specific) masks go first.
+    overrides.sort(key=lambda override: len(override[1]), reverse=True)
+    BUFFER_OVERRIDES[:] = overrides
+    BUFFER_POLICIES.clear()
+
+
+def apply_rules_config():
+    """Reads and compiles notification rules (rule.<number> options)."""
+    global NOTIFICATION_RULES, RULE_URGENCY
+    rules = []
+    prefix = 'plugins.var.python.{}.'.format(SCRIPT_NAME)
+    infolist = weechat.infolist_get('option', '', prefix + 'rule.*')
+    if infolist:
+        while weechat.infolist_next(infolist):
+            name = weechat.infolist_string(infolist, 'full_name')[len(prefix):]
+            value = weechat.infolist_string(infolist, 'value')
+            if not value:
+                # An empty value disables the rule.
+                continue
+            try:
+                rules.append(parse_rule(name, value))
+            except ValueError as ex:
+                print_error('invalid {}: {}'.format(name, ex))
+        weechat.infolist_free(infolist)
+
+    NOTIFICATION_RULES = RuleTable(rules) if rules else None
+    RULE_URGENCY = ''
+
+
+def apply_shadow_config():
+    """Reads the shadow profile (shadow.<name>.<option> options) into a
+    ShadowConfig.
+
+    Only options that decisions depend on can be set (see SHADOW_OPTIONS).
+    The counters of the profile are reset, as the options may have changed.
+    """
+    global SHADOW_PROFILE
+    name = weechat.config_get_plugin('shadow_profile')
+    if not name:
+        SHADOW_PROFILE = None
+        return
+
+    options = {option: weechat.config_get_plugin(option) for option in SHADOW_OPTIONS}
+    rules = []
+    prefix = 'plugins.var.python.{}.shadow.{}.'.format(SCRIPT_NAME, name)
+    infolist = weechat.infolist_get('option', '', prefix + '*')
+    if infolist:
+        while weechat.infolist_next(infolist):
+            option = weechat.infolist_string(infolist, 'full_name')[len(prefix):]
+            value = weechat.infolist_string(infolist, 'value')
+            if option.startswith('rule.'):
+                if not value:
+                    continue
+                try:
+                    rules.append(parse_rule(option, value))
+                except ValueError as ex:
+                    print_error('invalid shadow.{}.{}: {}'.format(name, option, ex))
+            elif option in SHADOW_OPTIONS:
+                options[option] = value
+            elif option in OPTIONS:
+                print_error('shadow profile {}: option {} does not change decisions, so '
+                            'it cannot be evaluated'.format(name, option))
+            else:
+                print_error('unknown option in shadow profile {}: {}'.format(name, option))
+        weechat.infolist_free(infolist)
+
+    if (options['notify_only_when_terminal_unfocused'] == 'on' and
+            not terminal_focus_is_needed()):
+        # Whether the terminal is focused is known only when the options need
+        # focus reporting.
+        print_error('shadow profile {}: option notify_only_when_terminal_unfocused '
+                    'can be evaluated only when it is on'.format(name))
+        options['notify_only_when_terminal_unfocused'] = 'off'
+
+    try:
+        suppress_while_typing = max(int(options['suppress_while_typing']), 0)
+    except ValueError:
+        suppress_while_typing = 0
+
+    SHADOW_PROFILE = ShadowProfile(
+        name,
+        ShadowConfig(
+            options,
+            RuleTable(rules) if rules else NOTIFICATION_RULES,
+            suppress_while_typing,
+            options['away_digest'] in ('on', 'buffer')
+        ),
+        max(int_option('shadow_max_rate'), 1)
+    )
+
+
+def parse_rule(name, value):
+    """Parses a notification rule from the given option name (rule.<number>)
+    and value (conditions -> action).
+
+    Raises ValueError when the rule is invalid.
+    """
+    number = name[len('rule.'):]
+    if not name.startswith('rule.') or not number.isdigit():
+        raise ValueError('rules have to be named rule.<number>')
+
+    conditions, separator, action = value.rpartition('->')
+    if not separator:
+        raise ValueError('missing "-> action"')
+    rule = Rule(name, int(number))
+
+    action, _, urgency = action.strip().partition(':')
+    if action not in ('notify', 'drop'):
+        raise ValueError('unknown action: {}'.format(action or '""'))
+    rule.notify = action == 'notify'
+    if urgency:
+        if not rule.notify or urgency not in URGENCY_LEVELS:
+            raise ValueError('invalid urgency: {}'.format(urgency))
+        rule.urgency = urgency
+
+    for condition in split_rule_conditions(conditions):
+        key, separator, argument = condition.partition('=')
+        if key in ('highlight', 'private') and not separator:
+            setattr(rule, key, True)
+        elif key in RULE_CONDITIONS and argument:
+            if key == 'message':
+                try:
+                    argument = re.compile(argument)
+                except re.error as ex:
+                    raise ValueError('invalid regular expression: {}'.format(ex))
+            getattr(rule, RULE_CONDITIONS[key]).append(argument)
+        else:
+            raise ValueError('invalid condition: {}'.format(condition))
+    return rule
+
+
+def split_rule_conditions(conditions):
+    """Splits the given conditions of a rule by whitespace.
+
+    Quotes group conditions containing whitespace. Backslashes are kept, so
+    regular expressions need no escaping, and # does not start a comment, so
+    channels can be used.
+    """
+    lexer = shlex.shlex(conditions, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    lexer.escape = ''
+    return list(lexer)
+
+
+def focus_changed_callback(data, signal, signal_data):
+    """A callback when the user switches to another buffer or window."""
+    global CURRENT_BUFFER
+    CURRENT_BUFFER = weechat.current_buffer()
+    return weechat.WEECHAT_RC_OK
+
+
+def terminal_focus_is_needed():
+    """Do the options need to know whether the terminal is focused?
+
+    Focus reporting writes to the terminal and binds keys, so only
+    notify_only_when_terminal_unfocused turns it on. notify_for_current_buffer
+    then also takes focus into account.
+    """
+    return notify_only_when_terminal_unfocused()
+
+
+def apply_focus_config():
+    """Turns focus reporting of the terminal on or off, depending on whether
+    it is needed.
+    """
+    if terminal_focus_is_needed():
+        start_focus_reporting()
+    else:
+        stop_focus_reporting()
+
+
+def user_is_typing(suppress_while_typing):
+    """Has the user changed the input within the given number of seconds?"""
+    return time.time() - LAST_INPUT_TIME < suppress_while_typing
+
+
+def input_activity_callback(data, signal, signal_data):
+    """A callback when the input changes.
+
+    It is called on every keystroke, so it only remembers the time.
+    """
+    global LAST_INPUT_TIME
+    LAST_INPUT_TIME = time.time()
+    return weechat.WEECHAT_RC_OK
+
+
+def apply_input_activity_config():
+    """Starts or stops tracking changes of the input based on the
+    suppress_while_typing option (of the options or of the shadow profile).
+    """
+    global SUPPRESS_WHILE_TYPING, INPUT_ACTIVITY_HOOK
+    SUPPRESS_WHILE_TYPING = max(int_option('suppress_while_typing'), 0)
+    is_needed = SUPPRESS_WHILE_TYPING or (
+        SHADOW_PROFILE is not None and SHADOW_PROFILE.config.suppress_while_typing
+    )
+    if is_needed and not INPUT_ACTIVITY_HOOK:
+        # Unlike key_pressed, input_text_changed is not sent for keys that
+        # the terminal sends by itself (e.g. when it loses focus).
+        INPUT_ACTIVITY_HOOK = weechat.hook_signal('input_text_changed',
+                                                  'input_activity_callback', '')
+    elif not is_needed and INPUT_ACTIVITY_HOOK:
+        weechat.unhook(INPUT_ACTIVITY_HOOK)
+        INPUT_ACTIVITY_HOOK = ''
+
+
+def start_focus_reporting():
+    """Makes the terminal report when it gains or loses focus."""
+    global FOCUS_REPORTING
+    if FOCUS_REPORTING:
+        return
+    # The terminal then sends CSI I or CSI O, which we bind to our command.
+    for state, key in sorted(FOCUS_KEYS.items()):
+        command = focus_key_command(state)
+        binding = key_binding(key)
+        FOCUS_KEY_BINDINGS[key] = binding if binding != command else ''
+        weechat.command('', '/mute /key bind {} {}'.format(key, command))
+    weechat.command('', '/print -stdout \\033[?1004h')
+    FOCUS_REPORTING = True
+
+
+def stop_focus_reporting():
+    """Stops focus reporting of the terminal."""
+    global FOCUS_REPORTING, TERMINAL_FOCUSED
+    if not FOCUS_REPORTING:
+        return
+    weechat.command('', '/print -stdout \\033[?1004l')
+    for key in sorted(FOCUS_KEYS.values()):
+        binding = FOCUS_KEY_BINDINGS.pop(key, '')
+        if binding:
+            weechat.command('', '/mute /key bind {} {}'.format(key, binding))
+        else:
+            weechat.command('', '/mute /key unbind {}'.format(key))
+    FOCUS_REPORTING = False
+    TERMINAL_FOCUSED = True
+
+
+def focus_key_command(state):
+    """Returns the command that a key for the given focus state is bound to."""
+    return '/{} focus {}'.format(SCRIPT_NAME, state)
+
+
+def key_binding(key):
+    """Returns the command that the given key is bound to in the default
+    context ('' when it is not bound).
+    """
+    command = ''
+    infolist = weechat.infolist_get('key', '', 'default')
+    if infolist:
+        while weechat.infolist_next(infolist):
+            if weechat.infolist_string(infolist, 'key') == key:
+                command = weechat.infolist_string(infolist, 'command')
+                break
+        weechat.infolist_free(infolist)
+    return command
+
+
+def buffer_changed_callback(data, signal, signal_data):
+    """A callback when a buffer is renamed or closed."""
+    # signal_data is the buffer. Its overrides and rules will be found again
+    # when needed.
+    BUFFER_POLICIES.pop(signal_data, None)
+    if signal == 'buffer_closed' and AWAY_DIGEST is not None:
+        AWAY_DIGEST.buffers.pop(signal_data, None)
+    if NOTIFICATION_RULES is not None:
+        NOTIFICATION_RULES.forget_buffer(signal_data)
+    if SHADOW_PROFILE is not None and SHADOW_PROFILE.config.rules is not None:
+        SHADOW_PROFILE.config.rules.forget_buffer(signal_data)
+    return weechat.WEECHAT_RC_OK
+
+
+def data_dir():
+    """Returns the path to WeeChat's data directory."""
+    # The weechat_data_dir info is available since WeeChat 3.2.
+    return (weechat.info_get('weechat_data_dir', '') or
+            weechat.info_get('weechat_dir', ''))
+
+
+def apply_icons_config():
+    """Reads directories with icons and forgets resolved icons."""
+    ICON_DIRS[:] = [
+        os.path.expanduser(icon_dir) for icon_dir in split_option_value('icon_dirs')
+        if icon_dir
+    ]
+    ICON_CACHE.clear()
+    ICON_DIR_LISTINGS.clear()
+
+
+def apply_regex_time_budget_config():
+    """Reads the time budget of regular expressions from the options."""
+    global REGEX_TIME_BUDGET
+    REGEX_TIME_BUDGET = max(int_option('regex_time_budget'), 0) / 1000
+    if not REGEX_TIME_BUDGET:
+        SLOW_PATTERNS.clear()
+
+
+def apply_history_config():
+    """Opens, resizes, or closes the history of sent notifications based on the
+    history_size option.
+    """
+    global NOTIFICATION_HISTORY
+    history_size = int_option('history_size')
+    if NOTIFICATION_HISTORY is not None:
+        if NOTIFICATION_HISTORY.capacity == history_size:
+            return
+        entries = NOTIFICATION_HISTORY.entries()
+        NOTIFICATION_HISTORY.close()
+        NOTIFICATION_HISTORY = None
+    else:
+        entries = []
+
+    if history_size <= 0:
+        return
+
+    path = os.path.join(data_dir(), HISTORY_FILE_NAME)
+    try:
+        NOTIFICATION_HISTORY = NotificationHistory(path, history_size)
+    except (OSError, ValueError) as ex:
+        print_error('cannot open {} ({})'.format(path, ex))
+        return
+
+    # Keep the remembered notifications when the size changes.
+    for entry in entries[-history_size:]:
+        NOTIFICATION_HISTORY.append(*entry)
+
+
+def config_changed_callback(data, option, value):
+    """A callback when an option of the script is changed."""
+    apply_config()
+    # Quiet hours are applied only when they change, so that a change of
+    # another option does not start do-not-disturb that has been stopped.
+    if option == 'plugins.var.python.{}.quiet_hours'.format(SCRIPT_NAME):
+        apply_quiet_hours_config()
+    return weechat.WEECHAT_RC_OK
+
+
+def print_error(message):
+    """Prints the given error message into the core buffer."""
+    weechat.prnt('', '{}{}: {}'.format(weechat.prefix('error'), SCRIPT_NAME, message))
+
+
+def format_decision(decision):
+    """Formats the given traced decision to be printed."""
+    decision_time, duration, buffer, nick, result, reason = decision
+    buffer_name = weechat.buffer_get_string(buffer, 'name') or buffer
+    return '{}  {}  {}  {}  ({}, {:.3f} ms)'.format(
+        time.strftime('%H:%M:%S', time.localtime(decision_time)),
+        buffer_name,
+        nick or '-',
+        'sent' if result else 'not sent',
+        reason,
+        duration * 1000
+    )
+
+
+def why_command(buffer, args):
+    """Handles /notify_send why [count]."""
+    if DECISION_TRACE is None:
+        print_error('tracing is disabled (set plugins.var.python.{}.trace_size '
+                    'to a positive number to enable it)'.format(SCRIPT_NAME))
+        return weechat.WEECHAT_RC_ERROR
+
+    try:
+        limit = int(args) if args else None
+    except ValueError:
+        print_error('invalid count: {}'.format(args))
+        return weechat.WEECHAT_RC_ERROR
+
+    decisions = DECISION_TRACE.entries(limit)
+    if not decisions:
+        weechat.prnt('', '{}: no decisions recorded yet'.format(SCRIPT_NAME))
+    for decision in decisions:
+        weechat.prnt('', format_decision(decision))
+    return weechat.WEECHAT_RC_OK
+
+
+def stats_command(buffer, args):
+    """Handles /notify_send stats."""
+    current_time = time.time()
+    buffer_hdata = weechat.hdata_get('buffer')
+    buffer = weechat.hdata_get_list(buffer_hdata, 'gui_buffers')
+    lines = []
+    while buffer:
+        last_notification_time = buffer_get_float(
+            buffer,
+            'localvar_' + LAST_NOTIFICATION_TIME_VAR
+        )
+        if last_notification_time:
+            lines.append(format_buffer_stats(buffer, current_time - last_notification_time))
+        buffer = weechat.hdata_move(buffer_hdata, buffer, 1)
+
+    if not lines:
+        weechat.prnt('', '{}: no notifications sent yet'.format(SCRIPT_NAME))
+    for line in lines:
+        weechat.prnt('', line)
+    return weechat.WEECHAT_RC_OK
+
+
+def format_buffer_stats(buffer, elapsed_time):
+    """Returns a line describing the notification delay of the given buffer for
+    /notify_send stats."""
+    min_notification_delay, max_notification_delay = notification_delay_limits(buffer)
+    if max_notification_delay > min_notification_delay > 0:
+        notification_delay = current_notification_delay(
+            buffer,
+            min_notification_delay,
+            max_notification_delay
+        )
+        limits = 'adaptive, {:g}s to {:g}s'.format(min_notification_delay,
+                                                   max_notification_delay)
+    else:
+        notification_delay = min_notification_delay
+        limits = 'fixed'
+    return '{}: delay {:g}s ({}), last notification {:.0f}s ago'.format(
+        weechat.buffer_get_string(buffer, 'full_name'),
+        notification_delay,
+        limits,
+        elapsed_time
+    )
+
+
+def shadow_command(buffer, args):
+    """Handles /notify_send shadow [reset]."""
+    if SHADOW_PROFILE is None:
+        print_error('there is no shadow profile (set plugins.var.python.{}.shadow_profile '
+                    'to its name)'.format(SCRIPT_NAME))
+        return weechat.WEECHAT_RC_ERROR
+
+    if args == 'reset':
+        SHADOW_PROFILE.reset()
+    elif args:
+        print_error('invalid argument: {}'.format(args))
+        return weechat.WEECHAT_RC_ERROR
+
+    for line in shadow_report(SHADOW_PROFILE):
+        weechat.prnt('', line)
+    return weechat.WEECHAT_RC_OK
+
+
+def shadow_report(profile):
+    """Returns a list of lines describing how decisions of the given shadow
+    profile differed from decisions of the options.
+    """
+    differences = sorted(profile.differences.items(),
+                         key=lambda difference: difference[1][0], reverse=True)
+    lines = ['{}: shadow profile {}: {} messages evaluated ({} skipped by sampling), '
+             '{} decided differently'.format(
+                 SCRIPT_NAME, profile.name, profile.evaluated, profile.skipped,
+                 sum(count for _, (count, _) in differences)
+             )]
+    for (shadow_result, shadow_reason, reason), (count, examples) in differences:
+        lines.append('  {}x would {}notify ({} instead of {})'.format(
+            count, '' if shadow_result else 'not ', shadow_reason, reason
+        ))
+        for buffer_name, nick, message in examples:
+            lines.append('    {} <{}> {}'.format(
+                buffer_name, nick, shorten_message(message, 80, '[..]')
+            ))
+    return lines
+
+
+def notification_engine_config():
+    """Returns a pair (engine, poll interval in milliseconds).
+
+    The auto engine is resolved into the engine that will be used.
+    """
+    engine = weechat.config_get_plugin('engine')
+    if engine == 'hotlist':
+        return engine, max(int_option('hotlist_poll_interval'), 1) * 1000
+    elif engine == 'signals':
+        return engine, 0
+    elif engine == 'auto' and only_highlights_and_private_messages_are_needed():
+        return 'signals', 0
+    return 'print', 0
+
+
+def only_highlights_and_private_messages_are_needed():
+    """Can notifications be sent based only on highlights and private
+    messages?
+
+    This is the case when no option needs to look at other messages.
+    """
+    return (
+        NOTIFICATION_RULES is None and
+        not split_option_value('notify_on_all_messages_in_buffers') and
+        not split_option_value('notify_on_all_messages_in_buffers_that_match') and
+        not split_option_value('notify_on_messages_that_match') and
+        not notify_on_all_messages_in_current_buffer() and
+        not notify_on_filtered_messages() and
+        weechat.config_get_plugin('auto_close_prior_buffer_notification') != 'on'
+    )
+
+
+def hook_notifications():
+    """Starts catching messages to notify about."""
+    global NOTIFICATION_HOOKS_CONFIG, HOTLIST_SNAPSHOT
+    if NOTIFICATION_HOOKS:
+        return
+
+    # While profiling, the callbacks are wrapped, so that they cost nothing
+    # extra otherwise.
+    prefix = 'profiled_' if PROFILER is not None else ''
+    NOTIFICATION_HOOKS_CONFIG = engine, interval = notification_engine_config()
+    if engine == 'hotlist':
+        HOTLIST_SNAPSHOT = hotlist_counts()
+        NOTIFICATION_HOOKS.append(
+            weechat.hook_timer(interval, 0, 0, prefix + 'hotlist_timer_callback', '')
+        )
+    elif engine == 'signals':
+        # WeeChat sends these signals only for highlights and private
+        # messages, so the script does not run for other messages. The
+        # weechat_pv signal is sent also for IRC private messages, so there is
+        # no need to catch irc_pv.
+        for signal in ['weechat_highlight', 'weechat_pv']:
+            NOTIFICATION_HOOKS.append(
+                weechat.hook_signal(signal, prefix + 'highlight_or_private_signal_callback',
+                                    '')
+            )
+    else:
+        # Catch all messages on all buffers and strip colors from them before
+        # passing them into the callback.
+        NOTIFICATION_HOOKS.append(
+            weechat.hook_print('', '', '', 1, prefix + 'message_printed_callback', '')
+        )
+
+
+def unhook_notifications():
+    """Stops catching messages to notify about."""
+    for hook in NOTIFICATION_HOOKS:
+        weechat.unhook(hook)
+    del NOTIFICATION_HOOKS[:]
+
+
+def rehook_notifications():
+    """Re-creates the hooks catching messages (unless they are off, e.g.
+    during do-not-disturb).
+    """
+    if NOTIFICATION_HOOKS:
+        unhook_notifications()
+        hook_notifications()
+
+
+def apply_engine_config():
+    """Re-creates the hooks catching messages when their configuration has
+    changed.
+    """
+    if NOTIFICATION_HOOKS and NOTIFICATION_HOOKS_CONFIG != notification_engine_config():
+        unhook_notifications()
+        hook_notifications()
+
+
+def hotlist_counts():
+    """Returns a dictionary mapping buffers in the hotlist to triples (number
+    of messages, number of private messages, number of highlights).
+    """
+    counts = {}
+    infolist = weechat.infolist_get('hotlist', '', '')
+    if infolist:
+        while weechat.infolist_next(infolist):
+            counts[weechat.infolist_pointer(infolist, 'buffer_pointer')] = (
+                weechat.infolist_integer(infolist, 'count_01'),
+                weechat.infolist_integer(infolist, 'count_02'),
+                weechat.infolist_integer(infolist, 'count_03'),
+            )
+        weechat.infolist_free(infolist)
+    return counts
+
+
+def hotlist_timer_callback(data, remaining_calls):
+    """A callback when the hotlist should be looked at (engine hotlist)."""
+    global HOTLIST_SNAPSHOT
+    counts = hotlist_counts()
+    for buffer, (messages, privates, highlights) in counts.items():
+        old_messages, old_privates, old_highlights = HOTLIST_SNAPSHOT.get(buffer, (0, 0, 0))
+        if hotlist_notification_should_be_sent(buffer,
+                                               messages > old_messages,
+                                               privates > old_privates,
+                                               highlights > old_highlights):
+            nick, message, date = last_message_in_buffer(buffer)
+            if AWAY_DIGEST is not None and is_away(buffer):
+                add_to_away_digest(buffer, nick, message)
+                continue
+            if HOOKED_MODIFIERS and not modifiers_allow_notification(
+                    buffer, (), nick, highlights > old_highlights, message):
+                continue
+            notification = prepare_notification(buffer, nick, message, date)
+            if HOOKED_MODIFIERS:
+                notification = modify_notification(buffer, notification)
+                if notification is None:
+                    continue
+            notification_id = send_notification(buffer, notification)
+            record_notification(buffer, notification_id, nick, message)
+    HOTLIST_SNAPSHOT = counts
+    return weechat.WEECHAT_RC_OK
+
+
+def hotlist_notification_should_be_sent(buffer, new_messages, new_privates,
+                                        new_highlights):
+    """Should a notification be sent for a buffer whose hotlist counts went up?
+
+    This is a counterpart of notification_should_be_sent() for the hotlist
+    engine, which knows only which counts went up.
+    """
+    if not (new_messages or new_privates or new_highlights):
+        return False
+
+    if is_away(buffer) and not notify_when_away() and AWAY_DIGEST is None:
+        return False
+
+    if ignore_notifications_from_buffer(buffer):
+        return False
+
+    if (FOCUS_REPORTING and TERMINAL_FOCUSED and
+            notify_only_when_terminal_unfocused()):
+        return False
+
+    if SUPPRESS_WHILE_TYPING and user_is_typing(SUPPRESS_WHILE_TYPING):
+        return False
+
+    if (buffer == current_buffer() and TERMINAL_FOCUSED and
+            not notify_for_current_buffer()):
+        return False
+
+    if new_highlights and notify_on_highlights():
+        return True
+
+    if new_privates and notify_on_private_messages():
+        return True
+
+    return notify_on_all_messages_in_buffer(buffer)
+
+
+def last_line_data(buffer):
+    """Returns a pointer to the data of the last line in the given buffer, or
+    the empty string when the buffer has no lines.
+    """
+    lines = weechat.hdata_pointer(weechat.hdata_get('buffer'), buffer, 'own_lines')
+    line = weechat.hdata_pointer(weechat.hdata_get('lines'), lines, 'last_line')
+    return weechat.hdata_pointer(weechat.hdata_get('line'), line, 'data')
+
+
+def line_tags(hdata, data):
+    """Returns a list of tags of the line with the given data."""
+    return [
+        weechat.hdata_string(hdata, data, '{}|tags_array'.format(i))
+        for i in range(weechat.hdata_integer(hdata, data, 'tags_count'))
+    ]
+
+
+def last_message_in_buffer(buffer):
+    """Returns a triple (nick, message, date) for the last line in the given
+    buffer.
+    """
+    data = last_line_data(buffer)
+    if not data:
+        return '', '', None
+
+    hdata = weechat.hdata_get('line_data')
+    prefix = weechat.string_remove_color(weechat.hdata_string(hdata, data, 'prefix'), '')
+    message = weechat.string_remove_color(weechat.hdata_string(hdata, data, 'message'), '')
+    date = weechat.hdata_time(hdata, data, 'date')
+    return nick_that_sent_message(line_tags(hdata, data), prefix), message, date
+
+
+def highlight_or_private_signal_callback(data, signal, signal_data):
+    """A callback for the weechat_highlight and weechat_pv signals (engine
+    signals).
+
+    The signals carry only the prefix and message of the line (separated by a
+    tab), so the buffer is found as the first one whose last line is the line
+    from the signal. Then, the line is handled as if it has been caught by the
+    print hook.
+
+    The signals are sent right when the line is printed, so buffers whose last
+    line was printed earlier are skipped without comparing the text. When the
+    last lines of several buffers with the same text are printed within the
+    same second, the first of these buffers is taken.
+    """
+    buffer_hdata = weechat.hdata_get('buffer')
+    line_data_hdata = weechat.hdata_get('line_data')
+    # Allow for the line being printed just before the start of a second.
+    min_date_printed = int(time.time()) - 1
+    buffer = weechat.hdata_get_list(buffer_hdata, 'gui_buffers')
+    while buffer:
+        line_data = last_line_data(buffer)
+        if (line_data and
+                weechat.hdata_time(line_data_hdata, line_data, 'date_printed') >=
+                min_date_printed):
+            # The data of the signals have no colors, unlike lines.
+            prefix = weechat.string_remove_color(
+                weechat.hdata_string(line_data_hdata, line_data, 'prefix'), ''
+            )
+            message = weechat.string_remove_color(
+                weechat.hdata_string(line_data_hdata, line_data, 'message'), ''
+            )
+            if prefix + '\t' + message == signal_data:
+                return message_printed_callback(
+                    data,
+                    buffer,
+                    str(weechat.hdata_time(line_data_hdata, line_data, 'date')),
+                    ','.join(line_tags(line_data_hdata, line_data)),
+                    str(weechat.hdata_char(line_data_hdata, line_data, 'displayed')),
+                    str(weechat.hdata_char(line_data_hdata, line_data, 'highlight')),
+                    prefix,
+                    message
+                )
+        buffer = weechat.hdata_move(buffer_hdata, buffer, 1)
+    return weechat.WEECHAT_RC_OK
+
+
+def dnd_start(until=0):
+    """Starts do-not-disturb, which lasts until the given time (0 means until
+    it is turned off).
+
+    The messages are not even looked at during do-not-disturb.
+    """
+    global DND_UNTIL, DND_TIMER, DND_HOTLIST
+    if DND_UNTIL is None:
+        unhook_notifications()
+        DND_HOTLIST = hotlist_counts() if weechat.config_get_plugin('dnd_digest') == 'on' else {}
+
+    if DND_TIMER:
+        weechat.unhook(DND_TIMER)
+        DND_TIMER = ''
+    DND_UNTIL = until
+    if until:
+        DND_TIMER = weechat.hook_timer(
+            max(int((until - time.time()) * 1000), 1), 0, 1, 'dnd_timer_callback', ''
+        )
+
+
+def dnd_stop():
+    """Stops do-not-disturb."""
+    global DND_UNTIL, DND_TIMER
+    if DND_UNTIL is None:
+        return
+
+    if DND_TIMER:
+        weechat.unhook(DND_TIMER)
+        DND_TIMER = ''
+    DND_UNTIL = None
+    hook_notifications()
+    send_dnd_digest()
+
+
+def send_dnd_digest():
+    """Sends a notification summarizing buffers that received private messages
+    or highlights since do-not-disturb started.
+    """
+    if weechat.config_get_plugin('dnd_digest') != 'on':
+        return
+
+    parts = []
+    for buffer, (_, privates, highlights) in hotlist_counts().items():
+        _, old_privates, old_highlights = DND_HOTLIST.get(buffer, (0, 0, 0))
+        new = max(privates - old_privates, 0) + max(highlights - old_highlights, 0)
+        if new:
+            name = (weechat.buffer_get_string(buffer, 'short_name') or
+                    weechat.buffer_get_string(buffer, 'name'))
+            parts.append('{} ({})'.format(name, new))
+    DND_HOTLIST.clear()
+    if not parts:
+        return
+
+    notification = digest_notification('While you were not disturbed',
+                                       escape_slashes(', '.join(sorted(parts))))
+    # Associate the notification with the core buffer.
+    send_notification(weechat.buffer_search_main(), notification)
+
+
+def digest_notification(source, message):
+    """Returns a notification that summarizes other notifications."""
+    return Notification(
+        source=source,
+        message=message,
         icon=weechat.config_get_plugin('icon'),
         desktop_entry=weechat.config_get_plugin('desktop_entry'),
-        timeout='5',  # 5ms
+        timeout=weechat.config_get_plugin('timeout'),
         transient=should_notifications_be_transient(),
         urgency=weechat.config_get_plugin('urgency'),
-        replace_id=notification_id,
+        replace_id='0',
     )
-    send_notification(buffer, notification)
 
 
-if __name__ == '__main__':
+def apply_away_digest_config():
+    """Starts or stops collecting notifications while away based on the
+    away_digest option.
+    """
+    global AWAY_DIGEST, AWAY_DIGEST_HOOK
+    if weechat.config_get_plugin('away_digest') not in ('on', 'buffer'):
+        if AWAY_DIGEST_HOOK:
+            weechat.unhook(AWAY_DIGEST_HOOK)
+            AWAY_DIGEST_HOOK = ''
+        AWAY_DIGEST = None
+        return
+
+    lines = max(int_option('away_digest_lines'), 0)
+    if AWAY_DIGEST is None:
+        AWAY_DIGEST = AwayDigest(lines)
+    else:
+        # Keep what has been collected. New buffers get the new number of
+        # lines.
+        AWAY_DIGEST.lines = lines
+    if not AWAY_DIGEST_HOOK:
+        # IRC servers confirm that you are no longer away by message 305
+        # (RPL_UNAWAY), after which WeeChat has already removed the away local
+        # variable from buffers of the server.
+        AWAY_DIGEST_HOOK = weechat.hook_signal('*,irc_in2_305', 'unaway_callback', '')
+
+
+def add_to_away_digest(buffer, nick, message):
+    """Adds a notification about the given message into the away digest."""
+    if len(message) > MAX_AWAY_DIGEST_LINE_LENGTH:
+        message = message[:MAX_AWAY_DIGEST_LINE_LENGTH] + weechat.config_get_plugin('ellipsis')
+    if not is_private_message(buffer):
+        message = nick + nick_separator() + message
+    AWAY_DIGEST.add(buffer, time.time(), message)
+
+
+def unaway_callback(data, signal, signal_data):
+    """A callback when an IRC server confirms that you are no longer away."""
+    # The signal is <server>,irc_in2_305.
+    send_away_digest(signal.split(',')[0])
+    return weechat.WEECHAT_RC_OK
+
+
+def send_away_digest(server):
+    """Sends notifications summarizing notifications collected while away on
+    the given server.
+    """
+    if AWAY_DIGEST is None:
+        return
+
+    buffers = [
+        buffer for buffer in AWAY_DIGEST.buffers
+        if weechat.buffer_get_string(buffer, 'localvar_server') == server
+    ]
+    html = weechat.config_get_plugin('escape_html') == 'on'
+    per_buffer = weechat.config_get_plugin('away_digest') == 'buffer'
+    parts = []
+    for buffer in buffers:
+        count, first_time, lines = AWAY_DIGEST.pop(buffer)
+        name = (weechat.buffer_get_string(buffer, 'short_name') or
+                weechat.buffer_get_string(buffer, 'name'))
+        heading = '{} ({} since {})'.format(
+            name, count, time.strftime('%H:%M', time.localtime(first_time))
+        )
+        if per_buffer:
+            send_notification(buffer, digest_notification(
+                heading, format_message('\n'.join(lines), 0, '', html)
+            ))
+        else:
+            parts.append('\n'.join([heading] + lines))
+
+    if parts:
+        notification = digest_notification(
+            'While you were away',
+            format_message('\n'.join(parts), 0, '', html)
+        )
+        # Associate the notification with the core buffer.
+        send_notification(weechat.buffer_search_main(), notification)
+
+
+def dnd_timer_callback(data, remaining_calls):
+    """A callback when do-not-disturb should end."""
+    global DND_TIMER
+    DND_TIMER = ''
+    quiet_hours_end = quiet_period_end(time.time())
+    if quiet_hours_end is not None:
+        dnd_start(quiet_hours_end)
+    else:
+        dnd_stop()
+    return weechat.WEECHAT_RC_OK
+
+
+def parse_quiet_hours(value):
+    """Parses the given value of the quiet_hours option into a list of pairs
+    (start, end), where both times are in minutes since midnight.
+
+    Invalid periods are skipped.
+    """
+    periods = []
+    for period in value.split(','):
+        m = re.match(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$', period)
+        if not m:
+            continue
+        start_hour, start_minute, end_hour, end_minute = map(int, m.groups())
+        if max(start_hour, end_hour) > 23 or max(start_minute, end_minute) > 59:
+            continue
+        periods.append((start_hour * 60 + start_minute, end_hour * 60 + end_minute))
+    return periods
+
+
+def local_midnight(now):
+    """Returns the time of the last local midnight before the given time."""
+    local_time = time.localtime(now)
+    return now - (local_time.tm_hour * 3600 + local_time.tm_min * 60 + local_time.tm_sec)
+
+
+def quiet_period_end(now):
+    """Returns the end of the quiet period that the given time falls into, or
+    None when it is not within quiet hours.
+    """
+    midnight = local_midnight(now)
+    minutes = (now - midnight) / 60
+    ends = []
+    for start, end in parse_quiet_hours(weechat.config_get_plugin('quiet_hours')):
+        if start <= end:
+            if start <= minutes < end:
+                ends.append(midnight + end * 60)
+        elif minutes >= start:
+            ends.append(midnight + 86400 + end * 60)
+        elif minutes < end:
+            ends.append(midnight + end * 60)
+    return max(ends) if ends else None
+
+
+def next_quiet_period_start(now):
+    """Returns the time when the next quiet period starts, or None when there
+    are no quiet hours.
+    """
+    midnight = local_midnight(now)
+    starts = []
+    for start, _ in parse_quiet_hours(weechat.config_get_plugin('quiet_hours')):
+        start_time = midnight + start * 60
+        starts.append(start_time if start_time > now else start_time + 86400)
+    return min(starts) if starts else None
+
+
+def apply_quiet_hours_config():
+    """Starts do-not-disturb when within quiet hours and schedules the start of
+    the next quiet period.
+    """
+    global QUIET_HOURS_TIMER
+    if QUIET_HOURS_TIMER:
+        weechat.unhook(QUIET_HOURS_TIMER)
+        QUIET_HOURS_TIMER = ''
+
+    now = time.time()
+    end = quiet_period_end(now)
+    if end is not None and DND_UNTIL is not None and (DND_UNTIL == 0 or DND_UNTIL >= end):
+        # Do-not-disturb is already active for longer.
+        pass
+    elif end is not None:
+        dnd_start(end)
+
+    start = next_quiet_period_start(now)
+    if start is not None:
+        QUIET_HOURS_TIMER = weechat.hook_timer(
+            max(int((start - now) * 1000), 1), 0, 1, 'quiet_hours_timer_callback', ''
+        )
+
+
+def quiet_hours_timer_callback(data, remaining_calls):
+    """A callback when a quiet period starts."""
+    global QUIET_HOURS_TIMER
+    QUIET_HOURS_TIMER = ''
+    apply_quiet_hours_config()
+    return weechat.WEECHAT_RC_OK
+
+
+def parse_duration(duration):
+    """Parses the given duration (e.g. '90s', '30m', '1h30m', or '15', which
+    means minutes) into seconds.
+
+    Returns None when the duration is invalid.
+    """
+    if re.match(r'^\d+$', duration):
+        return int(duration) * 60
+
+    m = re.match(r'^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?$', duration)
+    if not m or not duration:
+        return None
+    hours, minutes, seconds = (int(part) if part else 0 for part in m.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def print_dnd_status():
+    """Prints whether do-not-disturb is active and until when."""
+    if DND_UNTIL is None:
+        status = 'off'
+    elif DND_UNTIL == 0:
+        status = 'on'
+    else:
+        status = 'on until {}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(DND_UNTIL))
+        )
+    weechat.prnt('', '{}: do-not-disturb is {}'.format(SCRIPT_NAME, status))
+
+
+def snooze_command(buffer, args):
+    """Handles /notify_send snooze <duration>."""
+    duration = parse_duration(args)
+    if not duration:
+        print_error('invalid duration: {}'.format(args or '""'))
+        return weechat.WEECHAT_RC_ERROR
+
+    dnd_start(time.time() + duration)
+    print_dnd_status()
+    return weechat.WEECHAT_RC_OK
+
+
+def focus_command(buffer, args):
+    """Handles /notify_send focus in|out (sent by the terminal)."""
+    global TERMINAL_FOCUSED
+    if args not in FOCUS_KEYS:
+        print_error('invalid argument: {}'.format(args))
+        return weechat.WEECHAT_RC_ERROR
+    TERMINAL_FOCUSED = args == 'in'
+    return weechat.WEECHAT_RC_OK
+
+
+def dnd_command(buffer, args):
+    """Handles /notify_send dnd [on|off]."""
+    if args == 'on':
+        dnd_start()
+    elif args == 'off':
+        dnd_stop()
+    elif args:
+        print_error('invalid argument: {}'.format(args))
+        return weechat.WEECHAT_RC_ERROR
+    print_dnd_status()
+    return weechat.WEECHAT_RC_OK
+
+
+def profiled_message_printed_callback(*args):
+    """message_printed_callback() hooked while profiling."""
+    return profile_call(message_printed_callback, args)
+
+
+def profiled_highlight_or_private_signal_callback(*args):
+    """highlight_or_private_signal_callback() hooked while profiling."""
+    return profile_call(highlight_or_private_signal_callback, args)
+
+
+def profiled_hotlist_timer_callback(*args):
+    """hotlist_timer_callback() hooked while profiling."""
+    return profile_call(hotlist_timer_callback, args)
+
+
+def profile_call(callback, args):
+    """Calls the given callback, profiling every PROFILE_EVERY-th call."""
+    global PROFILE_CALLS
+    PROFILE_CALLS += 1
+    if PROFILE_CALLS % PROFILE_EVERY:
+        return callback(*args)
+    return PROFILER.runcall(callback, *args)
+
+
+def profile_start(every=1, duration=0):
+    """Starts profiling every given call of the callbacks that catch
+    messages, for the given duration (in seconds, 0 means until stopped).
+    """
+    global PROFILER, PROFILE_EVERY, PROFILE_CALLS, PROFILE_TIMER
+    if PROFILER is None:
+        PROFILER = cProfile.Profile()
+        PROFILE_CALLS = 0
+        rehook_notifications()
+    PROFILE_EVERY = every
+    if PROFILE_TIMER:
+        weechat.unhook(PROFILE_TIMER)
+        PROFILE_TIMER = ''
+    if duration:
+        PROFILE_TIMER = weechat.hook_timer(duration * 1000, 0, 1,
+                                           'profile_timer_callback', '')
+
+
+def profile_stop():
+    """Stops profiling and returns the profiler (None when not profiling)."""
+    global PROFILER, PROFILE_TIMER
+    profiler = PROFILER
+    if profiler is None:
+        return None
+
+    if PROFILE_TIMER:
+        weechat.unhook(PROFILE_TIMER)
+        PROFILE_TIMER = ''
+    PROFILER = None
+    rehook_notifications()
+    return profiler
+
+
+def profile_dump(profiler):
+    """Writes statistics of the given profiler into a new file in WeeChat's
+    data directory (loadable by the pstats module) and prints its path.
+    """
+    path = os.path.join(data_dir(), '{}_profile_{}.pstats'.format(
+        SCRIPT_NAME, time.strftime('%Y%m%d-%H%M%S', time.localtime(time.time()))
+    ))
+    try:
+        profiler.dump_stats(path)
+    except OSError as ex:
+        print_error('cannot write {}: {}'.format(path, ex))
+        return weechat.WEECHAT_RC_ERROR
+    weechat.prnt('', '{}: profile of {} call(s) written to {}'.format(
+        SCRIPT_NAME, PROFILE_CALLS // PROFILE_EVERY, path
+    ))
+    return weechat.WEECHAT_RC_OK
+
+
+def profile_timer_callback(data, remaining_calls):
+    """A callback when profiling for a given time should end."""
+    global PROFILE_TIMER
+    PROFILE_TIMER = ''
+    profile_dump(profile_stop())
+    return weechat.WEECHAT_RC_OK
+
+
+def profile_memory():
+    """Takes a snapshot of memory allocations and prints the biggest
+    differences from the previous snapshot.
+
+    Tracing of allocations starts with the first snapshot and is stopped by
+    /notify_send profile stop.
+    """
+    global MEMORY_SNAPSHOT
+    try:
+        import tracemalloc
+    except ImportError:
+        # For example, PyPy does not have tracemalloc.
+        print_error('tracemalloc is not available')
+        return weechat.WEECHAT_RC_ERROR
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        MEMORY_SNAPSHOT = None
+    snapshot = tracemalloc.take_snapshot()
+    if MEMORY_SNAPSHOT is None:
+        weechat.prnt('', '{}: tracing memory allocations, run the command again '
+                         'to see what has changed'.format(SCRIPT_NAME))
+    else:
+        for stat in snapshot.compare_to(MEMORY_SNAPSHOT, 'lineno')[:MEMORY_DIFF_PRINT_LIMIT]:
+            weechat.prnt('', '{}: {}'.format(SCRIPT_NAME, stat))
+    MEMORY_SNAPSHOT = snapshot
+    return weechat.WEECHAT_RC_OK
+
+
+def profile_memory_stop():
+    """Stops tracing memory allocations (when started by profile_memory())."""
+    global MEMORY_SNAPSHOT
+    if MEMORY_SNAPSHOT is None:
+        return
+    import tracemalloc
+    tracemalloc.stop()
+    MEMORY_SNAPSHOT = None
+
+
+def profile_command(buffer, args):
+    """Handles /notify_send profile start [every <n>] [for <duration>]|stop|
+    dump|memory.
+    """
+    action, _, args = args.partition(' ')
+    if action == 'start':
+        # The arguments are pairs of a name and a value.
+        words = args.split()
+        options = dict(zip(words[::2], words[1::2]))
+        every = options.pop('every', '1')
+        duration = parse_duration(options.pop('for', '0s'))
+        if (len(words) % 2 or options or not every.isdigit() or int(every) < 1 or
+                duration is None):
+            print_error('invalid arguments: {}'.format(args))
+            return weechat.WEECHAT_RC_ERROR
+        profile_start(int(every), duration)
+        weechat.prnt('', '{}: profiling started'.format(SCRIPT_NAME))
+    elif action == 'stop':
+        profile_memory_stop()
+        profiler = profile_stop()
+        if profiler is not None:
+            return profile_dump(profiler)
+        weechat.prnt('', '{}: profiling stopped'.format(SCRIPT_NAME))
+    elif action == 'dump':
+        if PROFILER is None:
+            print_error('profiling is not running (use /notify_send profile start)')
+            return weechat.WEECHAT_RC_ERROR
+        return profile_dump(PROFILER)
+    elif action == 'memory':
+        return profile_memory()
+    else:
+        print_error('invalid argument: {}'.format(action or '""'))
+        return weechat.WEECHAT_RC_ERROR
+    return weechat.WEECHAT_RC_OK
+
+
+# Maximal number of notifications printed by /notify_send history.
+HISTORY_PRINT_LIMIT = 100
+
+
+def history_command(buffer, args):
+    """Handles /notify_send history [filter]."""
+    if NOTIFICATION_HISTORY is None:
+        print_error('history is disabled (set plugins.var.python.{}.history_size '
+                    'to a positive number to enable it)'.format(SCRIPT_NAME))
+        return weechat.WEECHAT_RC_ERROR
+
+    text = args.lower()
+    entries = [
+        entry for entry in NOTIFICATION_HISTORY.entries()
+        if not text or
+        text in entry[2].lower() or text in entry[3].lower() or text in entry[4].lower()
+    ]
+    if not entries:
+        weechat.prnt('', '{}: no matching notifications'.format(SCRIPT_NAME))
+    for notification_time, _, buffer_name, nick, message in entries[-HISTORY_PRINT_LIMIT:]:
+        weechat.prnt('', '{}  {}  {}: {}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(notification_time)),
+            buffer_name,
+            nick,
+            message
+        ))
+    return weechat.WEECHAT_RC_OK
+
+
+def linted_patterns():
+    """Returns a list of (option, pattern, sample texts) triples for regular
+    expressions from the options.
+    """
+    patterns = [
+        ('notify_on_messages_that_match', pattern, LINT_SAMPLE_MESSAGES)
+        for pattern in split_option_value('notify_on_messages_that_match')
+    ]
+    for option in ['notify_on_all_messages_in_buffers_that_match',
+                   'hide_messages_in_buffers_that_match']:
+        patterns.extend(
+            (option, pattern, LINT_SAMPLE_BUFFER_NAMES)
+            for pattern in split_option_value(option)
+        )
+    if NOTIFICATION_RULES is not None:
+        for rule in NOTIFICATION_RULES.rules:
+            patterns.extend(
+                (rule.name, pattern, LINT_SAMPLE_MESSAGES)
+                for pattern in rule.message_patterns
+            )
+    return patterns
+
+
+def pattern_risks(pattern):
+    """Returns a list of descriptions of constructs in the given regular
+    expression that may make it backtrack catastrophically.
+    """
+    risks = []
+    find_pattern_risks(sre_parse.parse(pattern_text(pattern)), False, risks)
+    # Report every kind of risk only once.
+    return sorted(set(risks))
+
+
+def find_pattern_risks(subpattern, in_repeat, risks):
+    """Looks for risky constructs in the given parsed regular expression.
+
+    in_repeat says whether the subpattern is repeated (by a quantifier that
+    allows more than one repetition).
+    """
+    for op, av in subpattern:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            _, max_count, item = av
+            unbounded = max_count == sre_constants.MAXREPEAT
+            if in_repeat and unbounded:
+                risks.append('nested quantifiers (e.g. (a+)+)')
+            if unbounded and branches_may_overlap(item):
+                risks.append('quantified alternatives that can match the same '
+                             'text (e.g. (.|a)*)')
+            find_pattern_risks(item, in_repeat or max_count > 1, risks)
+        elif op == sre_constants.SUBPATTERN:
+            find_pattern_risks(av[-1], in_repeat, risks)
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                find_pattern_risks(branch, in_repeat, risks)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            find_pattern_risks(av[1], in_repeat, risks)
+        elif op == sre_constants.GROUPREF_EXISTS:
+            for branch in av[1:]:
+                if branch is not None:
+                    find_pattern_risks(branch, in_repeat, risks)
+        # Possessive quantifiers and atomic groups (Python >= 3.11) do not
+        # backtrack, so there is nothing risky inside them.
+
+
+def branches_may_overlap(subpattern):
+    """Can two alternatives directly in the given parsed regular expression
+    start by matching the same character?
+
+    Only alternatives starting with different literal characters are known
+    not to overlap.
+    """
+    items = list(subpattern)
+    while len(items) == 1 and items[0][0] == sre_constants.SUBPATTERN:
+        items = list(items[0][1][-1])
+    if len(items) != 1 or items[0][0] != sre_constants.BRANCH:
+        return False
+
+    first_characters = set()
+    for branch in items[0][1][1]:
+        if not branch or branch[0][0] != sre_constants.LITERAL:
+            return True
+        if branch[0][1] in first_characters:
+            return True
+        first_characters.add(branch[0][1])
+    return False
+
+
+def pattern_cost(pattern, texts):
+    """Returns the average time (in seconds) that the given regular
+    expression takes to search the given texts.
+    """
+    compiled = re.compile(pattern)
+    rounds = 20
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            compiled.search(text)
+    return (time.perf_counter() - start_time) / (rounds * len(texts))
+
+
+def crafted_texts_cost(pattern):
+    """Returns a pair (time in seconds, text) for the crafted text that took
+    the given regular expression the longest to search.
+
+    Crafted texts are runs of a single character (taken from the regular
+    expression, where possible) ended by a character that makes the match
+    fail at the very end, which is where catastrophic backtracking shows.
+    """
+    compiled = re.compile(pattern)
+    characters = []
+    for character in re.sub(r'[^\w ]', '', compiled.pattern) + 'a 0':
+        if character not in characters:
+            characters.append(character)
+    worst_time, worst_text = 0.0, ''
+    for character in characters[:6]:
+        for length in LINT_CRAFTED_TEXT_LENGTHS:
+            text = character * length + '!'
+            start_time = time.perf_counter()
+            compiled.search(text)
+            duration = time.perf_counter() - start_time
+            if duration > worst_time:
+                worst_time, worst_text = duration, text
+            if duration > LINT_SLOW_MATCH_TIME:
+                break
+    return worst_time, worst_text
+
+
+def lint_command(buffer, args):
+    """Handles /notify_send lint."""
+    patterns = linted_patterns()
+    if not patterns:
+        weechat.prnt('', '{}: no regular expressions in the options'.format(SCRIPT_NAME))
+    for option, pattern, texts in patterns:
+        text = pattern_text(pattern)
+        try:
+            risks = pattern_risks(pattern)
+            worst_time, worst_text = crafted_texts_cost(pattern)
+        except re.error as ex:
+            weechat.prnt('', '{}{}: {}: invalid regular expression: {}'.format(
+                weechat.prefix('error'), option, text, ex))
+            continue
+
+        if worst_time > LINT_SLOW_MATCH_TIME:
+            risks.append('took {:.1f} ms on a crafted text of {} characters ({!r})'.format(
+                worst_time * 1000, len(worst_text), worst_text[:8] + '...'))
+        # A risky pattern may backtrack catastrophically on the (long) sample
+        # texts, and a single search cannot be interrupted, so do not measure
+        # it at all.
+        if risks:
+            cost = 'not measured on sample texts'
+        else:
+            cost = '{:.2f} us per message'.format(pattern_cost(pattern, texts) * 1e6)
+        if pattern in SLOW_PATTERNS:
+            risks.append('disabled because it took longer than regex_time_budget')
+        weechat.prnt('', '{}{}: {}: {}{}'.format(
+            weechat.prefix('error') if risks else '',
+            option,
+            text,
+            cost,
+            ''.join('\n  - ' + risk for risk in risks)
+        ))
+    return weechat.WEECHAT_RC_OK
+
+
+# Subcommands of /notify_send.
+SUBCOMMANDS = {
+    'dnd': dnd_command,
+    'focus': focus_command,
+    'history': history_command,
+    'lint': lint_command,
+    'profile': profile_command,
+    'shadow': shadow_command,
+    'snooze': snooze_command,
+    'stats': stats_command,
+    'why': why_command,
+}
+
+
+def shutdown_callback():
+    """A callback when the script is unloaded."""
+    global NOTIFICATION_HISTORY
+    if NOTIFICATION_HISTORY is not None:
+        NOTIFICATION_HISTORY.close()
+        NOTIFICATION_HISTORY = None
+    stop_focus_reporting()
+    stop_action_monitor()
+    profile_stop()
+    profile_memory_stop()
+    return weechat.WEECHAT_RC_OK
+
+
+def command_callback(data, buffer, args):
+    """A callback for the /notify_send command."""
+    subcommand, _, subcommand_args = args.strip().partition(' ')
+    handler = SUBCOMMANDS.get(subcommand)
+    if handler is None:
+        print_error('unknown subcommand: {}'.format(subcommand or '""'))
+        return weechat.WEECHAT_RC_ERROR
+    return handler(buffer, subcommand_args.strip())
+
+
+def main():
+    """Registers and initializes the script."""
+    global CURRENT_BUFFER
+
     # Registration.
     weechat.register(
         SCRIPT_NAME,
@@ -810,6 +4036,55 @@ if __name__ == '__main__':
         if not weechat.config_is_set_plugin(option):
             weechat.config_set_plugin(option, default_value)
 
-    # Catch all messages on all buffers and strip colors from them before
-    # passing them into the callback.
-    weechat.hook_print('', '', '', 1, 'message_printed_callback', '')
+    hook_notifications()
+
+    weechat.hook_config('plugins.var.python.{}.*'.format(SCRIPT_NAME),
+                        'config_changed_callback', '')
+    apply_config()
+    apply_quiet_hours_config()
+    weechat.hook_signal('buffer_renamed', 'buffer_changed_callback', '')
+    weechat.hook_signal('buffer_closed', 'buffer_changed_callback', '')
+    weechat.hook_signal('buffer_switch', 'focus_changed_callback', '')
+    weechat.hook_signal('window_switch', 'focus_changed_callback', '')
+    weechat.hook_signal('*_script_loaded', 'script_loaded_callback', '')
+    weechat.hook_signal('*_script_unloaded', 'script_loaded_callback', '')
+    refresh_modifier_hooks()
+    CURRENT_BUFFER = weechat.current_buffer()
+
+    weechat.hook_command(
+        SCRIPT_NAME,
+        SCRIPT_DESC,
+        'dnd [on|off] || snooze <duration> || history [<text>] || why [<count>] '
+        '|| focus in|out || lint || profile start [every <n>] [for <duration>]|stop|dump|memory '
+        '|| shadow [reset] || stats',
+        '    dnd: turn do-not-disturb on or off (without argument: show its status)\n'
+        ' snooze: turn do-not-disturb on for the given duration '
+        '(e.g. 90s, 30m, 1h30m; a number means minutes)\n'
+        'history: show sent notifications, optionally only those whose buffer, '
+        'nick, or message contains the given text (requires option history_size)\n'
+        '    why: show why recent messages were (not) notified '
+        '(requires option trace_size)\n'
+        '  focus: tell the script that the terminal gained or lost focus '
+        '(bound to keys sent by the terminal when focus reporting is needed)\n'
+        '   lint: check regular expressions in the options for catastrophic '
+        'backtracking and show how long they take to match a message\n'
+        'profile: profile handling of messages (start: every n-th message, for '
+        'the given duration; stop or dump: write the profile into WeeChat\'s data '
+        'directory) or show how memory allocations changed since the last '
+        '"profile memory"\n'
+        ' shadow: show how decisions of the shadow profile differed from '
+        'decisions of the options (requires option shadow_profile), optionally '
+        'after resetting the counters\n'
+        '  stats: show the current delay between notifications from buffers '
+        '(see options min_notification_delay and max_notification_delay)\n'
+        '\n'
+        'During do-not-disturb, messages are not processed at all.',
+        'dnd on|off || snooze || history || why || focus in|out || lint '
+        '|| profile start|stop|dump|memory || shadow reset || stats',
+        'command_callback',
+        ''
+    )
+
+
+if __name__ == '__main__':
+    main()
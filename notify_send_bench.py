@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# Project:     weechat-notify-send
+# Homepage:    https://github.com/s3rvac/weechat-notify-send
+# Description: Benchmarks for the project.
+# License:     MIT (see below)
+#
+# Copyright (c) 2015 by Petr Zemek <s3rvac@gmail.com> and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Usage:
+#
+#     python notify_send_bench.py [--output results.json]
+#     python notify_send_bench.py --baseline results.json [--threshold 10]
+#
+# Micro benchmarks measure the per-call cost of the functions on the hot path
+# (in nanoseconds). Macro benchmarks push synthetic lines through
+# message_printed_callback() with realistic configurations and measure the
+# throughput (in lines per second). The runtime benchmark loads the script into
+# the fake WeeChat and prints lines into buffers, so they are dispatched through
+# the hooks of the script, like in WeeChat. Nothing is sent; notify-send is
+# replaced by a stub.
+#
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import timeit
+
+from fake_weechat import FakeWeechat
+
+
+class StubSubprocess(object):
+    """A stand-in for the subprocess module that does not run anything."""
+
+    STDOUT = -2
+
+    @staticmethod
+    def check_output(cmd, **kwargs):
+        return '1\n'
+
+
+weechat = FakeWeechat()
+sys.modules['weechat'] = weechat
+
+import notify_send  # noqa: E402
+
+notify_send.subprocess = StubSubprocess
+
+
+def configure(**options):
+    """Resets the configuration to the defaults updated with the given options."""
+    weechat.config = {
+        option: default for option, (default, _) in notify_send.OPTIONS.items()
+    }
+    # Do not throttle notifications, so every matching line gets formatted.
+    weechat.config['min_notification_delay'] = '0'
+    weechat.config.update(options)
+    notify_send.apply_config()
+
+
+def create_buffers(count, rnd):
+    """Creates the given number of buffers and returns their pointers."""
+    weechat.buffers = {}
+    pointers = []
+    for i in range(count):
+        pointer = '0x{:x}'.format(0x100000 + i)
+        if i % 10 == 0:
+            nick = 'user{}'.format(i)
+            weechat.add_buffer(pointer, 'irc.libera.' + nick, nick,
+                               type='private', nick='me', server='libera')
+        else:
+            channel = '#channel{}'.format(i)
+            weechat.add_buffer(pointer, 'irc.libera.' + channel, channel,
+                               type='channel', nick='me', server='libera')
+        pointers.append(pointer)
+    weechat.current = pointers[-1]
+    return pointers
+
+
+WORDS = ('the', 'build', 'is', 'broken', 'again', 'deploy', 'me', 'lunch',
+         'https://example.com/some/long/path?query=1', '<b>html</b>', 'x & y')
+
+
+def generate_lines(count, buffers, rnd):
+    """Generates the given number of callback argument tuples."""
+    lines = []
+    for _ in range(count):
+        buffer = rnd.choice(buffers)
+        nick = 'nick{}'.format(rnd.randrange(200))
+        tags = 'irc_privmsg,notify_message,prefix_nick_white,nick_{},log1'.format(nick)
+        message = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randrange(3, 30)))
+        is_highlight = '1' if rnd.random() < 0.05 else '0'
+        lines.append(('', buffer, '0', tags, '1', is_highlight, nick, message))
+    return lines
+
+
+def bench_micro(name, stmt, number):
+    """Measures the per-call cost of the given callable (in nanoseconds)."""
+    timer = timeit.Timer(stmt)
+    best = min(timer.repeat(repeat=5, number=number))
+    return name, {'ns_per_call': best / number * 1e9}
+
+
+def run_micro_benchmarks(number):
+    """Runs micro benchmarks of the functions on the hot path."""
+    rnd = random.Random(0)
+    configure(ignore_nicks='-,--,-->,bot1,bot2',
+              notify_on_messages_that_match='deploy failed,build broken')
+    buffers = create_buffers(100, rnd)
+    buffer = buffers[1]
+    args = generate_lines(1, [buffer], rnd)[0]
+    tags = notify_send.parse_tags(args[3])
+    long_message = 'x & <y> ' * 1000
+    message = 'nick: the build is <b>broken</b> & deploy again'
+
+    return dict([
+        bench_micro(
+            'micro.message_printed_callback',
+            lambda: notify_send.message_printed_callback(*args),
+            number
+        ),
+        bench_micro(
+            'micro.notification_should_be_sent',
+            lambda: notify_send.notification_should_be_sent(
+                buffer, tags, 'nick', 1, 1, args[7]
+            ),
+            number
+        ),
+        bench_micro(
+            'micro.prepare_notification',
+            lambda: notify_send.prepare_notification(buffer, 'nick', args[7]),
+            number
+        ),
+        bench_micro(
+            'micro.shorten_message',
+            lambda: notify_send.shorten_message(long_message, 72, '[..]'),
+            number
+        ),
+        bench_micro(
+            'micro.escape_html',
+            lambda: notify_send.escape_html(message),
+            number
+        ),
+        bench_micro(
+            'micro.escape_html_long_message',
+            lambda: notify_send.escape_html(long_message),
+            max(number // 100, 1)
+        ),
+        bench_micro(
+            'micro.format_message_long_message',
+            lambda: notify_send.format_message(long_message, 72, '[..]', True),
+            number
+        ),
+    ])
+
+
+# Configurations for the macro benchmarks: name -> (buffer count, options).
+MACRO_CONFIGS = {
+    'default': (50, {}),
+    'long_ignore_lists': (50, {
+        'ignore_nicks': ','.join('ignored{}'.format(i) for i in range(500)),
+        'ignore_nicks_starting_with': ','.join('bot{}'.format(i) for i in range(100)),
+        'ignore_buffers': ','.join('#ignored{}'.format(i) for i in range(500)),
+        'ignore_buffers_starting_with': ','.join('irc.oftc.{}'.format(i) for i in range(100)),
+    }),
+    'many_regexes': (50, {
+        'notify_on_messages_that_match': ','.join(
+            r'\bkeyword{}\b'.format(i) for i in range(50)
+        ),
+        'notify_on_all_messages_in_buffers_that_match': ','.join(
+            r'^irc\.server{}\.'.format(i) for i in range(50)
+        ),
+    }),
+    'shadow_profile': (50, {
+        'shadow_profile': 'strict',
+        'shadow.strict.ignore_nicks': ','.join('nick{}'.format(i) for i in range(100)),
+        'shadow.strict.notify_on_messages_that_match': r'\bdeploy\b',
+    }),
+    'many_buffers': (5000, {
+        'notify_on_all_messages_in_buffers': ','.join(
+            '#channel{}'.format(i) for i in range(1, 5000, 50)
+        ),
+    }),
+}
+
+
+def run_macro_benchmarks(line_count):
+    """Measures end-to-end throughput with realistic configurations."""
+    results = {}
+    for name, (buffer_count, options) in sorted(MACRO_CONFIGS.items()):
+        rnd = random.Random(0)
+        configure(**options)
+        buffers = create_buffers(buffer_count, rnd)
+        lines = generate_lines(line_count, buffers, rnd)
+        callback = notify_send.message_printed_callback
+
+        start = time.perf_counter()
+        for line in lines:
+            callback(*line)
+        elapsed = time.perf_counter() - start
+
+        results['macro.' + name] = {'lines_per_sec': line_count / elapsed}
+    return results
+
+
+def run_runtime_benchmark(line_count):
+    """Measures the throughput of lines printed into the fake WeeChat with the
+    script loaded.
+    """
+    rnd = random.Random(0)
+    configure()
+    buffers = create_buffers(50, rnd)
+    lines = [
+        (buffer, message, nick, tuple(tags.split(',')), int(is_highlight))
+        for _, buffer, _, tags, _, is_highlight, nick, message
+        in generate_lines(line_count, buffers, rnd)
+    ]
+    weechat.load_script(notify_send)
+    print_line = weechat.print_line
+
+    start = time.perf_counter()
+    for buffer, message, nick, tags, is_highlight in lines:
+        print_line(buffer, message, nick, tags, highlight=is_highlight)
+    elapsed = time.perf_counter() - start
+
+    weechat.unload_script()
+    return {'macro.runtime_default': {'lines_per_sec': line_count / elapsed}}
+
+
+def compare(results, baseline, threshold):
+    """Compares the given results with a baseline.
+
+    Returns a list of (name, metric, baseline value, new value, change in
+    percent, is regression) tuples.
+    """
+    comparison = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            old_value = baseline.get(name, {}).get(metric)
+            if not old_value:
+                continue
+            change = (value - old_value) / old_value * 100
+            # For costs, higher is worse. For throughputs, lower is worse.
+            worse = change if metric.startswith('ns_') else -change
+            comparison.append(
+                (name, metric, old_value, value, change, worse > threshold)
+            )
+    return comparison
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the hot paths of notify_send.py.'
+    )
+    parser.add_argument('-o', '--output',
+                        help='write the results as JSON into the given file')
+    parser.add_argument('-b', '--baseline',
+                        help='compare the results with a stored JSON baseline')
+    parser.add_argument('-t', '--threshold', type=float, default=10.0,
+                        help='slowdown (in percent) that is reported as a '
+                             'regression (default: %(default)s)')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='run fewer iterations (less precise results)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    number = 2000 if args.quick else 20000
+    line_count = 5000 if args.quick else 50000
+    results = run_micro_benchmarks(number)
+    results.update(run_macro_benchmarks(line_count))
+    results.update(run_runtime_benchmark(line_count))
+
+    output = {
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = 0
+    for name, metric, old, new, change, regression in compare(
+            results, baseline, args.threshold):
+        regressions += regression
+        print('{:<45} {:>14.1f} -> {:>14.1f} {:>+7.1f}%{}'.format(
+            name + ' (' + metric + ')', old, new, change,
+            '  REGRESSION' if regression else ''
+        ), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+#
+# Project:     weechat-notify-send
+# Homepage:    https://github.com/s3rvac/weechat-notify-send
+# Description: Integration tests of the script against a fake WeeChat.
+# License:     MIT (see below)
+#
+# Copyright (c) 2015 by Petr Zemek <s3rvac@gmail.com> and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import copy
+import sys
+import time
+import unittest
+from unittest import mock
+
+from fake_weechat import FakeWeechat
+from fake_weechat import VirtualClock
+
+sys.modules.setdefault('weechat', FakeWeechat())
+
+import notify_send
+
+
+class TestsBase(unittest.TestCase):
+    """A base class for all tests.
+
+    Every test loads the script into a fresh fake WeeChat, so the script runs
+    like in WeeChat: from registration through hooks to notify-send.
+    """
+
+    def setUp(self):
+        # Loading the script changes its global state, so restore it to not
+        # affect other tests.
+        orig_globals = {
+            name: copy.copy(value) if isinstance(value, (dict, list, set)) else value
+            for name, value in vars(notify_send).items()
+            if name.isupper() or name in ('weechat', 'time', 'subprocess')
+        }
+        self.addCleanup(vars(notify_send).update, orig_globals)
+
+        self.clock = VirtualClock(1000.0)
+        self.weechat = FakeWeechat(self.clock)
+        self.weechat.add_buffer('0x1', 'irc.libera.#chan', '#chan',
+                                type='channel', nick='me', server='libera')
+        self.weechat.add_buffer('0x2', 'irc.libera.john', 'john',
+                                type='private', nick='me', server='libera')
+        self.weechat.current = '0x1'
+        notify_send.weechat = self.weechat
+        notify_send.time = self.clock
+        notify_send.subprocess = mock.Mock()
+        notify_send.subprocess.check_output.return_value = '1\n'
+
+    def load_script(self, **options):
+        self.weechat.config.update(options)
+        self.weechat.load_script(notify_send)
+
+    def sent_messages(self):
+        return [
+            call[0][0][-1]
+            for call in notify_send.subprocess.check_output.call_args_list
+        ]
+
+
+class LoadScriptTests(TestsBase):
+    """Tests for loading and unloading the script."""
+
+    def test_sets_default_values_of_options(self):
+        self.load_script()
+
+        self.assertEqual(self.weechat.config['engine'], 'print')
+        self.assertIn('Default: print.', self.weechat.descriptions['engine'])
+
+    def test_keeps_values_of_options_that_are_set(self):
+        self.load_script(engine='signals')
+
+        self.assertEqual(self.weechat.config['engine'], 'signals')
+
+    def test_unloading_removes_all_hooks(self):
+        self.load_script()
+
+        self.weechat.unload_script()
+
+        self.assertEqual(self.weechat.hooks, {})
+
+
+class NotificationTests(TestsBase):
+    """Tests for notifications of printed lines."""
+
+    def test_notifies_about_highlight_in_other_buffer(self):
+        self.load_script(min_notification_delay='0')
+
+        self.weechat.print_line('0x2', 'hi there', 'john',
+                                ('notify_private', 'nick_john'))
+
+        self.assertEqual(self.sent_messages(), ['hi there'])
+
+    def test_does_not_notify_about_message_in_current_buffer(self):
+        self.load_script(notify_for_current_buffer='off')
+
+        self.weechat.print_line('0x1', 'me: hi', 'john',
+                                ('notify_message', 'nick_john'), highlight=1)
+
+        self.assertEqual(self.sent_messages(), [])
+
+    def test_notifies_about_message_in_buffer_that_is_no_longer_current(self):
+        self.load_script(notify_for_current_buffer='off', min_notification_delay='0')
+        self.weechat.switch_to_buffer('0x2')
+
+        self.weechat.print_line('0x1', 'me: hi', 'john',
+                                ('notify_message', 'nick_john'), highlight=1)
+
+        self.assertEqual(self.sent_messages(), ['john: me: hi'])
+
+    def test_changed_option_is_applied(self):
+        self.load_script(min_notification_delay='0')
+
+        self.weechat.config_set_plugin('ignore_nicks', 'john')
+        self.weechat.print_line('0x2', 'hi', 'john', ('notify_private', 'nick_john'))
+
+        self.assertEqual(self.sent_messages(), [])
+
+    def test_min_notification_delay_follows_virtual_time(self):
+        self.load_script(min_notification_delay='500')
+
+        self.weechat.print_line('0x2', 'first', 'john', ('notify_private', 'nick_john'))
+        self.weechat.print_line('0x2', 'second', 'john', ('notify_private', 'nick_john'))
+        self.weechat.advance(1)
+        self.weechat.print_line('0x2', 'third', 'john', ('notify_private', 'nick_john'))
+
+        self.assertEqual(self.sent_messages(), ['first', 'third'])
+
+    def test_adaptive_notification_delay_backs_off_and_recovers(self):
+        self.load_script(min_notification_delay='500', max_notification_delay='4000')
+
+        for i in range(20):
+            self.weechat.print_line('0x2', 'line{}'.format(i), 'john',
+                                    ('notify_private', 'nick_john'))
+            self.weechat.advance(0.6)
+        self.weechat.advance(60)
+        self.weechat.print_line('0x2', 'back', 'john', ('notify_private', 'nick_john'))
+        self.weechat.advance(0.6)
+        self.weechat.print_line('0x2', 'again', 'john', ('notify_private', 'nick_john'))
+
+        self.assertEqual(
+            self.sent_messages(),
+            ['line0', 'line1', 'line3', 'line7', 'line14', 'back', 'again']
+        )
+
+    def test_signals_engine_finds_buffer_of_line(self):
+        self.load_script(engine='signals', min_notification_delay='0')
+
+        self.weechat.print_line('0x2', 'hi', 'john', ('notify_private', 'nick_john'))
+
+        self.assertEqual(self.sent_messages(), ['hi'])
+
+    def test_signals_engine_finds_buffer_of_line_with_colored_prefix(self):
+        self.load_script(engine='signals', min_notification_delay='0')
+
+        self.weechat.print_line('0x2', 'hi', '\x1901john', ('notify_private', 'nick_john'))
+
+        self.assertEqual(self.sent_messages(), ['hi'])
+
+    def test_signals_engine_skips_buffer_with_same_line_printed_earlier(self):
+        self.load_script(engine='signals', min_notification_delay='0')
+        self.weechat.print_line('0x1', 'hi', 'john', ('notify_message', 'nick_john'))
+        self.weechat.advance(10)
+
+        self.weechat.print_line('0x2', 'hi', 'john', ('notify_private', 'nick_john'))
+
+        self.assertEqual(self.sent_messages(), ['hi'])
+
+    def test_hotlist_engine_notifies_when_timer_fires(self):
+        self.load_script(engine='hotlist', min_notification_delay='0')
+
+        self.weechat.print_line('0x2', 'hi', 'john', ('notify_private', 'nick_john'))
+        self.assertEqual(self.sent_messages(), [])
+        self.weechat.advance(10)
+
+        self.assertEqual(self.sent_messages(), ['hi'])
+
+    def test_rules_decide_per_buffer(self):
+        self.weechat.add_buffer('0x3', 'irc.libera.#deploy', '#deploy',
+                                type='channel', nick='me', server='libera')
+        self.weechat.add_buffer('0x4', 'irc.libera.#random', '#random',
+                                type='channel', nick='me', server='libera')
+        self.load_script(min_notification_delay='0')
+        self.weechat.config_set_plugin('rule.1', 'buffer=#deploy nick=*bot -> notify')
+        self.weechat.config_set_plugin('rule.2', 'buffer=#deploy -> drop')
+        self.weechat.config_set_plugin('rule.3', 'buffer=#random message=lunch -> notify')
+        self.weechat.config_set_plugin('rule.4', 'buffer=#random -> drop')
+
+        self.weechat.print_line('0x3', 'deployed', 'ci-bot', ('nick_ci-bot',))
+        self.weechat.print_line('0x3', 'me: ping', 'john', ('nick_john',), highlight=1)
+        self.weechat.print_line('0x4', 'lunch?', 'john', ('nick_john',))
+        self.weechat.print_line('0x4', 'me: hi', 'john', ('nick_john',), highlight=1)
+
+        self.assertEqual(self.sent_messages(), ['ci-bot: deployed', 'john: lunch?'])
+
+
+class CommandTests(TestsBase):
+    """Tests for the /notify_send command."""
+
+    def test_snooze_suppresses_notifications_until_it_expires(self):
+        self.load_script(min_notification_delay='0')
+
+        self.weechat.command('', '/notify_send snooze 1m')
+        self.weechat.print_line('0x2', 'during', 'john', ('notify_private', 'nick_john'))
+        self.weechat.advance(61)
+        self.weechat.print_line('0x2', 'after', 'john', ('notify_private', 'nick_john'))
+
+        self.assertEqual(self.sent_messages(), ['after'])
+
+    def test_dnd_stopped_within_quiet_hours_stays_stopped_when_option_changes(self):
+        self.clock.now = time.mktime((2024, 1, 2, 12, 30, 0, 0, 0, -1))
+        self.load_script(min_notification_delay='0', quiet_hours='12:00-13:00')
+
+        self.weechat.command('', '/notify_send dnd off')
+        self.weechat.config_set_plugin('nick_separator', ' > ')
+        self.weechat.print_line('0x2', 'hi', 'john', ('notify_private', 'nick_john'))
+
+        self.assertEqual(self.sent_messages(), ['hi'])
+
+
+class FocusTests(TestsBase):
+    """Tests for focus reporting of the terminal."""
+
+    def test_focus_reporting_is_off_when_current_buffer_is_not_notified(self):
+        self.load_script(notify_for_current_buffer='off')
+
+        self.assertEqual(self.weechat.commands, [])
+        self.assertEqual(self.weechat.keys, {})
+
+    def test_bindings_of_keys_are_restored_when_script_is_unloaded(self):
+        self.weechat.keys['meta2-I'] = '/my_command'
+        self.load_script(notify_only_when_terminal_unfocused='on')
+
+        self.assertEqual(self.weechat.keys, {
+            'meta2-I': '/notify_send focus in',
+            'meta2-O': '/notify_send focus out',
+        })
+
+        self.weechat.unload_script()
+
+        self.assertEqual(self.weechat.keys, {'meta2-I': '/my_command'})
+
+
+class FakeWeechatTests(unittest.TestCase):
+    """Tests for the fake WeeChat itself."""
+
+    def setUp(self):
+        self.weechat = FakeWeechat()
+        self.script = mock.Mock()
+        self.script.callback.return_value = self.weechat.WEECHAT_RC_OK
+        self.weechat.script = self.script
+
+    def test_hdata_walks_buffers_in_order_after_they_change(self):
+        self.weechat.add_buffer('0x1', 'core.weechat', 'weechat')
+        self.weechat.add_buffer('0x2', 'irc.libera.#a', '#a')
+        self.assertEqual(self.weechat.hdata_move('buffer', '0x1', 1), '0x2')
+        self.weechat.add_buffer('0x3', 'irc.libera.#b', '#b')
+        self.weechat.buffers.pop('0x2')
+        self.weechat.buffers.setdefault('0x4', {})
+
+        pointers = []
+        pointer = self.weechat.hdata_get_list('buffer', 'gui_buffers')
+        while pointer:
+            pointers.append(pointer)
+            pointer = self.weechat.hdata_move('buffer', pointer, 1)
+
+        self.assertEqual(pointers, ['0x1', '0x3', '0x4'])
+        self.assertEqual(self.weechat.hdata_move('buffer', '0x1', -1), '')
+
+    def test_timer_with_max_calls_is_removed_after_last_call(self):
+        self.weechat.hook_timer(1000, 0, 2, 'callback', '')
+
+        self.weechat.advance(5)
+
+        self.assertEqual(self.script.callback.call_args_list,
+                         [mock.call('', '1'), mock.call('', '0')])
+        self.assertEqual(self.weechat.hooks, {})
+
+    def test_process_callback_is_called_after_latency(self):
+        self.weechat.process_handler = lambda command, options: (0, 'out', '')
+        self.weechat.process_latency = 2
+        self.weechat.hook_process('cmd', 0, 'callback', 'data')
+
+        self.weechat.advance(1)
+        self.assertFalse(self.script.callback.called)
+        self.weechat.advance(1)
+
+        self.script.callback.assert_called_once_with('data', 'cmd', 0, 'out', '')
+
+    def test_running_process_can_be_fed_output(self):
+        self.weechat.process_handler = lambda command, options: None
+        hook = self.weechat.hook_process_hashtable('cmd', {}, 0, 'callback', '')
+
+        self.weechat.process_output(hook, 'line\n')
+
+        self.script.callback.assert_called_once_with('', 'cmd', -1, 'line\n', '')
+        self.assertIn(hook, self.weechat.hooks)
+
+    def test_signals_are_matched_with_masks(self):
+        self.weechat.hook_signal('*,irc_in2_privmsg', 'callback', '')
+
+        self.weechat.hook_signal_send('libera,irc_in2_privmsg', 'string', 'x')
+
+        self.script.callback.assert_called_once_with(
+            '', 'libera,irc_in2_privmsg', 'x'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
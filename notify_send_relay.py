@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+#
+# Project:     weechat-notify-send
+# Homepage:    https://github.com/s3rvac/weechat-notify-send
+# Description: Sends local notifications for a remote WeeChat via its relay.
+# License:     MIT (see below)
+#
+# Copyright (c) 2015 by Petr Zemek <s3rvac@gmail.com> and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Usage:
+#
+#     WEECHAT_RELAY_PASSWORD=secret python notify_send_relay.py [options] HOST PORT
+#
+# Connects to the relay of a remote WeeChat (the "weechat" protocol, see
+# https://weechat.org/doc/weechat/relay/), receives every line that is added
+# to a buffer, and runs it through the same rules and formatting as the script
+# does inside WeeChat. Matching lines are shown as notifications on the local
+# desktop. The remote WeeChat does not need to run the script at all. When the
+# connection drops, the client reconnects with an exponential backoff.
+#
+
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import re
+import ssl
+import struct
+import sys
+import zlib
+
+from fake_weechat import FakeWeechat
+
+weechat = FakeWeechat()
+sys.modules.setdefault('weechat', weechat)
+
+import notify_send  # noqa: E402
+from notify_send_replay import read_plugins_conf  # noqa: E402
+
+logger = logging.getLogger('notify_send_relay')
+
+# Options that need a running WeeChat and are therefore turned off.
+UNSUPPORTED_OPTIONS = {
+    'actions': 'off',
+    'engine': 'print',
+    'history_size': '0',
+    'quiet_hours': '',
+}
+
+# Commands that get all buffers and make the relay send changes of buffers and
+# added lines (as _buffer_line_added messages).
+SYNC_COMMANDS = (
+    '(listbuffers) hdata buffer:gui_buffers(*) '
+    'name,full_name,short_name,local_variables\n'
+    'sync * buffers,upgrade,buffer\n'
+)
+
+# Commands sent to the relay after connecting. Options of init are separated
+# by commas, so the password cannot contain a comma.
+INIT_COMMANDS = (
+    '(handshake) handshake password_hash_algo=plain,compression=off\n'
+    'init password={password},compression=off\n'
+) + SYNC_COMMANDS
+
+# Local variables of buffers that hold the state of the script. They exist
+# only in this process, so changes of buffers from the relay keep them.
+SCRIPT_LOCALVAR_PREFIX = 'localvar_notify_send_'
+
+# Maximal length of a message from the relay. A longer length means that the
+# stream is corrupted.
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+
+# Number of bytes read from the relay at once.
+READ_SIZE = 64 * 1024
+
+# A message from the relay: its ID and a list of decoded objects.
+RelayMessage = collections.namedtuple('RelayMessage', ['id', 'objects'])
+
+
+class RelayError(Exception):
+    """An error in communication with the relay."""
+
+
+class MessageReader(object):
+    """Decodes objects from the data of a single message."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def at_end(self):
+        return self.pos >= len(self.data)
+
+    def take(self, size):
+        if size < 0 or self.pos + size > len(self.data):
+            raise RelayError('truncated message')
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return chunk
+
+    def read_type(self):
+        return self.take(3).decode('ascii')
+
+    def read_chr(self):
+        return struct.unpack('>b', self.take(1))[0]
+
+    def read_int(self):
+        return struct.unpack('>i', self.take(4))[0]
+
+    def read_short_string(self):
+        # Used for long integers, pointers, and times.
+        return self.take(self.take(1)[0]).decode('ascii')
+
+    def read_lon(self):
+        return int(self.read_short_string())
+
+    def read_tim(self):
+        return int(self.read_short_string())
+
+    def read_ptr(self):
+        return '0x' + self.read_short_string()
+
+    def read_buf(self):
+        length = self.read_int()
+        if length < 0:
+            # NULL.
+            return None
+        return self.take(length)
+
+    def read_str(self):
+        value = self.read_buf()
+        return value.decode('utf-8', 'replace') if value is not None else None
+
+    def read_htb(self):
+        key_type = self.read_type()
+        value_type = self.read_type()
+        return dict(
+            (self.read_object(key_type), self.read_object(value_type))
+            for _ in range(self.read_int())
+        )
+
+    def read_hda(self):
+        path = (self.read_str() or '').split('/')
+        keys = [key.split(':') for key in (self.read_str() or '').split(',') if key]
+        items = []
+        for _ in range(self.read_int()):
+            item = {'__path': [self.read_ptr() for _ in path]}
+            for name, object_type in keys:
+                item[name] = self.read_object(object_type)
+            items.append(item)
+        return items
+
+    def read_inf(self):
+        return self.read_str(), self.read_str()
+
+    def read_inl(self):
+        self.read_str()  # The name of the infolist.
+        items = []
+        for _ in range(self.read_int()):
+            item = {}
+            for _ in range(self.read_int()):
+                name = self.read_str()
+                item[name] = self.read_object(self.read_type())
+            items.append(item)
+        return items
+
+    def read_arr(self):
+        object_type = self.read_type()
+        return [self.read_object(object_type) for _ in range(self.read_int())]
+
+    def read_object(self, object_type):
+        reader = getattr(self, 'read_' + object_type, None)
+        if reader is None:
+            raise RelayError('unknown object type: {!r}'.format(object_type))
+        return reader()
+
+
+def decode_message(data):
+    """Decodes the given (uncompressed) data of a message into a
+    RelayMessage.
+    """
+    reader = MessageReader(data)
+    message_id = reader.read_str()
+    objects = []
+    while not reader.at_end():
+        objects.append(reader.read_object(reader.read_type()))
+    return RelayMessage(message_id, objects)
+
+
+class RelayDecoder(object):
+    """An incremental decoder of the stream of messages from the relay.
+
+    Data can be fed in chunks of any size. Only the unprocessed rest of the
+    stream (at most one incomplete message) is kept.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Adds the given data and returns a list of RelayMessages that have
+        been completed by it.
+        """
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= 5:
+            length, compression = struct.unpack_from('>IB', self.buffer)
+            if length < 5 or length > MAX_MESSAGE_LENGTH:
+                raise RelayError('invalid message length: {}'.format(length))
+            if len(self.buffer) < length:
+                break
+            data = bytes(self.buffer[5:length])
+            del self.buffer[:length]
+            if compression == 1:
+                data = zlib.decompress(data)
+            elif compression != 0:
+                raise RelayError('unsupported compression: {}'.format(compression))
+            messages.append(decode_message(data))
+        return messages
+
+
+# Color codes in prefixes and messages of lines
+# (https://weechat.org/doc/weechat/relay/#message_colors).
+COLOR_ATTRS = r'[*!/_|]*'
+COLOR = r'(?:{0}\d{{2}}|@{0}\d{{5}})'.format(COLOR_ATTRS)
+COLOR_RE = re.compile(
+    r'\x19(?:'
+    r'F{0}|B(?:\d{{2}}|@\d{{5}})|\*{0}(?:[,~]{0})?|{0}|b.|E|\x1c'
+    r')|[\x1a\x1b].|\x1c'.format(COLOR),
+    re.DOTALL
+)
+
+
+def strip_colors(text):
+    """Removes color codes from the given text."""
+    return COLOR_RE.sub('', text or '')
+
+
+def setup_runtime(options):
+    """Makes the script run against the fake WeeChat with the given options."""
+    notify_send.weechat = weechat
+    weechat.config = {
+        option: default for option, (default, _) in notify_send.OPTIONS.items()
+    }
+    weechat.config.update(options)
+    weechat.config.update(UNSUPPORTED_OPTIONS)
+    weechat.buffers = {}
+    weechat.current = ''
+    notify_send.apply_config()
+
+
+class RelayNotifier(object):
+    """A client of the relay that sends notifications for received lines."""
+
+    def __init__(self, host, port, password='', ssl_context=None,
+                 min_backoff=1.0, max_backoff=60.0, ping_interval=60.0):
+        if ',' in password:
+            raise ValueError('the password of the relay cannot contain a comma')
+        self.host = host
+        self.port = port
+        self.password = password
+        self.ssl_context = ssl_context
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.ping_interval = ping_interval
+        self.handlers = {
+            'listbuffers': self.handle_buffer_list,
+            '_buffer_opened': self.handle_buffer_opened,
+            '_buffer_renamed': self.handle_buffer_changed,
+            '_buffer_localvar_added': self.handle_buffer_changed,
+            '_buffer_localvar_changed': self.handle_buffer_changed,
+            '_buffer_localvar_removed': self.handle_buffer_changed,
+            '_buffer_closing': self.handle_buffer_closing,
+            '_buffer_line_added': self.handle_line_added,
+            '_upgrade_ended': self.handle_upgrade_ended,
+        }
+        self.writer = None
+        self.received = False
+
+    async def run(self):
+        """Keeps a connection to the relay, reconnecting with an exponential
+        backoff when it drops.
+        """
+        backoff = self.min_backoff
+        while True:
+            self.received = False
+            try:
+                await self.session()
+            except (OSError, EOFError, RelayError, zlib.error) as ex:
+                logger.warning('connection to %s:%s failed: %s', self.host, self.port, ex)
+            if self.received:
+                # The connection worked, so start over with a short delay.
+                backoff = self.min_backoff
+            logger.info('reconnecting in %.1f s', backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def session(self):
+        """Connects to the relay and handles its messages until the connection
+        drops.
+        """
+        reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl_context
+        )
+        try:
+            self.send(INIT_COMMANDS.format(password=self.password))
+            await self.writer.drain()
+            decoder = RelayDecoder()
+            pinged = False
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE),
+                                                  self.ping_interval)
+                except asyncio.TimeoutError:
+                    if pinged:
+                        raise RelayError('no response to ping')
+                    self.send('ping\n')
+                    pinged = True
+                    continue
+                if not data:
+                    raise EOFError('connection closed by the relay')
+                pinged = False
+                for message in decoder.feed(data):
+                    self.received = True
+                    self.handle_message(message)
+        finally:
+            self.writer.close()
+            self.writer = None
+
+    def send(self, commands):
+        self.writer.write(commands.encode('utf-8'))
+
+    def handle_message(self, message):
+        handler = self.handlers.get(message.id)
+        if handler is not None:
+            for items in message.objects:
+                if isinstance(items, list):
+                    handler(items)
+
+    def handle_buffer_list(self, items):
+        for pointer in list(weechat.buffers):
+            notify_send.buffer_changed_callback('', 'buffer_closed', pointer)
+        weechat.buffers = {}
+        self.handle_buffer_opened(items)
+
+    def handle_buffer_opened(self, items):
+        for item in items:
+            pointer = item['__path'][0]
+            weechat.add_buffer(pointer, item.get('name') or '', item.get('short_name') or '')
+            self.handle_buffer_changed([item])
+
+    def handle_buffer_changed(self, items):
+        for item in items:
+            pointer = item['__path'][0]
+            properties = weechat.buffers.setdefault(pointer, {})
+            for name in ('name', 'full_name', 'short_name'):
+                if item.get(name) is not None:
+                    properties[name] = item[name]
+            local_variables = item.get('local_variables')
+            if local_variables is not None:
+                for name in [name for name in properties
+                             if name.startswith('localvar_') and
+                             not name.startswith(SCRIPT_LOCALVAR_PREFIX)]:
+                    del properties[name]
+                for name, value in local_variables.items():
+                    name = 'localvar_' + name
+                    if not name.startswith(SCRIPT_LOCALVAR_PREFIX):
+                        properties[name] = value or ''
+            notify_send.buffer_changed_callback('', 'buffer_renamed', pointer)
+
+    def handle_buffer_closing(self, items):
+        for item in items:
+            pointer = item['__path'][0]
+            weechat.buffers.pop(pointer, None)
+            notify_send.buffer_changed_callback('', 'buffer_closed', pointer)
+
+    def handle_line_added(self, items):
+        for item in items:
+            notify_send.message_printed_callback(
+                '',
+                item.get('buffer', ''),
+                str(item.get('date', 0)),
+                ','.join(item.get('tags_array') or []),
+                str(item.get('displayed', 1)),
+                str(item.get('highlight', 0)),
+                strip_colors(item.get('prefix')),
+                strip_colors(item.get('message'))
+            )
+
+    def handle_upgrade_ended(self, items):
+        # Buffers got new pointers, so get them again.
+        self.send(SYNC_COMMANDS)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Connects to the relay of a remote WeeChat and sends local '
+                    'notifications by using the rules of notify_send.py.'
+    )
+    parser.add_argument('host', help='host of the relay')
+    parser.add_argument('port', type=int, help='port of the relay')
+    parser.add_argument('-p', '--password-file', metavar='FILE',
+                        help='read the password of the relay from the given '
+                             'file (default: environment variable '
+                             'WEECHAT_RELAY_PASSWORD)')
+    parser.add_argument('-t', '--tls', action='store_true',
+                        help='connect via TLS')
+    parser.add_argument('-c', '--config', metavar='PLUGINS_CONF',
+                        help='read options of the script from plugins.conf')
+    parser.add_argument('-o', '--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='set an option of the script (may be repeated)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log connection attempts')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=logging.INFO if args.verbose else logging.WARNING
+    )
+
+    options = read_plugins_conf(args.config) if args.config else {}
+    for option in args.option:
+        name, sep, value = option.partition('=')
+        if not sep or name not in notify_send.OPTIONS:
+            sys.exit('invalid option: {}'.format(option))
+        options[name] = value
+    setup_runtime(options)
+
+    if args.password_file:
+        with open(args.password_file, encoding='utf-8') as f:
+            password = f.read().strip()
+    else:
+        password = os.environ.get('WEECHAT_RELAY_PASSWORD', '')
+
+    try:
+        notifier = RelayNotifier(
+            args.host,
+            args.port,
+            password,
+            ssl.create_default_context() if args.tls else None
+        )
+    except ValueError as ex:
+        sys.exit(str(ex))
+    try:
+        asyncio.run(notifier.run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+#
+# Project:     weechat-notify-send
+# Homepage:    https://github.com/s3rvac/weechat-notify-send
+# Description: Tests for the relay client.
+# License:     MIT (see below)
+#
+# Copyright (c) 2015 by Petr Zemek <s3rvac@gmail.com> and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import asyncio
+import struct
+import unittest
+import zlib
+from unittest import mock
+
+# notify_send_relay has to be imported first as it provides a stand-in for
+# the weechat module, without which notify_send cannot be imported.
+import notify_send_relay
+import notify_send
+from notify_send_relay import RelayDecoder
+from notify_send_relay import RelayError
+from notify_send_relay import RelayNotifier
+from notify_send_relay import strip_colors
+
+
+def encode_str(value):
+    if value is None:
+        return struct.pack('>i', -1)
+    data = value.encode('utf-8')
+    return struct.pack('>i', len(data)) + data
+
+
+def encode_short_string(value):
+    data = value.encode('ascii')
+    return bytes([len(data)]) + data
+
+
+def encode_ptr(value):
+    return encode_short_string(value[2:])
+
+
+def encode_value(object_type, value):
+    """Encodes the given value of the given type (without the type)."""
+    if object_type == 'chr':
+        return struct.pack('>b', value)
+    elif object_type == 'int':
+        return struct.pack('>i', value)
+    elif object_type in ('lon', 'tim'):
+        return encode_short_string(str(value))
+    elif object_type == 'ptr':
+        return encode_ptr(value)
+    elif object_type == 'str':
+        return encode_str(value)
+    elif object_type == 'htb':
+        data = b'strstr' + struct.pack('>i', len(value))
+        for key, item in value.items():
+            data += encode_str(key) + encode_str(item)
+        return data
+    elif object_type == 'arr':
+        data = b'str' + struct.pack('>i', len(value))
+        for item in value:
+            data += encode_str(item)
+        return data
+    raise ValueError(object_type)
+
+
+def encode_hda(path, keys, items):
+    """Encodes an hdata object (with the type).
+
+    keys is a list of (name, type) pairs and each item is a pair (list of
+    pointers, dictionary of values).
+    """
+    data = b'hda' + encode_str(path)
+    data += encode_str(','.join('{}:{}'.format(name, t) for name, t in keys))
+    data += struct.pack('>i', len(items))
+    for pointers, values in items:
+        for pointer in pointers:
+            data += encode_ptr(pointer)
+        for name, object_type in keys:
+            data += encode_value(object_type, values[name])
+    return data
+
+
+def encode_message(message_id, *objects, compress=False):
+    """Encodes a message with the given ID and encoded objects."""
+    data = encode_str(message_id) + b''.join(objects)
+    if compress:
+        data = zlib.compress(data)
+    return struct.pack('>IB', len(data) + 5, 1 if compress else 0) + data
+
+
+BUFFER_KEYS = [
+    ('name', 'str'),
+    ('full_name', 'str'),
+    ('short_name', 'str'),
+    ('local_variables', 'htb'),
+]
+
+LINE_KEYS = [
+    ('buffer', 'ptr'),
+    ('date', 'tim'),
+    ('displayed', 'chr'),
+    ('highlight', 'chr'),
+    ('tags_array', 'arr'),
+    ('prefix', 'str'),
+    ('message', 'str'),
+]
+
+
+def buffer_list_message(buffers):
+    """Encodes the reply to the listbuffers request."""
+    return encode_message('listbuffers', encode_hda('buffer', BUFFER_KEYS, [
+        ([pointer], values) for pointer, values in buffers
+    ]))
+
+
+def line_added_message(buffer, prefix, message, tags=(), highlight=0):
+    """Encodes a _buffer_line_added message."""
+    return encode_message('_buffer_line_added', encode_hda('line_data', LINE_KEYS, [
+        (['0xabc'], {
+            'buffer': buffer,
+            'date': 1700000000,
+            'displayed': 1,
+            'highlight': highlight,
+            'tags_array': list(tags),
+            'prefix': prefix,
+            'message': message,
+        }),
+    ]))
+
+
+CHANNEL = ('0x1', {
+    'name': 'libera.#weechat',
+    'full_name': 'irc.libera.#weechat',
+    'short_name': '#weechat',
+    'local_variables': {'type': 'channel', 'nick': 'me'},
+})
+
+PRIVATE = ('0x2', {
+    'name': 'libera.john',
+    'full_name': 'irc.libera.john',
+    'short_name': 'john',
+    'local_variables': {'type': 'private', 'nick': 'me'},
+})
+
+
+class TestsBase(unittest.TestCase):
+    """A base class for all tests."""
+
+    def setUp(self):
+        # The client rebinds weechat in the script, so restore it to not
+        # affect tests of the script itself.
+        orig_weechat = notify_send.weechat
+        self.addCleanup(setattr, notify_send, 'weechat', orig_weechat)
+
+        patcher = mock.patch('notify_send.subprocess')
+        self.subprocess = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.subprocess.check_output.return_value = '1\n'
+
+        notify_send_relay.setup_runtime({'min_notification_delay': '0'})
+
+    def sent_notifications(self):
+        """Returns (source, message) pairs of sent notifications."""
+        return [
+            tuple(call[0][0][-2:])
+            for call in self.subprocess.check_output.call_args_list
+        ]
+
+
+class RelayDecoderTests(TestsBase):
+    """Tests for RelayDecoder."""
+
+    def test_decodes_message_fed_byte_by_byte(self):
+        data = line_added_message('0x1', 'john', 'hello', tags=['nick_john'])
+        decoder = RelayDecoder()
+
+        messages = []
+        for i in range(len(data)):
+            messages.extend(decoder.feed(data[i:i + 1]))
+
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].id, '_buffer_line_added')
+        self.assertEqual(messages[0].objects, [[{
+            '__path': ['0xabc'],
+            'buffer': '0x1',
+            'date': 1700000000,
+            'displayed': 1,
+            'highlight': 0,
+            'tags_array': ['nick_john'],
+            'prefix': 'john',
+            'message': 'hello',
+        }]])
+        self.assertEqual(decoder.buffer, bytearray())
+
+    def test_decodes_several_messages_in_one_chunk(self):
+        data = buffer_list_message([CHANNEL]) + encode_message('_pong', b'str' + encode_str('x'))
+
+        messages = RelayDecoder().feed(data)
+
+        self.assertEqual([message.id for message in messages], ['listbuffers', '_pong'])
+        self.assertEqual(messages[0].objects[0][0]['local_variables'],
+                         {'type': 'channel', 'nick': 'me'})
+        self.assertEqual(messages[1].objects, ['x'])
+
+    def test_decodes_compressed_message(self):
+        data = encode_message('_pong', b'str' + encode_str('x'), compress=True)
+
+        messages = RelayDecoder().feed(data)
+
+        self.assertEqual(messages[0].objects, ['x'])
+
+    def test_decodes_null_string_and_long_integer(self):
+        data = encode_message(None, b'str' + encode_str(None), b'lon' + encode_short_string('-5'))
+
+        messages = RelayDecoder().feed(data)
+
+        self.assertEqual(messages[0].id, None)
+        self.assertEqual(messages[0].objects, [None, -5])
+
+    def test_raises_error_for_unknown_object_type(self):
+        with self.assertRaises(RelayError):
+            RelayDecoder().feed(encode_message('x', b'xyz'))
+
+    def test_raises_error_for_invalid_length(self):
+        with self.assertRaises(RelayError):
+            RelayDecoder().feed(struct.pack('>IB', 2, 0))
+
+
+class StripColorsTests(TestsBase):
+    """Tests for strip_colors()."""
+
+    def test_removes_color_codes(self):
+        self.assertEqual(
+            strip_colors('\x1901john\x1c: \x19F@00123hi \x19*05,10there\x1a\x01!\x1b\x01'),
+            'john: hi there!'
+        )
+
+    def test_returns_empty_string_for_null(self):
+        self.assertEqual(strip_colors(None), '')
+
+
+class RelayNotifierTests(TestsBase):
+    """Tests for handling of messages by RelayNotifier."""
+
+    def setUp(self):
+        super().setUp()
+        self.notifier = RelayNotifier('localhost', 9000)
+
+    def handle(self, data):
+        for message in RelayDecoder().feed(data):
+            self.notifier.handle_message(message)
+
+    def test_sends_notification_for_private_message(self):
+        self.handle(buffer_list_message([CHANNEL, PRIVATE]))
+
+        self.handle(line_added_message('0x2', 'john', 'hi', tags=['irc_privmsg', 'nick_john']))
+
+        self.assertEqual(self.sent_notifications(), [('john', 'hi')])
+
+    def test_sends_notification_for_highlight_with_colors_removed(self):
+        notify_send_relay.weechat.config['nick_separator'] = ': '
+        self.handle(buffer_list_message([CHANNEL]))
+
+        self.handle(line_added_message(
+            '0x1', '\x1905john', 'me: \x1902hello',
+            tags=['irc_privmsg', 'nick_john'], highlight=1
+        ))
+
+        self.assertEqual(self.sent_notifications(), [('#weechat', 'john: me: hello')])
+
+    def test_does_not_send_notification_for_own_message(self):
+        self.handle(buffer_list_message([PRIVATE]))
+
+        self.handle(line_added_message('0x2', 'me', 'hi', tags=['nick_me']))
+
+        self.assertEqual(self.sent_notifications(), [])
+
+    def test_uses_local_variables_of_changed_buffer(self):
+        self.handle(buffer_list_message([PRIVATE]))
+        self.handle(encode_message('_buffer_localvar_added', encode_hda('buffer', [
+            ('local_variables', 'htb'),
+        ], [(['0x2'], {'local_variables': {'type': 'private', 'nick': 'john'}})])))
+
+        self.handle(line_added_message('0x2', 'john', 'hi', tags=['nick_john']))
+
+        self.assertEqual(self.sent_notifications(), [])
+
+    def test_keeps_local_variables_of_script_when_buffer_changes(self):
+        self.handle(buffer_list_message([PRIVATE]))
+        notify_send_relay.weechat.buffer_set(
+            '0x2', 'localvar_set_notify_send_last_notification_time', '42'
+        )
+
+        self.handle(encode_message('_buffer_localvar_changed', encode_hda('buffer', [
+            ('local_variables', 'htb'),
+        ], [(['0x2'], {'local_variables': {'type': 'private', 'away': 'gone'}})])))
+
+        buffers = notify_send_relay.weechat.buffers
+        self.assertEqual(buffers['0x2']['localvar_notify_send_last_notification_time'], '42')
+        self.assertEqual(buffers['0x2']['localvar_away'], 'gone')
+
+    def test_forgets_closed_buffer(self):
+        self.handle(buffer_list_message([CHANNEL, PRIVATE]))
+
+        self.handle(encode_message('_buffer_closing', encode_hda('buffer', [
+            ('full_name', 'str'),
+        ], [(['0x2'], {'full_name': 'irc.libera.john'})])))
+
+        self.assertEqual(list(notify_send_relay.weechat.buffers), ['0x1'])
+
+    def test_rejects_password_with_comma(self):
+        with self.assertRaisesRegex(ValueError, 'cannot contain a comma'):
+            RelayNotifier('localhost', 9000, password='a,b')
+
+    def test_turns_off_options_that_need_running_weechat(self):
+        notify_send_relay.setup_runtime({'actions': 'on', 'engine': 'hotlist'})
+
+        self.assertEqual(notify_send_relay.weechat.config['actions'], 'off')
+        self.assertEqual(notify_send_relay.weechat.config['engine'], 'print')
+
+
+class StandInRelay(object):
+    """A local stand-in for the relay of WeeChat.
+
+    For each connection, it sends the next list of messages from the given
+    list of sessions and then closes the connection.
+    """
+
+    def __init__(self, sessions):
+        self.sessions = list(sessions)
+        self.commands = []
+        self.connections = 0
+        self.all_sessions_served = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        # Wait for the sync command, which is the last one sent by the client.
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            self.commands.append(line.decode('utf-8').rstrip('\n'))
+            if line.startswith(b'sync'):
+                break
+        for data in self.sessions.pop(0) if self.sessions else []:
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+        if not self.sessions:
+            self.all_sessions_served.set()
+
+    def close(self):
+        self.server.close()
+
+
+class RelaySessionTests(TestsBase, unittest.IsolatedAsyncioTestCase):
+    """Tests of RelayNotifier against a stand-in relay."""
+
+    async def run_against(self, relay):
+        port = await relay.start()
+        notifier = RelayNotifier('127.0.0.1', port, 'secret',
+                                 min_backoff=0.01, max_backoff=0.02)
+        task = asyncio.ensure_future(notifier.run())
+        try:
+            await asyncio.wait_for(relay.all_sessions_served.wait(), 5)
+            # Give the client time to handle the last messages.
+            for _ in range(10):
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            relay.close()
+
+    async def test_authenticates_and_syncs(self):
+        relay = StandInRelay([[]])
+
+        await self.run_against(relay)
+
+        self.assertIn('init password=secret,compression=off', relay.commands)
+        self.assertIn('sync * buffers,upgrade,buffer', relay.commands)
+
+    async def test_sends_notifications_for_received_lines(self):
+        data = buffer_list_message([PRIVATE]) + line_added_message(
+            '0x2', 'john', 'hi', tags=['nick_john']
+        )
+        # Split the data to check that incomplete messages are handled.
+        relay = StandInRelay([[data[:10], data[10:]]])
+
+        await self.run_against(relay)
+
+        self.assertEqual(self.sent_notifications(), [('john', 'hi')])
+
+    async def test_reconnects_when_connection_drops(self):
+        relay = StandInRelay([
+            [buffer_list_message([PRIVATE])],
+            [buffer_list_message([PRIVATE]),
+             line_added_message('0x2', 'john', 'again', tags=['nick_john'])],
+        ])
+
+        await self.run_against(relay)
+
+        self.assertGreaterEqual(relay.connections, 2)
+        self.assertEqual(self.sent_notifications(), [('john', 'again')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+#
+# Project:     weechat-notify-send
+# Homepage:    https://github.com/s3rvac/weechat-notify-send
+# Description: Replays WeeChat logs through the notification rules.
+# License:     MIT (see below)
+#
+# Copyright (c) 2015 by Petr Zemek <s3rvac@gmail.com> and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Usage:
+#
+#     python notify_send_replay.py [options] ~/.weechat/logs/*.weechatlog
+#
+# Streams log files written by WeeChat's logger plugin through the same
+# decision pipeline that the script uses, without running WeeChat. Time is
+# virtual (it follows the timestamps in the logs), so min_notification_delay
+# behaves as it would have live. It prints the notifications that would have
+# been sent, how many lines each option decided, and the throughput. Nothing
+# is sent.
+#
+
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import os
+import re
+import sys
+import time
+
+from fake_weechat import FakeWeechat
+from fake_weechat import VirtualClock
+
+weechat = FakeWeechat()
+sys.modules.setdefault('weechat', weechat)
+
+import notify_send  # noqa: E402
+
+clock = VirtualClock()
+
+# The default value of logger.file.time_format.
+DEFAULT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Prefixes of buffer short names that denote channels.
+CHANNEL_PREFIXES = ('#', '&', '+', '!')
+
+# Options that need a running WeeChat (or would leave files or side effects
+# behind) and are therefore turned off.
+UNSUPPORTED_OPTIONS = {
+    'actions': 'off',
+    'history_size': '0',
+    'quiet_hours': '',
+}
+
+# Tags of lines with special prefixes, which are not part of the log.
+TAGS_FOR_PREFIXES = {
+    '-->': ['irc_join'],
+    '<--': ['irc_quit'],
+    '--': ['irc_status'],
+}
+
+# A line that would have produced a notification: (time, source, message).
+SentNotification = collections.namedtuple(
+    'SentNotification', ['time', 'source', 'message']
+)
+
+# Results of a replay of one file.
+ReplayResult = collections.namedtuple(
+    'ReplayResult', ['path', 'lines', 'elapsed', 'notifications', 'decisions']
+)
+
+
+def read_plugins_conf(path):
+    """Reads options of the script from the given plugins.conf."""
+    options = {}
+    option_re = re.compile(
+        r'^python\.{}\.(\S+)\s*=\s*"(.*)"\s*$'.format(notify_send.SCRIPT_NAME)
+    )
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            m = option_re.match(line)
+            if m:
+                options[m.group(1)] = m.group(2).replace('\\"', '"')
+    return options
+
+
+def setup_runtime(options):
+    """Makes the script run against the fake WeeChat with the given options."""
+    notify_send.weechat = weechat
+    notify_send.time = clock
+    weechat.config = {
+        option: default for option, (default, _) in notify_send.OPTIONS.items()
+    }
+    weechat.config.update(options)
+    weechat.config.update(UNSUPPORTED_OPTIONS)
+    weechat.buffers = {}
+    weechat.current = ''
+    notify_send.apply_config()
+
+
+def buffer_from_path(path, own_nick):
+    """Creates a buffer for the given log file and returns its pointer.
+
+    The name of the buffer is taken from the name of the file, which is
+    '$plugin.$name.weechatlog' by default (e.g.
+    'irc.libera.#weechat.weechatlog').
+    """
+    name = os.path.basename(path)
+    for suffix in ('.gz', '.weechatlog'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+
+    parts = name.split('.', 2)
+    if len(parts) == 3 and parts[0] == 'irc' and parts[1] != 'server':
+        short_name = parts[2]
+        if short_name.startswith(CHANNEL_PREFIXES):
+            buffer_type = 'channel'
+        else:
+            buffer_type = 'private'
+    else:
+        short_name = parts[-1]
+        buffer_type = 'server'
+
+    pointer = '0x{:x}'.format(len(weechat.buffers) + 1)
+    weechat.add_buffer(pointer, name, short_name, type=buffer_type, nick=own_nick)
+    return pointer
+
+
+def parse_time(timestamp, time_format):
+    """Parses the given timestamp into seconds since the epoch."""
+    if time_format == DEFAULT_TIME_FORMAT and len(timestamp) == 19:
+        # A fast path for the default format, which avoids strptime().
+        return time.mktime((
+            int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+            int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+            0, 0, -1
+        ))
+    return time.mktime(time.strptime(timestamp, time_format))
+
+
+def parse_log(lines, time_format=DEFAULT_TIME_FORMAT):
+    """A generator of (time, tags, prefix, message) tuples from the given lines
+    of a log.
+
+    Lines that cannot be parsed are skipped.
+    """
+    for line in lines:
+        parts = line.rstrip('\n').split('\t', 2)
+        if len(parts) != 3:
+            continue
+        timestamp, prefix, message = parts
+        try:
+            line_time = parse_time(timestamp, time_format)
+        except ValueError:
+            continue
+
+        tags = TAGS_FOR_PREFIXES.get(prefix)
+        if tags is None:
+            if prefix == ' *':
+                # An action (/me); the nick is the first word of the message.
+                tags = ['irc_action', 'nick_' + message.split(' ', 1)[0]]
+            else:
+                tags = ['irc_privmsg']
+        yield line_time, tags, prefix, message
+
+
+def highlight_re_for(own_nick, highlight_words):
+    """Returns a regex matching highlights, or None when there are none."""
+    words = [own_nick] if own_nick else []
+    words.extend(word for word in highlight_words if word)
+    if not words:
+        return None
+    return re.compile(
+        r'\b(?:{})\b'.format('|'.join(re.escape(word) for word in words)),
+        re.IGNORECASE
+    )
+
+
+def open_log(path):
+    """Opens the given (possibly gzipped) log for reading."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
+
+
+def replay_file(path, options, own_nick='', highlight_words=(),
+                time_format=DEFAULT_TIME_FORMAT, keep_notifications=True):
+    """Replays the given log file and returns a ReplayResult.
+
+    When keep_notifications is false, notifications are only counted in the
+    decisions, so memory use does not grow with the number of notifications.
+    """
+    setup_runtime(options)
+    buffer = buffer_from_path(path, own_nick)
+    highlight_re = highlight_re_for(own_nick, highlight_words)
+    notifications = []
+    decisions = collections.Counter()
+    lines = 0
+
+    start = time.perf_counter()
+    with open_log(path) as f:
+        for line_time, tags, prefix, message in parse_log(f, time_format):
+            lines += 1
+            clock.now = line_time
+            nick = notify_send.nick_that_sent_message(tags, prefix)
+            is_highlight = bool(highlight_re and nick != own_nick and
+                                highlight_re.search(message))
+            should_be_sent, reason = notify_send.notification_decision(
+                buffer, tags, nick, 1, is_highlight, message
+            )
+            decisions[(should_be_sent, reason)] += 1
+            if should_be_sent and keep_notifications:
+                notification = notify_send.prepare_notification(
+                    buffer, nick, message, line_time
+                )
+                notifications.append(SentNotification(
+                    line_time, notification.source, notification.message
+                ))
+    elapsed = time.perf_counter() - start
+
+    return ReplayResult(path, lines, elapsed, notifications, decisions)
+
+
+def replay_files(paths, options, jobs=1, **kwargs):
+    """A generator of ReplayResults for the given files.
+
+    When jobs is greater than one, the files are replayed in parallel.
+    """
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield replay_file(path, options, **kwargs)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(replay_file, path, options, **kwargs)
+            for path in paths
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Replays WeeChat logs through the notification rules of '
+                    'notify_send.py and prints the notifications that would '
+                    'have been sent.'
+    )
+    parser.add_argument('logs', nargs='+', metavar='LOG',
+                        help='log file written by the logger plugin '
+                             '(may be gzipped)')
+    parser.add_argument('-c', '--config', metavar='PLUGINS_CONF',
+                        help='read options of the script from plugins.conf')
+    parser.add_argument('-o', '--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='set an option of the script (may be repeated)')
+    parser.add_argument('-n', '--nick', default='',
+                        help='your nick (used to detect your own messages '
+                             'and highlights)')
+    parser.add_argument('-w', '--highlight', default='',
+                        help='a comma-separated list of highlight words')
+    parser.add_argument('-f', '--time-format', default=DEFAULT_TIME_FORMAT,
+                        help='value of logger.file.time_format '
+                             '(default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files to replay in parallel')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print individual notifications')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    options = read_plugins_conf(args.config) if args.config else {}
+    for option in args.option:
+        name, sep, value = option.partition('=')
+        if not sep or name not in notify_send.OPTIONS:
+            sys.exit('invalid option: {}'.format(option))
+        options[name] = value
+
+    decisions = collections.Counter()
+    lines = 0
+    elapsed = 0.0
+    results = replay_files(
+        args.logs,
+        options,
+        jobs=args.jobs,
+        own_nick=args.nick,
+        highlight_words=[word.strip() for word in args.highlight.split(',')],
+        time_format=args.time_format,
+        keep_notifications=not args.quiet,
+    )
+    for result in results:
+        lines += result.lines
+        elapsed += result.elapsed
+        decisions.update(result.decisions)
+        for notification in result.notifications:
+            print('{}  {}  {}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(notification.time)),
+                notification.source,
+                notification.message
+            ))
+
+    print('\nDecisions:')
+    for (should_be_sent, reason), count in decisions.most_common():
+        print('{:>10}  {:<8}  {}'.format(
+            count, 'sent' if should_be_sent else 'not sent', reason
+        ))
+    print('\n{} lines in {:.2f} s ({:.0f} lines/s)'.format(
+        lines, elapsed, lines / elapsed if elapsed else 0
+    ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# Project:     weechat-notify-send
+# Homepage:    https://github.com/s3rvac/weechat-notify-send
+# Description: Unit tests for notify_send_replay.py.
+# License:     MIT (see below)
+#
+# Copyright (c) 2015 by Petr Zemek <s3rvac@gmail.com> and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+# notify_send_replay has to be imported first as it provides a stand-in for
+# the weechat module, without which notify_send cannot be imported.
+import notify_send_replay
+import notify_send
+from notify_send_replay import buffer_from_path
+from notify_send_replay import parse_log
+from notify_send_replay import read_plugins_conf
+from notify_send_replay import replay_file
+from notify_send_replay import replay_files
+
+
+def timestamp(seconds):
+    """Returns a log timestamp for the given number of seconds after the start
+    of 2024-01-01 (local time).
+    """
+    start = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start + seconds))
+
+
+class TestsBase(unittest.TestCase):
+    """A base class for all tests."""
+
+    def setUp(self):
+        # The replay rebinds weechat and time in the script, so restore them
+        # to not affect tests of the script itself.
+        orig_weechat = notify_send.weechat
+        orig_time = notify_send.time
+
+        def restore():
+            notify_send.weechat = orig_weechat
+            notify_send.time = orig_time
+        self.addCleanup(restore)
+
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write_log(self, name, lines):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line + '\n')
+        return path
+
+
+class ParseLogTests(TestsBase):
+    """Tests for parse_log()."""
+
+    def test_parses_time_prefix_and_message(self):
+        lines = list(parse_log([timestamp(0) + '\tjohn\thello\tworld\n']))
+
+        self.assertEqual(lines, [
+            (time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1)), ['irc_privmsg'],
+             'john', 'hello\tworld'),
+        ])
+
+    def test_skips_lines_that_cannot_be_parsed(self):
+        lines = list(parse_log(['xxx\n', 'not a date\tjohn\thello\n']))
+
+        self.assertEqual(lines, [])
+
+    def test_adds_tags_for_joins(self):
+        lines = list(parse_log([timestamp(0) + '\t-->\tjohn has joined\n']))
+
+        self.assertEqual(lines[0][1], ['irc_join'])
+
+    def test_adds_nick_tag_for_actions(self):
+        lines = list(parse_log([timestamp(0) + '\t *\tjohn waves\n']))
+
+        self.assertEqual(lines[0][1], ['irc_action', 'nick_john'])
+
+    def test_supports_custom_time_format(self):
+        lines = list(parse_log(['01/02/2024 10:00\tjohn\thello\n'], '%d/%m/%Y %H:%M'))
+
+        self.assertEqual(lines[0][0], time.mktime((2024, 2, 1, 10, 0, 0, 0, 0, -1)))
+
+
+class BufferFromPathTests(TestsBase):
+    """Tests for buffer_from_path()."""
+
+    def setUp(self):
+        super().setUp()
+        notify_send_replay.setup_runtime({})
+
+    def test_channel_log_creates_channel_buffer(self):
+        buffer = buffer_from_path('/logs/irc.libera.#weechat.weechatlog', 'me')
+
+        weechat = notify_send_replay.weechat
+        self.assertEqual(weechat.buffer_get_string(buffer, 'name'), 'irc.libera.#weechat')
+        self.assertEqual(weechat.buffer_get_string(buffer, 'short_name'), '#weechat')
+        self.assertEqual(weechat.buffer_get_string(buffer, 'localvar_type'), 'channel')
+        self.assertEqual(weechat.buffer_get_string(buffer, 'localvar_nick'), 'me')
+
+    def test_private_log_creates_private_buffer(self):
+        buffer = buffer_from_path('/logs/irc.libera.john.weechatlog.gz', 'me')
+
+        weechat = notify_send_replay.weechat
+        self.assertEqual(weechat.buffer_get_string(buffer, 'short_name'), 'john')
+        self.assertEqual(weechat.buffer_get_string(buffer, 'localvar_type'), 'private')
+
+    def test_server_log_creates_server_buffer(self):
+        buffer = buffer_from_path('/logs/irc.server.libera.weechatlog', 'me')
+
+        weechat = notify_send_replay.weechat
+        self.assertEqual(weechat.buffer_get_string(buffer, 'localvar_type'), 'server')
+
+
+class SetupRuntimeTests(TestsBase):
+    """Tests for setup_runtime()."""
+
+    def test_turns_off_options_that_need_running_weechat(self):
+        notify_send_replay.setup_runtime({
+            'actions': 'on',
+            'history_size': '10',
+            'quiet_hours': '00:00-23:59',
+        })
+
+        self.assertEqual(notify_send_replay.weechat.config_get_plugin('actions'), 'off')
+        self.assertEqual(notify_send_replay.weechat.config_get_plugin('history_size'), '0')
+        self.assertEqual(notify_send_replay.weechat.config_get_plugin('quiet_hours'), '')
+        self.assertIsNone(notify_send.NOTIFICATION_HISTORY)
+
+
+class ReadPluginsConfTests(TestsBase):
+    """Tests for read_plugins_conf()."""
+
+    def test_reads_options_of_the_script(self):
+        path = self.write_log('plugins.conf', [
+            '[var]',
+            'python.notify_send.ignore_nicks = "bot,\\"quoted\\""',
+            'python.other_script.ignore_nicks = "xxx"',
+            'python.notify_send.urgency = "low"',
+        ])
+
+        self.assertEqual(read_plugins_conf(path), {
+            'ignore_nicks': 'bot,"quoted"',
+            'urgency': 'low',
+        })
+
+
+class ReplayFileTests(TestsBase):
+    """Tests for replay_file()."""
+
+    def test_returns_notifications_that_would_have_been_sent(self):
+        path = self.write_log('irc.libera.#weechat.weechatlog', [
+            timestamp(0) + '\tjohn\thello me',
+            timestamp(1) + '\tjohn\thello everyone',
+        ])
+
+        result = replay_file(path, {}, own_nick='me')
+
+        self.assertEqual(result.lines, 2)
+        self.assertEqual(len(result.notifications), 1)
+        self.assertEqual(result.notifications[0].source, '#weechat')
+        self.assertEqual(result.notifications[0].message, 'john: hello me')
+
+    def test_only_counts_notifications_when_they_are_not_kept(self):
+        path = self.write_log('irc.libera.john.weechatlog', [
+            timestamp(0) + '\tjohn\thello',
+        ])
+
+        result = replay_file(path, {}, own_nick='me', keep_notifications=False)
+
+        self.assertEqual(result.notifications, [])
+        self.assertEqual(sum(count for (should_be_sent, _), count in result.decisions.items()
+                             if should_be_sent), 1)
+
+    def test_min_notification_delay_uses_times_from_log(self):
+        path = self.write_log('irc.libera.john.weechatlog', [
+            timestamp(0) + '\tjohn\tfirst',
+            timestamp(0) + '\tjohn\tsecond',
+            timestamp(10) + '\tjohn\tthird',
+        ])
+
+        result = replay_file(path, {'min_notification_delay': '5000'}, own_nick='me')
+
+        messages = [notification.message for notification in result.notifications]
+        self.assertEqual(messages, ['first', 'third'])
+        self.assertEqual(result.decisions[(False, 'min_notification_delay')], 1)
+
+    def test_counts_decisions_per_option(self):
+        path = self.write_log('irc.libera.#weechat.weechatlog', [
+            timestamp(0) + '\tbot\thello me',
+            timestamp(1) + '\tme\thello',
+            timestamp(2) + '\tjohn\thello',
+        ])
+
+        result = replay_file(path, {'ignore_nicks': 'bot'}, own_nick='me')
+
+        self.assertEqual(result.decisions, {
+            (False, 'ignore_nicks'): 1,
+            (False, 'own message'): 1,
+            (False, 'no matching option'): 1,
+        })
+
+    def test_detects_highlights_on_given_words(self):
+        path = self.write_log('irc.libera.#weechat.weechatlog', [
+            timestamp(0) + '\tjohn\tthe BUILD is broken',
+        ])
+
+        result = replay_file(path, {}, own_nick='me', highlight_words=['build'])
+
+        self.assertEqual(len(result.notifications), 1)
+
+
+class ReplayFilesTests(TestsBase):
+    """Tests for replay_files()."""
+
+    def test_replays_files_in_parallel(self):
+        paths = [
+            self.write_log('irc.libera.john.weechatlog', [timestamp(0) + '\tjohn\thi']),
+            self.write_log('irc.libera.jane.weechatlog', [timestamp(0) + '\tjane\thi']),
+        ]
+
+        results = list(replay_files(paths, {}, jobs=2, own_nick='me'))
+
+        self.assertEqual([result.path for result in results], paths)
+        self.assertEqual(
+            [result.notifications[0].source for result in results],
+            ['john', 'jane']
+        )
@@ -26,7 +26,16 @@
 # SOFTWARE.
 #
 
+import collections
+import fnmatch
+import json
+import os
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from unittest import mock
@@ -36,26 +45,76 @@ from unittest import mock
 weechat = mock.Mock()
 sys.modules['weechat'] = weechat
 
+import notify_send
+from notify_send import DecisionTrace
 from notify_send import Notification
+from notify_send import NotificationHistory
+from notify_send import ShadowProfile
+from notify_send import action_monitor_callback
 from notify_send import add_default_value_to
+from notify_send import apply_buffer_overrides_config
+from notify_send import apply_away_digest_config
+from notify_send import apply_config
+from notify_send import apply_icons_config
+from notify_send import apply_input_activity_config
+from notify_send import apply_quiet_hours_config
+from notify_send import apply_regex_time_budget_config
+from notify_send import apply_rules_config
+from notify_send import apply_shadow_config
+from notify_send import apply_templates_config
+from notify_send import buffer_changed_callback
+from notify_send import buffer_option
+from notify_send import command_callback
+from notify_send import config_changed_callback
 from notify_send import default_value_of
+from notify_send import dnd_start
+from notify_send import dnd_stop
+from notify_send import dnd_timer_callback
+from notify_send import encode_history_field
 from notify_send import escape_html
 from notify_send import escape_slashes
+from notify_send import focus_changed_callback
+from notify_send import format_message
+from notify_send import highlight_or_private_signal_callback
+from notify_send import hook_notifications
+from notify_send import hotlist_notification_should_be_sent
+from notify_send import hotlist_timer_callback
+from notify_send import icon_for
 from notify_send import ignore_notifications_from_buffer
 from notify_send import ignore_notifications_from_messages_tagged_with
 from notify_send import ignore_notifications_from_nick
+from notify_send import input_activity_callback
+from notify_send import int_option
 from notify_send import is_below_min_notification_delay
+from notify_send import is_safe_file_name
 from notify_send import message_printed_callback
 from notify_send import names_for_buffer
+from notify_send import next_notification_delay
 from notify_send import nick_separator
 from notify_send import nick_that_sent_message
+from notify_send import notification_decision
+from notify_send import notification_engine_config
 from notify_send import notification_should_be_sent
 from notify_send import notify_on_all_messages_in_buffer
 from notify_send import notify_on_messages_that_match
+from notify_send import next_quiet_period_start
+from notify_send import parse_duration
+from notify_send import parse_quiet_hours
+from notify_send import parse_rule
+from notify_send import parse_template
+from notify_send import pattern_risks
+from notify_send import pattern_search
 from notify_send import prepare_notification
+from notify_send import profiled_message_printed_callback
+from notify_send import refresh_modifier_hooks
+from notify_send import quiet_period_end
 from notify_send import send_notification
 from notify_send import close_notification
+from notify_send import current_buffer
+from notify_send import shadow_report
+from notify_send import shutdown_callback
 from notify_send import shorten_message
+from notify_send import unaway_callback
 
 
 def new_notification(source='source', message='message', icon='icon.png',
@@ -127,6 +186,7 @@ class TestsBase(unittest.TestCase):
         set_config_option('notify_on_all_messages_in_buffers_that_match', '')
         set_config_option('notify_on_messages_that_match', '')
         set_config_option('min_notification_delay', '0')
+        set_config_option('max_notification_delay', '0')
         set_config_option('ignore_messages_tagged_with', '')
         set_config_option('ignore_buffers', '')
         set_config_option('ignore_buffers_starting_with', '')
@@ -144,11 +204,151 @@ class TestsBase(unittest.TestCase):
         set_config_option('urgency', '')
         set_config_option('replace_buffer_notifications', 'off')
         set_config_option('auto_close_prior_buffer_notification', 'off')
+        set_config_option('command', 'notify-send')
+        set_config_option('engine', 'print')
+        set_config_option('hotlist_poll_interval', '5')
+        set_config_option('quiet_hours', '')
+        set_config_option('dnd_digest', 'off')
+        set_config_option('history_size', '0')
+        set_config_option('trace_size', '0')
+        set_config_option('notify_only_when_terminal_unfocused', 'off')
+        set_config_option('actions', 'off')
+        set_config_option('icon_dirs', '')
+        set_config_option('away_digest', 'off')
+        set_config_option('away_digest_lines', '3')
+        set_config_option('regex_time_budget', '0')
+        set_config_option('suppress_while_typing', '0')
+        set_config_option('shadow_profile', '')
+        set_config_option('shadow_max_rate', '100')
+        set_config_option('summary_template', '')
+        set_config_option('body_template', '')
+
+        # Start with no cached parts of commands.
+        patcher = mock.patch.dict('notify_send.NOTIFY_CMD_PARTS', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Disable tracing and history by default.
+        patcher = mock.patch('notify_send.DECISION_TRACE', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('notify_send.NOTIFICATION_HISTORY', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Start with no hooks and without do-not-disturb.
+        for name, value in [('NOTIFICATION_HOOKS', []),
+                            ('NOTIFICATION_HOOKS_CONFIG', None),
+                            ('HOTLIST_SNAPSHOT', {}),
+                            ('DND_UNTIL', None),
+                            ('DND_TIMER', ''),
+                            ('DND_HOTLIST', {}),
+                            ('QUIET_HOURS_TIMER', ''),
+                            ('CURRENT_BUFFER', None),
+                            ('TERMINAL_FOCUSED', True),
+                            ('FOCUS_REPORTING', False),
+                            ('ACTION_MONITOR_HOOK', ''),
+                            ('ACTION_MONITOR_OUTPUT', ''),
+                            ('HOOKED_MODIFIERS', frozenset()),
+                            ('NOTIFICATION_RULES', None),
+                            ('RULE_URGENCY', ''),
+                            ('MATCHED_KEYWORD', ''),
+                            ('ICON_DIRS', []),
+                            ('ICON_DIRS_CHECKED', 0.0),
+                            ('AWAY_DIGEST', None),
+                            ('AWAY_DIGEST_HOOK', ''),
+                            ('REGEX_TIME_BUDGET', 0),
+                            ('PROFILER', None),
+                            ('PROFILE_EVERY', 1),
+                            ('PROFILE_CALLS', 0),
+                            ('PROFILE_TIMER', ''),
+                            ('MEMORY_SNAPSHOT', None),
+                            ('SUPPRESS_WHILE_TYPING', 0),
+                            ('LAST_INPUT_TIME', 0.0),
+                            ('INPUT_ACTIVITY_HOOK', ''),
+                            ('SHADOW_PROFILE', None),
+                            ('SUMMARY_TEMPLATE', None),
+                            ('BODY_TEMPLATE', None)]:
+            patcher = mock.patch('notify_send.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # Start with no saved bindings of keys for focus reporting.
+        patcher = mock.patch.dict('notify_send.FOCUS_KEY_BINDINGS', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Start with no notifications with actions.
+        patcher = mock.patch.dict('notify_send.ACTION_NOTIFICATIONS', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Start with no disabled regular expressions.
+        patcher = mock.patch('notify_send.SLOW_PATTERNS', set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Start with no resolved icons.
+        for name in ['ICON_CACHE', 'ICON_DIR_LISTINGS']:
+            patcher = mock.patch.dict('notify_send.' + name, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # Start with no buffer overrides.
+        patcher = mock.patch('notify_send.BUFFER_OVERRIDES', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict('notify_send.BUFFER_POLICIES', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
         # Mimic the behavior of weechat.buffer_get_string() by returning the
         # empty string by default.
         weechat.buffer_get_string.side_effect = lambda buffer, string: ''
 
+        # Return no infolists by default.
+        weechat.infolist_get.return_value = ''
+
+    def create_temp_dir(self):
+        """Creates a temporary directory that is removed after the test."""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        return temp_dir
+
+    def mock_hotlist(self, hotlist):
+        """Makes the hotlist infolist return the given items."""
+        weechat.infolist_get.return_value = 'infolist'
+        position = []
+
+        def infolist_next(infolist):
+            position.append(None)
+            if len(position) <= len(hotlist):
+                return 1
+            del position[:]
+            return 0
+
+        weechat.infolist_next.side_effect = infolist_next
+        weechat.infolist_pointer.side_effect = \
+            lambda infolist, name: hotlist[len(position) - 1][name]
+        weechat.infolist_integer.side_effect = \
+            lambda infolist, name: hotlist[len(position) - 1][name]
+
+    def open_history(self, capacity):
+        """Opens a history of notifications in a temporary directory."""
+        path = os.path.join(self.create_temp_dir(), 'history.dat')
+        history = NotificationHistory(path, capacity)
+        self.addCleanup(history.close)
+        return history
+
+
+class NotificationTests(TestsBase):
+    """Tests for Notification."""
+
+    def test_has_no_instance_dict(self):
+        notification = new_notification()
+
+        self.assertFalse(hasattr(notification, '__dict__'))
+
 
 class DefaultValueOfTests(TestsBase):
     """Tests for default_value_of()."""
@@ -171,6 +371,20 @@ class AddDefaultValueToTests(TestsBase):
         self.assertEqual(description, 'Option description. Default: "".')
 
 
+class IntOptionTests(TestsBase):
+    """Tests for int_option()."""
+
+    def test_returns_value_from_config_when_it_is_integer(self):
+        set_config_option('max_length', '10')
+
+        self.assertEqual(int_option('max_length'), 10)
+
+    def test_returns_default_value_when_config_value_is_not_integer(self):
+        set_config_option('max_length', 'xxx')
+
+        self.assertEqual(int_option('max_length'), 72)
+
+
 class NickThatSentMessageTests(TestsBase):
     """Tests for nick_that_sent_message()."""
 
@@ -205,6 +419,111 @@ class NickThatSentMessageTests(TestsBase):
         self.assertEqual(nick_that_sent_message([], ''), '')
 
 
+class ModifierTests(TestsBase):
+    """Tests for modifiers that other scripts can hook."""
+
+    def setUp(self):
+        super().setUp()
+        set_buffer_string('buffer', 'localvar_type', 'private')
+
+        # Mock send_notification().
+        patcher = mock.patch('notify_send.send_notification')
+        self.send_notification = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.send_notification.return_value = '1'
+
+    def hook_modifiers(self, modifiers):
+        """Makes the hook infolist contain the given modifiers and refreshes
+        the hooked modifiers.
+        """
+        weechat.infolist_get.return_value = 'infolist'
+        position = []
+
+        def infolist_next(infolist):
+            position.append(None)
+            return 1 if len(position) <= len(modifiers) else 0
+
+        weechat.infolist_next.side_effect = infolist_next
+        weechat.infolist_string.side_effect = \
+            lambda infolist, name: modifiers[len(position) - 1]
+        refresh_modifier_hooks()
+
+    def message_printed_callback(self, message='message'):
+        return message_printed_callback('', 'buffer', '0', 'nick_john', '1', '0',
+                                        'john', message)
+
+    def test_detects_hooked_modifiers(self):
+        self.hook_modifiers(['weechat_print', 'notify_send_notification'])
+
+        self.assertEqual(notify_send.HOOKED_MODIFIERS,
+                         frozenset(['notify_send_notification']))
+
+    def test_does_not_run_modifiers_when_none_is_hooked(self):
+        self.hook_modifiers(['weechat_print'])
+
+        self.message_printed_callback()
+
+        weechat.hook_modifier_exec.assert_not_called()
+        self.assertTrue(self.send_notification.called)
+
+    def test_should_notify_modifier_gets_message(self):
+        self.hook_modifiers(['notify_send_should_notify'])
+        weechat.hook_modifier_exec.return_value = '1'
+
+        self.message_printed_callback('hello')
+
+        modifier, buffer, string = weechat.hook_modifier_exec.call_args[0]
+        self.assertEqual(modifier, 'notify_send_should_notify')
+        self.assertEqual(buffer, 'buffer')
+        self.assertEqual(json.loads(string), {
+            'nick': 'john',
+            'tags': ['nick_john'],
+            'highlight': False,
+            'message': 'hello',
+        })
+        self.assertTrue(self.send_notification.called)
+
+    def test_should_notify_modifier_can_veto_notification(self):
+        self.hook_modifiers(['notify_send_should_notify'])
+        weechat.hook_modifier_exec.return_value = ''
+
+        self.message_printed_callback()
+
+        self.assertFalse(self.send_notification.called)
+
+    def test_notification_modifier_can_change_notification(self):
+        self.hook_modifiers(['notify_send_notification'])
+        weechat.hook_modifier_exec.side_effect = \
+            lambda modifier, buffer, string: json.dumps(
+                dict(json.loads(string), message='changed', urgency='critical')
+            )
+
+        self.message_printed_callback('hello')
+
+        notification = self.send_notification.call_args[0][1]
+        self.assertEqual(notification.source, 'john')
+        self.assertEqual(notification.message, 'changed')
+        self.assertEqual(notification.urgency, 'critical')
+
+    def test_notification_modifier_can_drop_notification(self):
+        self.hook_modifiers(['notify_send_notification'])
+        weechat.hook_modifier_exec.return_value = ''
+
+        self.message_printed_callback()
+
+        self.assertFalse(self.send_notification.called)
+
+    def test_invalid_notification_from_modifier_is_ignored(self):
+        self.hook_modifiers(['notify_send_notification'])
+        weechat.hook_modifier_exec.return_value = '{"transient": "yes"}'
+
+        self.message_printed_callback('hello')
+
+        notification = self.send_notification.call_args[0][1]
+        self.assertEqual(notification.message, 'hello')
+        self.assertTrue(weechat.prnt.called)
+
+
 class MessagePrintedCallbackTests(TestsBase):
     """Tests for message_printed_callback()."""
 
@@ -255,6 +574,19 @@ class MessagePrintedCallbackTests(TestsBase):
         self.assertFalse(self.send_notification.called)
         self.assertEqual(rc, weechat.WEECHAT_RC_OK)
 
+    def test_appends_sent_notification_to_history_when_it_is_enabled(self):
+        self.notification_should_be_sent.return_value = True
+        self.send_notification.return_value = '42'
+        set_buffer_string('buffer', 'name', 'irc.libera.#weechat')
+        self.time.return_value = 10.0
+        history = self.open_history(10)
+
+        with mock.patch('notify_send.NOTIFICATION_HISTORY', history):
+            self.message_printed_callback(prefix='john', message='hello')
+
+        self.assertEqual(history.entries(),
+                         [(10.0, 42, 'irc.libera.#weechat', 'john', 'hello')])
+
     def test_closes_notification_when_auto_close_prior_buffer_notification_is_on(self):
         self.notification_should_be_sent.return_value = False
         self.i_am_author_of_message.return_value = True
@@ -357,6 +689,33 @@ class NotificationShouldBeSentTests(TestsBase):
 
         self.assertFalse(should_be_sent)
 
+    def test_returns_true_for_current_buffer_when_terminal_is_not_focused(self):
+        set_config_option('notify_for_current_buffer', 'off')
+        BUFFER = 'buffer'
+        weechat.current_buffer.return_value = BUFFER
+        notify_send.TERMINAL_FOCUSED = False
+
+        should_be_sent = self.notification_should_be_sent(buffer=BUFFER, is_highlight=True)
+
+        self.assertTrue(should_be_sent)
+
+    def test_returns_false_when_terminal_is_focused_and_option_is_on(self):
+        set_config_option('notify_only_when_terminal_unfocused', 'on')
+        notify_send.FOCUS_REPORTING = True
+
+        should_be_sent = self.notification_should_be_sent()
+
+        self.assertFalse(should_be_sent)
+
+    def test_returns_true_when_terminal_is_not_focused_and_option_is_on(self):
+        set_config_option('notify_only_when_terminal_unfocused', 'on')
+        notify_send.FOCUS_REPORTING = True
+        notify_send.TERMINAL_FOCUSED = False
+
+        should_be_sent = self.notification_should_be_sent(is_highlight=True)
+
+        self.assertTrue(should_be_sent)
+
     def test_returns_true_when_in_curr_buf_and_notify_on_all_msgs_in_curr_buf_is_on(self):
         set_config_option('notify_on_all_messages_in_current_buffer', 'on')
         BUFFER = 'buffer'
@@ -491,234 +850,1918 @@ class NotificationShouldBeSentTests(TestsBase):
         self.assertFalse(should_be_sent)
 
 
-class IsBelowMinNotificationDelayTests(TestsBase):
-    """Tests for is_below_min_notification_delay()."""
+class NotificationDecisionTests(TestsBase):
+    """Tests for notification_decision()."""
 
-    def test_returns_false_when_min_notification_delay_is_zero(self):
-        BUFFER = 'buffer'
-        set_buffer_string(
-            BUFFER,
-            'localvar_notify_send_last_notification_time',
-            '1.0'
-        )
-        self.time.return_value = 1.0
-        set_config_option('min_notification_delay', 0)
+    def test_returns_option_that_decided_when_notification_should_be_sent(self):
+        decision = notification_decision('buffer', [], 'nick', True, True, '')
 
-        self.assertFalse(is_below_min_notification_delay(BUFFER))
+        self.assertEqual(decision, (True, 'notify_on_highlights'))
 
-    def test_returns_false_when_last_time_is_not_below_min_notification_delay(self):
-        BUFFER = 'buffer'
-        set_buffer_string(
-            BUFFER,
-            'localvar_notify_send_last_notification_time',
-            '0.4'
-        )
-        self.time.return_value = 1.0
-        set_config_option('min_notification_delay', 500)
+    def test_returns_option_that_decided_when_notification_should_not_be_sent(self):
+        set_config_option('ignore_nicks', 'nick')
 
-        self.assertFalse(is_below_min_notification_delay(BUFFER))
+        decision = notification_decision('buffer', [], 'nick', True, True, '')
 
-    def test_returns_true_when_last_time_is_below_min_notification_delay(self):
-        BUFFER = 'buffer'
+        self.assertEqual(decision, (False, 'ignore_nicks'))
+
+    def test_returns_min_notification_delay_when_below_min_notification_delay(self):
         set_buffer_string(
-            BUFFER,
+            'buffer',
             'localvar_notify_send_last_notification_time',
-            '1.4'
+            '0.7'
         )
+        set_config_option('min_notification_delay', '500')
         self.time.return_value = 1.0
-        set_config_option('min_notification_delay', 500)
 
-        self.assertTrue(is_below_min_notification_delay(BUFFER))
+        decision = notification_decision('buffer', [], 'nick', True, True, '')
 
-    def test_updates_last_notification_time(self):
-        CURRENT_TIME = 1.0
-        self.time.return_value = CURRENT_TIME
-        BUFFER = 'buffer'
+        self.assertEqual(decision, (False, 'min_notification_delay'))
 
-        is_below_min_notification_delay(BUFFER)
 
-        weechat.buffer_set.assert_called_once_with(
-            BUFFER,
-            'localvar_set_notify_send_last_notification_time',
-            str(CURRENT_TIME)
-        )
+class DecisionTraceTests(TestsBase):
+    """Tests for DecisionTrace."""
 
+    def test_entries_returns_empty_list_when_nothing_was_recorded(self):
+        trace = DecisionTrace(3)
 
-class NamesForBufferTests(TestsBase):
-    """Tests for names_for_buffer()."""
+        self.assertEqual(trace.entries(), [])
 
-    def test_returns_correct_list_when_buffer_has_both_names(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
+    def test_entries_returns_recorded_decisions_from_oldest_to_newest(self):
+        trace = DecisionTrace(3)
+        trace.record(1.0, 0.1, 'buffer1', 'nick1', True, 'reason1')
+        trace.record(2.0, 0.2, 'buffer2', 'nick2', False, 'reason2')
 
-        self.assertEqual(
-            names_for_buffer(BUFFER),
-            ['network.#buffer', '#buffer']
-        )
+        self.assertEqual(trace.entries(), [
+            (1.0, 0.1, 'buffer1', 'nick1', True, 'reason1'),
+            (2.0, 0.2, 'buffer2', 'nick2', False, 'reason2'),
+        ])
 
-    def test_includes_short_name_with_hash_when_short_name_starts_with_gt(self):
-        # This may happen with the wee_slack script, see the comment in
-        # names_for_buffer().
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '>buffer')
+    def test_oldest_decisions_are_overwritten_when_trace_is_full(self):
+        trace = DecisionTrace(2)
+        for i in range(5):
+            trace.record(float(i), 0.0, 'buffer', 'nick', True, str(i))
 
-        self.assertEqual(
-            names_for_buffer(BUFFER),
-            ['network.#buffer', '>buffer', '#buffer']
-        )
+        reasons = [entry[5] for entry in trace.entries()]
+        self.assertEqual(reasons, ['3', '4'])
 
-    def test_returns_empty_list_when_buffer_has_no_name(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', '')
-        set_buffer_string(BUFFER, 'short_name', '')
+    def test_entries_returns_only_given_number_of_newest_decisions(self):
+        trace = DecisionTrace(5)
+        for i in range(4):
+            trace.record(float(i), 0.0, 'buffer', 'nick', True, str(i))
 
-        self.assertEqual(names_for_buffer(BUFFER), [])
+        reasons = [entry[5] for entry in trace.entries(2)]
+        self.assertEqual(reasons, ['2', '3'])
 
+    def test_notification_should_be_sent_records_decision_when_tracing_is_enabled(self):
+        trace = DecisionTrace(2)
+        self.time.return_value = 10.0
 
-class IgnoreNotificationsFromMessagesTaggedWith(TestsBase):
-    """Tests for ignore_notifications_from_messages_tagged_with()."""
+        with mock.patch('notify_send.DECISION_TRACE', trace):
+            notification_should_be_sent('buffer', [], 'nick', True, True, '')
 
-    def test_returns_false_when_no_tags_are_ignored(self):
-        set_config_option('ignore_messages_tagged_with', '')
+        entry = trace.entries()[0]
+        self.assertEqual(entry[0], 10.0)
+        self.assertEqual(entry[2:], ('buffer', 'nick', True, 'notify_on_highlights'))
 
-        self.assertFalse(
-            ignore_notifications_from_messages_tagged_with(['tag1', 'tag2'])
-        )
 
-    def test_returns_false_when_no_tag_is_between_ignored(self):
-        set_config_option('ignore_messages_tagged_with', 'tagA,tagB')
+class NotificationHistoryTests(TestsBase):
+    """Tests for NotificationHistory."""
 
-        self.assertFalse(
-            ignore_notifications_from_messages_tagged_with(['tag1', 'tag2'])
-        )
+    def test_entries_returns_empty_list_for_new_history(self):
+        history = self.open_history(3)
 
-    def test_returns_true_when_tag_is_between_ignored(self):
-        set_config_option('ignore_messages_tagged_with', 'tag3,tag4,tag5')
+        self.assertEqual(history.entries(), [])
 
-        self.assertTrue(
-            ignore_notifications_from_messages_tagged_with(['tag0', 'tag2', 'tag3'])
-        )
+    def test_entries_returns_appended_notifications_from_oldest_to_newest(self):
+        history = self.open_history(3)
+        history.append(1.0, 1, 'buffer1', 'nick1', 'message1')
+        history.append(2.0, 2, 'buffer2', 'nick2', 'message2')
 
+        self.assertEqual(history.entries(), [
+            (1.0, 1, 'buffer1', 'nick1', 'message1'),
+            (2.0, 2, 'buffer2', 'nick2', 'message2'),
+        ])
 
-class IgnoreNotificationsFromBufferTests(TestsBase):
-    """Tests for ignore_notifications_from_buffer()."""
+    def test_oldest_notifications_are_overwritten_when_history_is_full(self):
+        history = self.open_history(2)
+        for i in range(5):
+            history.append(float(i), i, 'buffer', 'nick', 'message')
 
-    def test_returns_false_when_nothing_is_ignored(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers', '')
-        set_config_option('ignore_buffers_starting_with', '')
+        self.assertEqual([entry[1] for entry in history.entries()], [3, 4])
 
-        self.assertFalse(ignore_notifications_from_buffer(BUFFER))
+    def test_file_has_fixed_size(self):
+        history = self.open_history(4)
+        size = os.path.getsize(history.path)
+        for i in range(10):
+            history.append(float(i), i, 'buffer', 'nick', 'message')
 
-    def test_returns_false_when_buffer_has_no_name(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', '')
-        set_buffer_string(BUFFER, 'short_name', '')
-        set_config_option('ignore_buffers', '')
-        set_config_option('ignore_buffers_starting_with', '')
+        self.assertEqual(os.path.getsize(history.path), size)
 
-        self.assertFalse(ignore_notifications_from_buffer(BUFFER))
+    def test_notifications_are_kept_after_reopening(self):
+        history = self.open_history(3)
+        history.append(1.0, 1, 'buffer', 'nick', 'message')
+        history.close()
 
-    def test_returns_false_when_buffer_is_not_between_ignored(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers', '#buffer1,#buffer2,#buffer3')
+        history = NotificationHistory(history.path, 3)
+        self.addCleanup(history.close)
 
-        self.assertFalse(ignore_notifications_from_buffer(BUFFER))
+        self.assertEqual(history.entries(), [(1.0, 1, 'buffer', 'nick', 'message')])
 
-    def test_returns_true_when_buffer_is_ignored_by_short_name(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers', '#buffer')
+    def test_notifications_are_discarded_when_capacity_differs(self):
+        history = self.open_history(3)
+        history.append(1.0, 1, 'buffer', 'nick', 'message')
+        history.close()
 
-        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+        history = NotificationHistory(history.path, 4)
+        self.addCleanup(history.close)
 
-    def test_returns_true_when_buffer_is_ignored_by_full_name(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers', 'network.#buffer')
+        self.assertEqual(history.entries(), [])
 
-        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+    def test_long_texts_are_truncated(self):
+        history = self.open_history(1)
+        history.append(1.0, 1, 'b' * 100, 'n' * 100, 'm' * 1000)
 
-    def test_returns_true_when_buffer_is_between_ignored_by_short_name(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers', '#aaa,#buffer,#bbb')
+        _, _, buffer, nick, message = history.entries()[0]
+        self.assertEqual(buffer, 'b' * 64)
+        self.assertEqual(nick, 'n' * 32)
+        self.assertEqual(message, 'm' * 160)
 
-        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
 
-    def test_returns_true_when_buffer_is_between_ignored_by_full_name(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers', '#aaa,network.#buffer,#bbb')
+class EncodeHistoryFieldTests(TestsBase):
+    """Tests for encode_history_field()."""
 
-        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+    def test_returns_whole_text_when_it_fits(self):
+        self.assertEqual(encode_history_field('ab', 2), b'ab')
 
-    def test_strips_beginning_and_trailing_whitespace_from_ignored_buffers(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers', '  #buffer  ')
+    def test_does_not_split_multibyte_character(self):
+        self.assertEqual(encode_history_field('a\u010d', 2), b'a')
 
-        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
 
-    def test_returns_false_when_buffer_is_not_prefixed_with_ignored_prefix(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers_starting_with', 'some_prefix')
+class BufferOptionTests(TestsBase):
+    """Tests for buffer_option() and apply_buffer_overrides_config()."""
 
-        self.assertFalse(ignore_notifications_from_buffer(BUFFER))
+    def setUp(self):
+        super().setUp()
+        set_buffer_string('buffer', 'name', 'irc.libera.#weechat')
+        set_buffer_string('buffer', 'short_name', '#weechat')
+        weechat.string_match.side_effect = \
+            lambda string, mask, case_sensitive: fnmatch.fnmatch(string, mask)
 
-    def test_returns_true_when_buffer_full_name_is_prefixed_with_ignored_prefix(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers_starting_with', '#aaa,network.,#bbb')
+    def set_overrides(self, overrides):
+        """Makes the option infolist return the given (name, value) pairs and
+        applies them.
+        """
+        weechat.infolist_get.return_value = 'infolist'
+        options = [
+            {'full_name': 'plugins.var.python.notify_send.' + name, 'value': value}
+            for name, value in overrides
+        ]
+        position = []
 
-        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+        def infolist_next(infolist):
+            position.append(None)
+            return 1 if len(position) <= len(options) else 0
 
-    def test_returns_true_when_buffer_short_name_is_prefixed_with_ignored_prefix(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers_starting_with', '#aaa,#buf,#bbb')
+        weechat.infolist_next.side_effect = infolist_next
+        weechat.infolist_string.side_effect = \
+            lambda infolist, name: options[len(position) - 1][name]
+        apply_buffer_overrides_config()
 
-        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+    def test_returns_option_value_when_there_are_no_overrides(self):
+        set_config_option('urgency', 'normal')
 
-    def test_strips_beginning_and_trailing_whitespace_from_ignored_prefixes(self):
-        BUFFER = 'buffer'
-        set_buffer_string(BUFFER, 'name', 'network.#buffer')
-        set_buffer_string(BUFFER, 'short_name', '#buffer')
-        set_config_option('ignore_buffers_starting_with', '  network.  ')
+        self.assertEqual(buffer_option('buffer', 'urgency'), 'normal')
+        weechat.string_match.assert_not_called()
 
-        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+    def test_returns_override_for_matching_buffer(self):
+        set_config_option('urgency', 'normal')
+        self.set_overrides([('urgency.irc.libera.*', 'critical')])
 
+        self.assertEqual(buffer_option('buffer', 'urgency'), 'critical')
 
-class IgnoreNotificationsFromNickTests(TestsBase):
-    """Tests for ignore_notifications_from_nick()."""
+    def test_returns_override_when_short_name_matches(self):
+        self.set_overrides([('timeout.#weechat', '1000')])
 
-    def test_returns_false_when_nothing_is_ignored(self):
-        set_config_option('ignore_nicks', '')
-        set_config_option('ignore_nicks_starting_with', '')
+        self.assertEqual(buffer_option('buffer', 'timeout'), '1000')
 
-        self.assertFalse(ignore_notifications_from_nick('nick'))
+    def test_returns_option_value_for_buffer_that_does_not_match(self):
+        set_config_option('urgency', 'normal')
+        self.set_overrides([('urgency.irc.oftc.*', 'critical')])
 
-    def test_returns_false_when_nick_is_not_between_ignored(self):
-        set_config_option('ignore_nicks', 'nick1,nick2,nick3')
+        self.assertEqual(buffer_option('buffer', 'urgency'), 'normal')
 
-        self.assertFalse(ignore_notifications_from_nick('wizard'))
+    def test_most_specific_override_wins(self):
+        self.set_overrides([
+            ('urgency.irc.*', 'low'),
+            ('urgency.irc.libera.#weechat', 'critical'),
+            ('urgency.irc.libera.*', 'normal'),
+        ])
 
-    def test_returns_true_when_nick_is_ignored(self):
+        self.assertEqual(buffer_option('buffer', 'urgency'), 'critical')
+
+    def test_ignores_options_that_cannot_be_overridden(self):
+        self.set_overrides([('nick_separator.irc.*', ' says ')])
+
+        self.assertEqual(notify_send.BUFFER_OVERRIDES, [])
+
+    def test_ignores_options_without_mask(self):
+        self.set_overrides([('urgency', 'normal')])
+
+        self.assertEqual(notify_send.BUFFER_OVERRIDES, [])
+
+    def test_policy_is_compiled_only_once_per_buffer(self):
+        self.set_overrides([('urgency.irc.*', 'low'), ('timeout.irc.*', '1')])
+
+        buffer_option('buffer', 'urgency')
+        calls = weechat.string_match.call_count
+        buffer_option('buffer', 'timeout')
+        buffer_option('buffer', 'urgency')
+
+        self.assertEqual(weechat.string_match.call_count, calls)
+
+    def test_applying_overrides_clears_policies(self):
+        self.set_overrides([('urgency.irc.*', 'low')])
+        buffer_option('buffer', 'urgency')
+
+        self.set_overrides([('urgency.irc.*', 'critical')])
+
+        self.assertEqual(buffer_option('buffer', 'urgency'), 'critical')
+
+    def test_buffer_changed_callback_forgets_policy_of_buffer(self):
+        self.set_overrides([('urgency.irc.libera.*', 'low')])
+        buffer_option('buffer', 'urgency')
+        set_buffer_string('buffer', 'name', 'irc.oftc.#weechat')
+        set_buffer_string('buffer', 'short_name', '#other')
+        set_config_option('urgency', 'normal')
+
+        rc = buffer_changed_callback('', 'buffer_renamed', 'buffer')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(buffer_option('buffer', 'urgency'), 'normal')
+
+    def test_prepare_notification_uses_overrides(self):
+        set_buffer_string('buffer', 'localvar_type', 'private')
+        set_config_option('max_length', '0')
+        self.set_overrides([
+            ('urgency.#weechat', 'critical'),
+            ('max_length.#weechat', '3'),
+            ('ellipsis.#weechat', '..'),
+            ('transient.#weechat', 'off'),
+        ])
+
+        notification = prepare_notification('buffer', 'nick', 'message')
+
+        self.assertEqual(notification.urgency, 'critical')
+        self.assertEqual(notification.message, 'm..')
+        self.assertFalse(notification.transient)
+
+    def test_min_notification_delay_uses_overrides(self):
+        set_config_option('min_notification_delay', '0')
+        self.set_overrides([('min_notification_delay.#weechat', '1000')])
+        set_buffer_string('buffer', 'localvar_notify_send_last_notification_time', '0')
+        self.time.return_value = 0.5
+
+        self.assertTrue(is_below_min_notification_delay('buffer'))
+
+
+class InputActivityTests(TestsBase):
+    """Tests for suppressing notifications while typing."""
+
+    def setUp(self):
+        super().setUp()
+        set_config_option('suppress_while_typing', '5')
+        weechat.hook_signal.return_value = 'input_hook'
+        apply_input_activity_config()
+
+    def decision(self):
+        return notification_decision('buffer', [], 'nick', True, True, 'message')
+
+    def test_tracks_input_only_when_enabled(self):
+        weechat.hook_signal.assert_called_once_with(
+            'input_text_changed', 'input_activity_callback', ''
+        )
+
+        set_config_option('suppress_while_typing', '0')
+        apply_input_activity_config()
+
+        weechat.unhook.assert_called_once_with('input_hook')
+        self.assertEqual(notify_send.INPUT_ACTIVITY_HOOK, '')
+
+    def test_suppresses_notifications_shortly_after_typing(self):
+        self.time.return_value = 100.0
+        rc = input_activity_callback('', 'input_text_changed', 'buffer')
+        self.time.return_value = 104.0
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(self.decision(), (False, 'suppress_while_typing'))
+
+    def test_sends_notifications_when_user_has_not_typed_for_a_while(self):
+        self.time.return_value = 100.0
+        input_activity_callback('', 'input_text_changed', 'buffer')
+        self.time.return_value = 105.0
+
+        self.assertEqual(self.decision(), (True, 'notify_on_highlights'))
+
+    def test_hotlist_engine_suppresses_notifications_after_typing(self):
+        self.time.return_value = 100.0
+        input_activity_callback('', 'input_text_changed', 'buffer')
+
+        self.assertFalse(hotlist_notification_should_be_sent('buffer', True, True, True))
+
+
+class RuleTests(TestsBase):
+    """Tests for notification rules (see apply_rules_config())."""
+
+    def setUp(self):
+        super().setUp()
+        set_buffer_string('buffer', 'name', 'irc.libera.#ops')
+        set_buffer_string('buffer', 'short_name', '#ops')
+        set_buffer_string('buffer', 'localvar_server', 'libera')
+        weechat.string_match.side_effect = \
+            lambda string, mask, case_sensitive: fnmatch.fnmatch(string, mask)
+
+    def set_rules(self, rules):
+        """Makes the option infolist return the given (name, value) pairs and
+        applies them.
+        """
+        weechat.infolist_get.return_value = 'infolist'
+        options = [
+            {'full_name': 'plugins.var.python.notify_send.' + name, 'value': value}
+            for name, value in rules
+        ]
+        position = []
+
+        def infolist_next(infolist):
+            position.append(None)
+            return 1 if len(position) <= len(options) else 0
+
+        weechat.infolist_next.side_effect = infolist_next
+        weechat.infolist_string.side_effect = \
+            lambda infolist, name: options[len(position) - 1][name]
+        apply_rules_config()
+
+    def decision(self, tags=(), nick='nick', is_highlight=False, message='message'):
+        return notification_decision('buffer', list(tags), nick, True,
+                                     is_highlight, message)
+
+    def test_parses_conditions_and_action(self):
+        rule = parse_rule(
+            'rule.3',
+            r'buffer=#ops nick=*bot tag=irc_privmsg highlight "message=\bx y" '
+            '-> notify:critical'
+        )
+
+        self.assertEqual(rule.number, 3)
+        self.assertEqual(rule.buffer_masks, ['#ops'])
+        self.assertEqual(rule.nick_masks, ['*bot'])
+        self.assertEqual(rule.tags, ['irc_privmsg'])
+        self.assertTrue(rule.highlight)
+        self.assertEqual(rule.message_patterns[0].pattern, r'\bx y')
+        self.assertTrue(rule.notify)
+        self.assertEqual(rule.urgency, 'critical')
+
+    def test_parses_drop_action(self):
+        rule = parse_rule('rule.1', 'buffer=#random -> drop')
+
+        self.assertFalse(rule.notify)
+
+    def test_rejects_invalid_rules(self):
+        for name, value in [
+                ('rule.x', '-> drop'),
+                ('rule.1', 'buffer=#ops'),
+                ('rule.1', 'buffer=#ops -> ignore'),
+                ('rule.1', 'buffer=#ops -> drop:low'),
+                ('rule.1', 'buffer=#ops -> notify:urgent'),
+                ('rule.1', 'channel=#ops -> drop'),
+                ('rule.1', 'buffer= -> drop'),
+                ('rule.1', 'message=( -> drop')]:
+            with self.assertRaises(ValueError, msg=value):
+                parse_rule(name, value)
+
+    def test_invalid_rule_is_reported_and_skipped(self):
+        self.set_rules([('rule.1', 'buffer=#ops -> ignore'),
+                        ('rule.2', 'buffer=#ops -> drop')])
+
+        self.assertEqual(self.decision(is_highlight=True), (False, 'rule.2'))
+        self.assertTrue(weechat.prnt.called)
+
+    def test_options_decide_when_there_are_no_rules(self):
+        self.set_rules([])
+
+        self.assertIsNone(notify_send.NOTIFICATION_RULES)
+        self.assertEqual(self.decision(is_highlight=True), (True, 'notify_on_highlights'))
+
+    def test_options_decide_when_no_rule_matches(self):
+        self.set_rules([('rule.1', 'buffer=#random -> drop')])
+
+        self.assertEqual(self.decision(is_highlight=True), (True, 'notify_on_highlights'))
+
+    def test_first_matching_rule_by_number_wins(self):
+        self.set_rules([
+            ('rule.10', 'buffer=#ops -> drop'),
+            ('rule.2', 'buffer=#ops message=deploy -> notify'),
+        ])
+
+        self.assertEqual(self.decision(message='deploy failed'), (True, 'rule.2'))
+        self.assertEqual(self.decision(message='lunch?'), (False, 'rule.10'))
+
+    def test_rules_take_precedence_over_options(self):
+        set_config_option('ignore_nicks', 'deploybot')
+        self.set_rules([('rule.1', 'server=libera nick=*bot -> notify')])
+
+        self.assertEqual(self.decision(nick='deploybot'), (True, 'rule.1'))
+
+    def test_rule_matches_only_when_all_conditions_hold(self):
+        self.set_rules([('rule.1', 'buffer=#ops highlight private -> drop')])
+
+        self.assertEqual(self.decision(is_highlight=True), (True, 'notify_on_highlights'))
+
+    def test_tagged_rule_is_looked_at_only_for_messages_with_its_tag(self):
+        self.set_rules([
+            ('rule.1', 'tag=irc_notice -> drop'),
+            ('rule.2', 'buffer=#ops -> notify'),
+        ])
+
+        self.assertEqual(self.decision(tags=['irc_privmsg']), (True, 'rule.2'))
+        self.assertEqual(self.decision(tags=['irc_privmsg', 'irc_notice']),
+                         (False, 'rule.1'))
+
+    def test_conditions_on_buffer_are_evaluated_once_per_buffer(self):
+        self.set_rules([('rule.1', 'buffer=#ops message=x -> notify')])
+
+        self.decision()
+        calls = weechat.string_match.call_count
+        self.decision()
+
+        self.assertEqual(weechat.string_match.call_count, calls)
+
+    def test_renamed_buffer_is_matched_again(self):
+        self.set_rules([('rule.1', 'buffer=#ops -> drop')])
+        self.decision()
+        set_buffer_string('buffer', 'short_name', '#random')
+        set_buffer_string('buffer', 'name', 'irc.libera.#random')
+
+        buffer_changed_callback('', 'buffer_renamed', 'buffer')
+
+        self.assertEqual(self.decision(is_highlight=True), (True, 'notify_on_highlights'))
+
+    def test_urgency_of_matching_rule_is_used_for_notification(self):
+        self.set_rules([('rule.1', 'buffer=#ops -> notify:critical')])
+
+        with mock.patch('notify_send.send_notification') as send_notification:
+            message_printed_callback('', 'buffer', '0', '', '1', '0', 'nick', 'hi')
+
+        notification = send_notification.call_args[0][1]
+        self.assertEqual(notification.urgency, 'critical')
+
+    def test_rules_require_print_engine_in_auto_mode(self):
+        set_config_option('engine', 'auto')
+        self.set_rules([('rule.1', 'buffer=#ops -> notify')])
+
+        self.assertEqual(notification_engine_config(), ('print', 0))
+
+
+class FocusTests(TestsBase):
+    """Tests for tracking of the current buffer and terminal focus."""
+
+    def test_current_buffer_asks_weechat_when_not_tracked(self):
+        weechat.current_buffer.return_value = 'buffer'
+
+        self.assertEqual(current_buffer(), 'buffer')
+
+    def test_focus_changed_callback_remembers_current_buffer(self):
+        weechat.current_buffer.return_value = 'buffer'
+
+        rc = focus_changed_callback('', 'buffer_switch', 'buffer')
+        weechat.current_buffer.reset_mock()
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(current_buffer(), 'buffer')
+        weechat.current_buffer.assert_not_called()
+
+    def test_focus_reporting_is_off_with_default_options(self):
+        apply_config()
+
+        self.assertFalse(notify_send.FOCUS_REPORTING)
+        weechat.command.assert_not_called()
+
+    def test_focus_reporting_is_turned_on_when_needed(self):
+        set_config_option('notify_only_when_terminal_unfocused', 'on')
+
+        apply_config()
+
+        self.assertTrue(notify_send.FOCUS_REPORTING)
+        weechat.command.assert_any_call('', '/print -stdout \\033[?1004h')
+        weechat.command.assert_any_call(
+            '', '/mute /key bind meta2-I /notify_send focus in'
+        )
+        weechat.command.assert_any_call(
+            '', '/mute /key bind meta2-O /notify_send focus out'
+        )
+
+    def test_focus_reporting_is_not_turned_on_when_current_buffer_is_not_notified(self):
+        set_config_option('notify_for_current_buffer', 'off')
+
+        apply_config()
+
+        self.assertFalse(notify_send.FOCUS_REPORTING)
+        weechat.command.assert_not_called()
+
+    def test_focus_reporting_is_turned_off_when_no_longer_needed(self):
+        set_config_option('notify_only_when_terminal_unfocused', 'on')
+        apply_config()
+        notify_send.TERMINAL_FOCUSED = False
+        weechat.command.reset_mock()
+        set_config_option('notify_only_when_terminal_unfocused', 'off')
+
+        apply_config()
+
+        self.assertFalse(notify_send.FOCUS_REPORTING)
+        self.assertTrue(notify_send.TERMINAL_FOCUSED)
+        weechat.command.assert_any_call('', '/print -stdout \\033[?1004l')
+        weechat.command.assert_any_call('', '/mute /key unbind meta2-I')
+
+    def test_focus_reporting_restores_previous_bindings_of_keys(self):
+        set_config_option('notify_only_when_terminal_unfocused', 'on')
+        weechat.infolist_get.side_effect = \
+            lambda name, pointer, arguments: 'infolist' if name == 'key' else ''
+        # A single key binding, found for meta2-I, looked through for meta2-O.
+        weechat.infolist_next.side_effect = [1, 1, 0]
+        weechat.infolist_string.side_effect = \
+            lambda infolist, name: {'key': 'meta2-I', 'command': '/my_command'}[name]
+        apply_config()
+        weechat.command.reset_mock()
+        set_config_option('notify_only_when_terminal_unfocused', 'off')
+
+        apply_config()
+
+        weechat.command.assert_any_call('', '/mute /key bind meta2-I /my_command')
+        weechat.command.assert_any_call('', '/mute /key unbind meta2-O')
+
+    def test_shutdown_turns_focus_reporting_off(self):
+        set_config_option('notify_only_when_terminal_unfocused', 'on')
+        apply_config()
+
+        shutdown_callback()
+
+        self.assertFalse(notify_send.FOCUS_REPORTING)
+
+    def test_focus_command_sets_terminal_focus(self):
+        command_callback('', 'buffer', 'focus out')
+        self.assertFalse(notify_send.TERMINAL_FOCUSED)
+
+        command_callback('', 'buffer', 'focus in')
+        self.assertTrue(notify_send.TERMINAL_FOCUSED)
+
+    def test_focus_command_rejects_invalid_argument(self):
+        rc = command_callback('', 'buffer', 'focus sideways')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_ERROR)
+        self.assertTrue(notify_send.TERMINAL_FOCUSED)
+
+
+class ApplyConfigTests(TestsBase):
+    """Tests for apply_config()."""
+
+    def test_disables_tracing_when_trace_size_is_zero(self):
+        notify_send.DECISION_TRACE = DecisionTrace(2)
+        set_config_option('trace_size', '0')
+
+        apply_config()
+
+        self.assertIsNone(notify_send.DECISION_TRACE)
+
+    def test_enables_tracing_when_trace_size_is_positive(self):
+        set_config_option('trace_size', '10')
+
+        apply_config()
+
+        self.assertEqual(notify_send.DECISION_TRACE.size, 10)
+
+    def test_keeps_recorded_decisions_when_trace_size_does_not_change(self):
+        trace = DecisionTrace(10)
+        notify_send.DECISION_TRACE = trace
+        set_config_option('trace_size', '10')
+
+        apply_config()
+
+        self.assertIs(notify_send.DECISION_TRACE, trace)
+
+
+class ApplyHistoryConfigTests(TestsBase):
+    """Tests for the history part of apply_config()."""
+
+    def setUp(self):
+        super().setUp()
+        weechat.info_get.return_value = self.create_temp_dir()
+        self.addCleanup(self.close_history)
+
+    def close_history(self):
+        if notify_send.NOTIFICATION_HISTORY is not None:
+            notify_send.NOTIFICATION_HISTORY.close()
+
+    def test_opens_history_in_data_dir_when_history_size_is_positive(self):
+        set_config_option('history_size', '5')
+
+        apply_config()
+
+        history = notify_send.NOTIFICATION_HISTORY
+        self.assertEqual(history.capacity, 5)
+        self.assertEqual(
+            history.path,
+            os.path.join(weechat.info_get.return_value, 'notify_send_history.dat')
+        )
+
+    def test_keeps_newest_notifications_when_history_size_changes(self):
+        set_config_option('history_size', '5')
+        apply_config()
+        for i in range(4):
+            notify_send.NOTIFICATION_HISTORY.append(float(i), i, 'b', 'n', 'm')
+        set_config_option('history_size', '2')
+
+        apply_config()
+
+        history = notify_send.NOTIFICATION_HISTORY
+        self.assertEqual([entry[1] for entry in history.entries()], [2, 3])
+
+    def test_closes_history_when_history_size_is_zero(self):
+        set_config_option('history_size', '5')
+        apply_config()
+        set_config_option('history_size', '0')
+
+        apply_config()
+
+        self.assertIsNone(notify_send.NOTIFICATION_HISTORY)
+
+    def test_prints_error_when_history_cannot_be_opened(self):
+        weechat.info_get.return_value = os.path.join(self.create_temp_dir(), 'xxx')
+        set_config_option('history_size', '5')
+
+        apply_config()
+
+        self.assertIsNone(notify_send.NOTIFICATION_HISTORY)
+        self.assertIn('cannot open', weechat.prnt.call_args[0][1])
+
+
+def local_time(hour, minute, day=1):
+    """Returns the time of the given local time on the given day of January
+    2024.
+    """
+    return time.mktime((2024, 1, day, hour, minute, 0, 0, 0, -1))
+
+
+class DndTests(TestsBase):
+    """Tests for do-not-disturb."""
+
+    def setUp(self):
+        super().setUp()
+        weechat.hook_print.return_value = 'print_hook'
+        weechat.hook_timer.return_value = 'timer_hook'
+        weechat.infolist_get.return_value = ''
+        hook_notifications()
+
+    def test_dnd_start_unhooks_print_hook(self):
+        dnd_start()
+
+        weechat.unhook.assert_called_once_with('print_hook')
+        self.assertEqual(notify_send.NOTIFICATION_HOOKS, [])
+        weechat.hook_timer.assert_not_called()
+
+    def test_dnd_start_with_end_time_hooks_timer(self):
+        self.time.return_value = 100.0
+
+        dnd_start(160.0)
+
+        weechat.hook_timer.assert_called_once_with(
+            60000, 0, 1, 'dnd_timer_callback', ''
+        )
+        self.assertEqual(notify_send.DND_UNTIL, 160.0)
+
+    def test_dnd_stop_hooks_print_hook_again(self):
+        dnd_start(160.0)
+        weechat.hook_print.reset_mock()
+
+        dnd_stop()
+
+        weechat.hook_print.assert_called_once_with(
+            '', '', '', 1, 'message_printed_callback', ''
+        )
+        weechat.unhook.assert_called_with('timer_hook')
+        self.assertIsNone(notify_send.DND_UNTIL)
+
+    def test_dnd_stop_does_nothing_when_dnd_is_not_active(self):
+        weechat.hook_print.reset_mock()
+
+        dnd_stop()
+
+        weechat.hook_print.assert_not_called()
+
+    def test_dnd_timer_callback_stops_dnd(self):
+        dnd_start(160.0)
+
+        dnd_timer_callback('', 0)
+
+        self.assertIsNone(notify_send.DND_UNTIL)
+        self.assertEqual(notify_send.NOTIFICATION_HOOKS, ['print_hook'])
+
+    def test_dnd_timer_callback_extends_dnd_when_within_quiet_hours(self):
+        set_config_option('quiet_hours', '12:00-13:00')
+        self.time.return_value = local_time(12, 30)
+        dnd_start(local_time(12, 30))
+
+        dnd_timer_callback('', 0)
+
+        self.assertEqual(notify_send.DND_UNTIL, local_time(13, 0))
+
+    def test_dnd_stop_sends_digest_of_new_highlights_and_private_messages(self):
+        set_config_option('dnd_digest', 'on')
+        hotlist = [
+            {'buffer_pointer': 'buffer1', 'count_01': 0, 'count_02': 0, 'count_03': 1},
+        ]
+        self.mock_hotlist(hotlist)
+        dnd_start()
+        hotlist[:] = [
+            {'buffer_pointer': 'buffer1', 'count_01': 0, 'count_02': 0, 'count_03': 3},
+            {'buffer_pointer': 'buffer2', 'count_01': 0, 'count_02': 1, 'count_03': 0},
+            {'buffer_pointer': 'buffer3', 'count_01': 5, 'count_02': 0, 'count_03': 0},
+        ]
+        set_buffer_string('buffer1', 'short_name', '#weechat')
+        set_buffer_string('buffer2', 'short_name', 'john')
+
+        with mock.patch('notify_send.send_notification') as send_notification:
+            dnd_stop()
+
+        notification = send_notification.call_args[0][1]
+        self.assertEqual(notification.message, '#weechat (2), john (1)')
+
+    def test_dnd_stop_does_not_send_digest_when_nothing_happened(self):
+        set_config_option('dnd_digest', 'on')
+        self.mock_hotlist([])
+        dnd_start()
+
+        with mock.patch('notify_send.send_notification') as send_notification:
+            dnd_stop()
+
+        send_notification.assert_not_called()
+
+
+class AwayDigestTests(TestsBase):
+    """Tests for digests of notifications collected while away."""
+
+    def setUp(self):
+        super().setUp()
+        set_config_option('away_digest', 'on')
+        set_config_option('notify_when_away', 'off')
+        weechat.hook_signal.return_value = 'unaway_hook'
+        apply_away_digest_config()
+        for buffer, name in [('buffer1', '#weechat'), ('buffer2', '#python')]:
+            set_buffer_string(buffer, 'short_name', name)
+            set_buffer_string(buffer, 'localvar_server', 'libera')
+            set_buffer_string(buffer, 'localvar_away', 'gone')
+        self.time.return_value = local_time(14, 2)
+
+        patcher = mock.patch('notify_send.send_notification')
+        self.send_notification = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def collect(self, buffer, nick, message):
+        decision = notification_decision(buffer, [], nick, True, True, message)
+        self.assertEqual(decision, (False, 'away_digest'))
+
+    def come_back(self, server='libera'):
+        for buffer in ['buffer1', 'buffer2']:
+            set_buffer_string(buffer, 'localvar_away', '')
+        return unaway_callback('', server + ',irc_in2_305', '')
+
+    def test_hooks_signal_of_coming_back_only_when_enabled(self):
+        weechat.hook_signal.assert_called_once_with(
+            '*,irc_in2_305', 'unaway_callback', ''
+        )
+
+        set_config_option('away_digest', 'off')
+        apply_away_digest_config()
+
+        weechat.unhook.assert_called_once_with('unaway_hook')
+        self.assertIsNone(notify_send.AWAY_DIGEST)
+
+    def test_messages_that_would_not_be_notified_are_not_collected(self):
+        set_config_option('ignore_nicks', 'bot')
+
+        decision = notification_decision('buffer1', [], 'bot', True, True, 'hi')
+
+        self.assertEqual(decision, (False, 'ignore_nicks'))
+        self.assertEqual(notify_send.AWAY_DIGEST.buffers, {})
+
+    def test_messages_are_notified_when_not_away(self):
+        set_buffer_string('buffer1', 'localvar_away', '')
+
+        decision = notification_decision('buffer1', [], 'john', True, True, 'hi')
+
+        self.assertEqual(decision, (True, 'notify_on_highlights'))
+
+    def test_sends_single_digest_when_coming_back(self):
+        self.collect('buffer1', 'john', 'one')
+        self.time.return_value = local_time(14, 30)
+        self.collect('buffer2', 'jane', 'two')
+        self.collect('buffer1', 'john', 'three')
+
+        rc = self.come_back()
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.send_notification.assert_called_once()
+        notification = self.send_notification.call_args[0][1]
+        self.assertEqual(notification.source, 'While you were away')
+        self.assertIn('#weechat (2 since 14:02)\njohn: one\njohn: three',
+                      notification.message)
+        self.assertIn('#python (1 since 14:30)\njane: two', notification.message)
+
+    def test_sends_digest_for_every_buffer_when_requested(self):
+        set_config_option('away_digest', 'buffer')
+        self.collect('buffer1', 'john', 'one')
+        self.collect('buffer2', 'jane', 'two')
+
+        self.come_back()
+
+        notifications = {
+            call[0][0]: call[0][1] for call in self.send_notification.call_args_list
+        }
+        self.assertEqual(notifications['buffer1'].source, '#weechat (1 since 14:02)')
+        self.assertEqual(notifications['buffer1'].message, 'john: one')
+        self.assertEqual(notifications['buffer2'].message, 'jane: two')
+
+    def test_digest_keeps_only_most_recent_lines(self):
+        set_config_option('away_digest_lines', '2')
+        set_config_option('away_digest', 'buffer')
+        notify_send.AWAY_DIGEST = None
+        apply_away_digest_config()
+        for message in ['one', 'two', 'three']:
+            self.collect('buffer1', 'john', message)
+
+        self.come_back()
+
+        notification = self.send_notification.call_args[0][1]
+        self.assertEqual(notification.source, '#weechat (3 since 14:02)')
+        self.assertEqual(notification.message, 'john: two\njohn: three')
+
+    def test_long_messages_are_shortened(self):
+        set_config_option('away_digest', 'buffer')
+        set_config_option('ellipsis', '..')
+        self.collect('buffer1', 'john', 'x' * 1000)
+
+        self.come_back()
+
+        notification = self.send_notification.call_args[0][1]
+        self.assertEqual(notification.message,
+                         'john: ' + 'x' * notify_send.MAX_AWAY_DIGEST_LINE_LENGTH + '..')
+
+    def test_sends_digest_only_for_buffers_of_server(self):
+        set_buffer_string('buffer2', 'localvar_server', 'oftc')
+        self.collect('buffer1', 'john', 'one')
+        self.collect('buffer2', 'jane', 'two')
+
+        self.come_back('oftc')
+
+        notification = self.send_notification.call_args[0][1]
+        self.assertEqual(notification.message, '#python (1 since 14:02)\njane: two')
+        self.assertIn('buffer1', notify_send.AWAY_DIGEST.buffers)
+
+    def test_does_not_send_digest_when_nothing_was_collected(self):
+        self.come_back()
+
+        self.send_notification.assert_not_called()
+
+    def test_closed_buffer_is_removed_from_digest(self):
+        self.collect('buffer1', 'john', 'one')
+
+        buffer_changed_callback('', 'buffer_closed', 'buffer1')
+
+        self.assertEqual(notify_send.AWAY_DIGEST.buffers, {})
+
+
+class ShadowTests(TestsBase):
+    """Tests for the shadow profile."""
+
+    def setUp(self):
+        super().setUp()
+        set_buffer_string('buffer', 'full_name', 'irc.libera.#chan')
+
+    def set_profile(self, name, options):
+        """Makes the option infolist return the given (option, value) pairs of
+        the given profile and applies them.
+        """
+        set_config_option('shadow_profile', name)
+        weechat.infolist_get.return_value = 'infolist'
+        options = [
+            {'full_name': 'plugins.var.python.notify_send.shadow.{}.{}'.format(name, option),
+             'value': value}
+            for option, value in options
+        ]
+        position = []
+
+        def infolist_next(infolist):
+            position.append(None)
+            return 1 if len(position) <= len(options) else 0
+
+        weechat.infolist_next.side_effect = infolist_next
+        weechat.infolist_string.side_effect = \
+            lambda infolist, name: options[len(position) - 1][name]
+        apply_shadow_config()
+
+    def decision(self, nick='john', is_highlight=True, message='message'):
+        return notification_decision('buffer', [], nick, True, is_highlight, message)
+
+    def test_there_is_no_profile_when_option_is_empty(self):
+        apply_shadow_config()
+
+        self.assertIsNone(notify_send.SHADOW_PROFILE)
+
+    def test_profile_overrides_only_its_options(self):
+        set_config_option('ignore_buffers', '#spam')
+        self.set_profile('strict', [('ignore_nicks', 'john')])
+
+        config = notify_send.SHADOW_PROFILE.config
+        self.assertEqual(config.config_get_plugin('ignore_nicks'), 'john')
+        self.assertEqual(config.config_get_plugin('ignore_buffers'), '#spam')
+        self.assertIsNone(config.rules)
+
+    def test_reports_unknown_options_and_invalid_rules(self):
+        self.set_profile('strict', [('unknown', 'on'), ('rule.1', 'nick=john')])
+
+        self.assertEqual(weechat.prnt.call_count, 2)
+
+    def test_rejects_options_that_do_not_change_decisions(self):
+        self.set_profile('strict', [('regex_time_budget', '10'), ('urgency', 'low')])
+
+        self.assertEqual(weechat.prnt.call_count, 2)
+        self.assertEqual(notify_send.SHADOW_PROFILE.config.config_get_plugin('urgency'), '')
+
+    def test_rejects_unfocused_terminal_when_focus_is_not_reported(self):
+        set_config_option('notify_only_when_terminal_unfocused', 'off')
+        self.set_profile('strict', [('notify_only_when_terminal_unfocused', 'on')])
+
+        self.assertTrue(weechat.prnt.called)
+        self.assertEqual(
+            notify_send.SHADOW_PROFILE.config.config_get_plugin(
+                'notify_only_when_terminal_unfocused'),
+            'off'
+        )
+
+    def test_profile_suppresses_notifications_while_typing(self):
+        weechat.hook_signal.return_value = 'input_hook'
+        self.set_profile('strict', [('suppress_while_typing', '60')])
+        apply_input_activity_config()
+        self.time.return_value = 100.0
+        input_activity_callback('', 'input_text_changed', 'buffer')
+        self.time.return_value = 101.0
+
+        self.assertEqual(self.decision(), (True, 'notify_on_highlights'))
+
+        weechat.hook_signal.assert_called_once_with(
+            'input_text_changed', 'input_activity_callback', ''
+        )
+        self.assertEqual(list(notify_send.SHADOW_PROFILE.differences),
+                         [(False, 'suppress_while_typing', 'notify_on_highlights')])
+
+    def test_profile_honors_away_digest(self):
+        set_config_option('notify_when_away', 'off')
+        set_buffer_string('buffer', 'localvar_away', 'gone')
+        self.set_profile('strict', [('away_digest', 'on')])
+
+        self.assertEqual(self.decision(), (False, 'notify_when_away'))
+
+        self.assertEqual(list(notify_send.SHADOW_PROFILE.differences),
+                         [(True, 'notify_on_highlights', 'notify_when_away')])
+
+    def test_records_message_for_which_profile_decides_differently(self):
+        self.set_profile('strict', [('ignore_nicks', 'john')])
+
+        decision = self.decision()
+
+        self.assertEqual(decision, (True, 'notify_on_highlights'))
+        self.assertIs(notify_send.weechat, weechat)
+        self.assertEqual(notify_send.SHADOW_PROFILE.evaluated, 1)
+        self.assertEqual(notify_send.SHADOW_PROFILE.differences, {
+            (False, 'ignore_nicks', 'notify_on_highlights'):
+                [1, collections.deque([('irc.libera.#chan', 'john', 'message')])],
+        })
+
+    def test_does_not_record_message_for_which_profile_decides_the_same(self):
+        self.set_profile('strict', [('ignore_nicks', 'john')])
+
+        self.decision(nick='mary')
+
+        self.assertEqual(notify_send.SHADOW_PROFILE.evaluated, 1)
+        self.assertEqual(notify_send.SHADOW_PROFILE.differences, {})
+
+    def test_rules_of_profile_replace_rules_of_options(self):
+        self.set_profile('strict', [('rule.1', 'message=deploy -> notify:critical')])
+
+        self.assertEqual(self.decision(is_highlight=False, message='deploy'),
+                         (False, 'no matching option'))
+
+        self.assertEqual(notify_send.RULE_URGENCY, '')
+        self.assertIsNone(notify_send.NOTIFICATION_RULES)
+        self.assertEqual(list(notify_send.SHADOW_PROFILE.differences),
+                         [(True, 'rule.1', 'no matching option')])
+
+    def test_keeps_only_most_recent_examples(self):
+        self.set_profile('strict', [('ignore_nicks', 'john')])
+
+        for i in range(5):
+            self.decision(message='message {}'.format(i))
+
+        count, examples = notify_send.SHADOW_PROFILE.differences[
+            (False, 'ignore_nicks', 'notify_on_highlights')
+        ]
+        self.assertEqual(count, 5)
+        self.assertEqual([message for _, _, message in examples],
+                         ['message 2', 'message 3', 'message 4'])
+
+    def test_samples_messages_when_there_are_more_than_max_rate(self):
+        profile = ShadowProfile('strict', None, 2)
+
+        first_second = [profile.should_evaluate(10.5) for _ in range(5)]
+        next_second = [profile.should_evaluate(11.5) for _ in range(6)]
+
+        self.assertEqual(first_second, [True, True, False, False, False])
+        self.assertEqual(next_second, [False, False, True, False, False, True])
+        self.assertEqual((profile.evaluated, profile.skipped), (4, 7))
+        self.assertIn('4 messages evaluated (7 skipped by sampling)', shadow_report(profile)[0])
+
+    def test_command_prints_differences_with_examples(self):
+        self.set_profile('strict', [('ignore_nicks', 'john')])
+        self.decision()
+        self.decision(nick='mary')
+        weechat.prnt.reset_mock()
+
+        rc = command_callback('', 'buffer', 'shadow')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(weechat.prnt.call_args_list, [
+            mock.call('', 'notify_send: shadow profile strict: 2 messages evaluated '
+                          '(0 skipped by sampling), 1 decided differently'),
+            mock.call('', '  1x would not notify (ignore_nicks instead of '
+                          'notify_on_highlights)'),
+            mock.call('', '    irc.libera.#chan <john> message'),
+        ])
+
+    def test_command_resets_counters(self):
+        self.set_profile('strict', [('ignore_nicks', 'john')])
+        self.decision()
+
+        command_callback('', 'buffer', 'shadow reset')
+
+        self.assertEqual(notify_send.SHADOW_PROFILE.evaluated, 0)
+        self.assertEqual(notify_send.SHADOW_PROFILE.differences, {})
+
+    def test_command_prints_error_when_there_is_no_profile(self):
+        rc = command_callback('', 'buffer', 'shadow')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_ERROR)
+
+
+class ProfileTests(TestsBase):
+    """Tests for /notify_send profile."""
+
+    def setUp(self):
+        super().setUp()
+        weechat.hook_print.return_value = 'print_hook'
+        weechat.hook_timer.return_value = 'timer_hook'
+        weechat.info_get.return_value = self.create_temp_dir()
+        hook_notifications()
+
+        patcher = mock.patch('notify_send.message_printed_callback')
+        self.message_printed_callback = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.message_printed_callback.return_value = weechat.WEECHAT_RC_OK
+
+    def profile(self, args):
+        return command_callback('', '', 'profile ' + args)
+
+    def dumps(self):
+        return [name for name in os.listdir(weechat.info_get.return_value)
+                if name.endswith('.pstats')]
+
+    def test_start_hooks_profiled_callback(self):
+        rc = self.profile('start')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        weechat.unhook.assert_called_once_with('print_hook')
+        weechat.hook_print.assert_called_with(
+            '', '', '', 1, 'profiled_message_printed_callback', ''
+        )
+
+    def test_start_does_not_hook_callbacks_during_dnd(self):
+        dnd_start()
+        weechat.hook_print.reset_mock()
+
+        self.profile('start')
+
+        weechat.hook_print.assert_not_called()
+
+    def test_profiles_every_nth_call(self):
+        self.profile('start every 3')
+
+        with mock.patch.object(notify_send.PROFILER, 'runcall') as runcall:
+            for _ in range(6):
+                profiled_message_printed_callback('', 'buffer', '0', '', '1', '0', 'p', 'm')
+
+        self.assertEqual(runcall.call_count, 2)
+        self.assertEqual(self.message_printed_callback.call_count, 4)
+
+    def test_stop_writes_profile_and_hooks_callback_back(self):
+        self.profile('start')
+        profiled_message_printed_callback('', 'buffer', '0', '', '1', '0', 'p', 'm')
+        weechat.hook_print.reset_mock()
+
+        rc = self.profile('stop')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(len(self.dumps()), 1)
+        self.assertIsNone(notify_send.PROFILER)
+        weechat.hook_print.assert_called_once_with(
+            '', '', '', 1, 'message_printed_callback', ''
+        )
+
+    def test_dump_writes_profile_and_keeps_profiling(self):
+        self.profile('start')
+        profiled_message_printed_callback('', 'buffer', '0', '', '1', '0', 'p', 'm')
+
+        rc = self.profile('dump')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(len(self.dumps()), 1)
+        self.assertIsNotNone(notify_send.PROFILER)
+
+    def test_dump_fails_when_not_profiling(self):
+        rc = self.profile('dump')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_ERROR)
+
+    def test_start_for_duration_stops_profiling_when_timer_fires(self):
+        self.profile('start for 5m')
+
+        weechat.hook_timer.assert_called_once_with(
+            300000, 0, 1, 'profile_timer_callback', ''
+        )
+        profiled_message_printed_callback('', 'buffer', '0', '', '1', '0', 'p', 'm')
+        notify_send.profile_timer_callback('', '0')
+
+        self.assertIsNone(notify_send.PROFILER)
+        self.assertEqual(len(self.dumps()), 1)
+
+    def test_start_rejects_invalid_arguments(self):
+        for args in ['start every', 'start every 0', 'start for xyz', 'start at 5',
+                     'restart']:
+            self.assertEqual(self.profile(args), weechat.WEECHAT_RC_ERROR, args)
+        self.assertIsNone(notify_send.PROFILER)
+
+    @unittest.skipIf(sys.implementation.name != 'cpython', 'requires tracemalloc')
+    def test_memory_prints_differences_between_snapshots(self):
+        import tracemalloc
+        self.addCleanup(tracemalloc.stop)
+
+        self.profile('memory')
+        self.assertTrue(tracemalloc.is_tracing())
+        self.profile('memory')
+        self.profile('stop')
+
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreater(weechat.prnt.call_count, 1)
+
+
+class HotlistEngineTests(TestsBase):
+    """Tests for the hotlist engine."""
+
+    def setUp(self):
+        super().setUp()
+        set_config_option('engine', 'hotlist')
+        set_config_option('hotlist_poll_interval', '10')
+        weechat.hook_timer.return_value = 'timer_hook'
+        self.hotlist = []
+        self.mock_hotlist(self.hotlist)
+
+        # Mock send_notification().
+        patcher = mock.patch('notify_send.send_notification')
+        self.send_notification = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Mock last_message_in_buffer().
+        patcher = mock.patch('notify_send.last_message_in_buffer')
+        self.last_message_in_buffer = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.last_message_in_buffer.return_value = ('john', 'hello', 0)
+
+    def set_hotlist(self, buffer, messages=0, privates=0, highlights=0):
+        self.hotlist[:] = [{
+            'buffer_pointer': buffer,
+            'count_01': messages,
+            'count_02': privates,
+            'count_03': highlights,
+        }]
+
+    def test_hook_notifications_hooks_timer_instead_of_print(self):
+        hook_notifications()
+
+        weechat.hook_timer.assert_called_once_with(
+            10000, 0, 0, 'hotlist_timer_callback', ''
+        )
+        weechat.hook_print.assert_not_called()
+
+    def test_sends_notification_when_highlight_count_goes_up(self):
+        self.set_hotlist('buffer', highlights=1)
+        hook_notifications()
+        self.set_hotlist('buffer', highlights=2)
+
+        hotlist_timer_callback('', 0)
+
+        self.last_message_in_buffer.assert_called_once_with('buffer')
+        notification = self.send_notification.call_args[0][1]
+        self.assertEqual(notification.message, 'john: hello')
+
+    def test_sends_notification_when_private_message_count_goes_up(self):
+        hook_notifications()
+        self.set_hotlist('buffer', privates=1)
+
+        hotlist_timer_callback('', 0)
+
+        self.assertTrue(self.send_notification.called)
+
+    def test_appends_sent_notification_to_history_when_it_is_enabled(self):
+        self.send_notification.return_value = '42'
+        set_buffer_string('buffer', 'name', 'irc.libera.#weechat')
+        self.time.return_value = 10.0
+        history = self.open_history(10)
+        hook_notifications()
+        self.set_hotlist('buffer', highlights=1)
+
+        with mock.patch('notify_send.NOTIFICATION_HISTORY', history):
+            hotlist_timer_callback('', 0)
+
+        self.assertEqual(history.entries(),
+                         [(10.0, 42, 'irc.libera.#weechat', 'john', 'hello')])
+
+    def test_does_not_send_notification_when_counts_do_not_go_up(self):
+        self.set_hotlist('buffer', highlights=1)
+        hook_notifications()
+
+        hotlist_timer_callback('', 0)
+
+        self.assertFalse(self.send_notification.called)
+
+    def test_does_not_send_notification_for_ordinary_message_by_default(self):
+        hook_notifications()
+        self.set_hotlist('buffer', messages=1)
+
+        hotlist_timer_callback('', 0)
+
+        self.assertFalse(self.send_notification.called)
+
+    def test_sends_notification_for_ordinary_message_in_buffer_from_option(self):
+        set_buffer_string('buffer', 'short_name', '#buffer')
+        set_config_option('notify_on_all_messages_in_buffers', '#buffer')
+        hook_notifications()
+        self.set_hotlist('buffer', messages=1)
+
+        hotlist_timer_callback('', 0)
+
+        self.assertTrue(self.send_notification.called)
+
+    def test_does_not_send_notification_for_ignored_buffer(self):
+        set_buffer_string('buffer', 'short_name', '#buffer')
+        set_config_option('ignore_buffers', '#buffer')
+        hook_notifications()
+        self.set_hotlist('buffer', highlights=1)
+
+        hotlist_timer_callback('', 0)
+
+        self.assertFalse(self.send_notification.called)
+
+    def test_apply_config_switches_engine(self):
+        hook_notifications()
+        set_config_option('engine', 'print')
+
+        apply_config()
+
+        weechat.unhook.assert_called_once_with('timer_hook')
+        self.assertTrue(weechat.hook_print.called)
+
+
+class SignalsEngineTests(TestsBase):
+    """Tests for the signals engine."""
+
+    def test_hook_notifications_hooks_signals_instead_of_print(self):
+        set_config_option('engine', 'signals')
+
+        hook_notifications()
+
+        weechat.hook_signal.assert_has_calls([
+            mock.call('weechat_highlight', 'highlight_or_private_signal_callback', ''),
+            mock.call('weechat_pv', 'highlight_or_private_signal_callback', ''),
+        ])
+        weechat.hook_print.assert_not_called()
+
+    def test_auto_engine_uses_signals_when_only_highlights_and_privmsgs_are_needed(self):
+        set_config_option('engine', 'auto')
+        set_config_option('notify_on_all_messages_in_current_buffer', 'off')
+
+        self.assertEqual(notification_engine_config(), ('signals', 0))
+
+    def test_auto_engine_uses_print_when_other_messages_are_needed(self):
+        set_config_option('engine', 'auto')
+        set_config_option('notify_on_all_messages_in_current_buffer', 'off')
+        set_config_option('notify_on_messages_that_match', 'foo')
+
+        self.assertEqual(notification_engine_config(), ('print', 0))
+
+    def test_unknown_engine_is_print(self):
+        set_config_option('engine', 'xxx')
+
+        self.assertEqual(notification_engine_config(), ('print', 0))
+
+    def test_signal_callback_handles_last_line_of_buffer_with_line_from_signal(self):
+        lines = {
+            'buffer1': 'data1',
+            'buffer2': 'data2',
+        }
+        line_data = {
+            ('data1', 'prefix'): 'jane',
+            ('data1', 'message'): 'hi',
+            ('data2', 'prefix'): '@john',
+            ('data2', 'message'): 'hello me',
+            ('data2', '0|tags_array'): 'irc_privmsg',
+            ('data2', '1|tags_array'): 'nick_john',
+        }
+        weechat.hdata_get_list.return_value = 'buffer1'
+        weechat.hdata_move.side_effect = \
+            lambda hdata, buffer, count: {'buffer1': 'buffer2'}.get(buffer, '')
+        weechat.hdata_string.side_effect = lambda hdata, data, name: line_data[(data, name)]
+        weechat.hdata_integer.return_value = 2
+        weechat.hdata_time.return_value = 1234
+        self.time.return_value = 1234.5
+        weechat.hdata_char.return_value = 1
+        weechat.string_remove_color.side_effect = lambda string, replacement: string
+
+        with mock.patch('notify_send.last_line_data', side_effect=lines.get), \
+                mock.patch('notify_send.message_printed_callback') as callback:
+            highlight_or_private_signal_callback('', 'weechat_highlight', '@john\thello me')
+
+        callback.assert_called_once_with(
+            '', 'buffer2', '1234', 'irc_privmsg,nick_john', '1', '1', '@john', 'hello me'
+        )
+
+    def test_signal_callback_finds_line_with_colored_prefix(self):
+        line_data = {
+            ('data', 'prefix'): '\x1901@\x1902john',
+            ('data', 'message'): 'hello me',
+            ('data', '0|tags_array'): 'nick_john',
+        }
+        weechat.hdata_get_list.return_value = 'buffer'
+        weechat.hdata_move.return_value = ''
+        weechat.hdata_string.side_effect = lambda hdata, data, name: line_data[(data, name)]
+        weechat.hdata_integer.return_value = 1
+        weechat.hdata_time.return_value = 1234
+        self.time.return_value = 1234.5
+        weechat.hdata_char.return_value = 1
+        weechat.string_remove_color.side_effect = \
+            lambda string, replacement: re.sub(r'\x19\d\d', replacement, string)
+
+        with mock.patch('notify_send.last_line_data', return_value='data'), \
+                mock.patch('notify_send.message_printed_callback') as callback:
+            highlight_or_private_signal_callback('', 'weechat_highlight', '@john\thello me')
+
+        callback.assert_called_once_with(
+            '', 'buffer', '1234', 'nick_john', '1', '1', '@john', 'hello me'
+        )
+
+    def test_signal_callback_skips_buffer_whose_last_line_was_printed_earlier(self):
+        line_data = {
+            ('data1', 'prefix'): 'john',
+            ('data1', 'message'): 'hi',
+            ('data2', 'prefix'): 'john',
+            ('data2', 'message'): 'hi',
+        }
+        dates_printed = {'data1': 1000, 'data2': 1234}
+        weechat.hdata_get_list.return_value = 'buffer1'
+        weechat.hdata_move.side_effect = \
+            lambda hdata, buffer, count: {'buffer1': 'buffer2'}.get(buffer, '')
+        weechat.hdata_string.side_effect = lambda hdata, data, name: line_data[(data, name)]
+        weechat.hdata_integer.return_value = 0
+        weechat.hdata_time.side_effect = lambda hdata, data, name: dates_printed[data]
+        weechat.hdata_char.return_value = 1
+        weechat.string_remove_color.side_effect = lambda string, replacement: string
+        self.time.return_value = 1234.5
+
+        with mock.patch('notify_send.last_line_data', side_effect=lambda b: 'data' + b[-1]), \
+                mock.patch('notify_send.message_printed_callback') as callback:
+            highlight_or_private_signal_callback('', 'weechat_pv', 'john\thi')
+
+        self.assertEqual(callback.call_args[0][1], 'buffer2')
+        self.assertNotIn(mock.call(mock.ANY, 'data1', 'prefix'),
+                         weechat.hdata_string.call_args_list)
+
+    def test_signal_callback_ignores_line_that_is_not_found(self):
+        weechat.hdata_get_list.return_value = ''
+
+        with mock.patch('notify_send.message_printed_callback') as callback:
+            rc = highlight_or_private_signal_callback('', 'weechat_pv', 'john\thi')
+
+        callback.assert_not_called()
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+
+
+class QuietHoursTests(TestsBase):
+    """Tests for quiet hours."""
+
+    def test_parse_quiet_hours_returns_periods_in_minutes(self):
+        self.assertEqual(parse_quiet_hours('23:00-07:30, 12:00 - 12:05'),
+                         [(23 * 60, 7 * 60 + 30), (12 * 60, 12 * 60 + 5)])
+
+    def test_parse_quiet_hours_skips_invalid_periods(self):
+        self.assertEqual(parse_quiet_hours('xxx,25:00-01:00,10:00-11:00,'),
+                         [(10 * 60, 11 * 60)])
+
+    def test_quiet_period_end_returns_none_when_not_within_quiet_hours(self):
+        set_config_option('quiet_hours', '12:00-13:00')
+
+        self.assertIsNone(quiet_period_end(local_time(13, 0)))
+
+    def test_quiet_period_end_returns_end_of_period(self):
+        set_config_option('quiet_hours', '12:00-13:00')
+
+        self.assertEqual(quiet_period_end(local_time(12, 0)), local_time(13, 0))
+
+    def test_quiet_period_end_handles_periods_over_midnight(self):
+        set_config_option('quiet_hours', '23:00-07:00')
+
+        self.assertEqual(quiet_period_end(local_time(23, 30)), local_time(7, 0, day=2))
+        self.assertEqual(quiet_period_end(local_time(6, 0)), local_time(7, 0))
+        self.assertIsNone(quiet_period_end(local_time(7, 0)))
+
+    def test_next_quiet_period_start_returns_next_start(self):
+        set_config_option('quiet_hours', '23:00-07:00,12:00-13:00')
+
+        self.assertEqual(next_quiet_period_start(local_time(12, 30)), local_time(23, 0))
+        self.assertEqual(next_quiet_period_start(local_time(23, 30)),
+                         local_time(12, 0, day=2))
+
+    def test_next_quiet_period_start_returns_none_when_there_are_no_quiet_hours(self):
+        self.assertIsNone(next_quiet_period_start(local_time(12, 0)))
+
+    def test_changing_quiet_hours_starts_dnd_within_quiet_hours(self):
+        set_config_option('quiet_hours', '12:00-13:00')
+        self.time.return_value = local_time(12, 30)
+
+        config_changed_callback('', 'plugins.var.python.notify_send.quiet_hours',
+                                '12:00-13:00')
+
+        self.assertEqual(notify_send.DND_UNTIL, local_time(13, 0))
+
+    def test_changing_other_option_does_not_start_dnd_within_quiet_hours(self):
+        set_config_option('quiet_hours', '12:00-13:00')
+        self.time.return_value = local_time(12, 30)
+
+        config_changed_callback('', 'plugins.var.python.notify_send.nick_separator', ': ')
+
+        self.assertIsNone(notify_send.DND_UNTIL)
+
+    def test_apply_quiet_hours_config_schedules_start_of_next_quiet_period(self):
+        set_config_option('quiet_hours', '12:00-13:00')
+        self.time.return_value = local_time(11, 0)
+
+        apply_quiet_hours_config()
+
+        self.assertIsNone(notify_send.DND_UNTIL)
+        weechat.hook_timer.assert_called_once_with(
+            3600 * 1000, 0, 1, 'quiet_hours_timer_callback', ''
+        )
+
+
+class ParseDurationTests(TestsBase):
+    """Tests for parse_duration()."""
+
+    def test_number_means_minutes(self):
+        self.assertEqual(parse_duration('15'), 15 * 60)
+
+    def test_parses_hours_minutes_and_seconds(self):
+        self.assertEqual(parse_duration('1h30m'), 5400)
+        self.assertEqual(parse_duration('2h'), 7200)
+        self.assertEqual(parse_duration('90s'), 90)
+
+    def test_returns_none_when_duration_is_invalid(self):
+        self.assertIsNone(parse_duration(''))
+        self.assertIsNone(parse_duration('xxx'))
+        self.assertIsNone(parse_duration('1m1h'))
+
+
+class CommandCallbackTests(TestsBase):
+    """Tests for command_callback()."""
+
+    def test_prints_error_when_subcommand_is_unknown(self):
+        rc = command_callback('', 'buffer', 'xxx')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_ERROR)
+        self.assertIn('unknown subcommand: xxx', weechat.prnt.call_args[0][1])
+
+    def test_why_prints_error_when_tracing_is_disabled(self):
+        rc = command_callback('', 'buffer', 'why')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_ERROR)
+        self.assertIn('tracing is disabled', weechat.prnt.call_args[0][1])
+
+    def test_why_prints_recorded_decisions(self):
+        trace = DecisionTrace(5)
+        trace.record(0.0, 0.001, 'buffer', 'john', False, 'ignore_nicks')
+        set_buffer_string('buffer', 'name', 'irc.libera.#weechat')
+
+        with mock.patch('notify_send.DECISION_TRACE', trace):
+            rc = command_callback('', 'buffer', 'why')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        printed = weechat.prnt.call_args[0][1]
+        self.assertIn('irc.libera.#weechat  john  not sent  (ignore_nicks', printed)
+
+    def test_snooze_starts_dnd_for_given_duration(self):
+        self.time.return_value = 1000.0
+
+        rc = command_callback('', 'buffer', 'snooze 30m')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(notify_send.DND_UNTIL, 1000.0 + 30 * 60)
+
+    def test_snooze_prints_error_when_duration_is_invalid(self):
+        rc = command_callback('', 'buffer', 'snooze xxx')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_ERROR)
+        self.assertIsNone(notify_send.DND_UNTIL)
+
+    def test_dnd_on_and_off_start_and_stop_dnd(self):
+        command_callback('', 'buffer', 'dnd on')
+        self.assertEqual(notify_send.DND_UNTIL, 0)
+
+        command_callback('', 'buffer', 'dnd off')
+        self.assertIsNone(notify_send.DND_UNTIL)
+
+    def test_dnd_prints_status(self):
+        rc = command_callback('', 'buffer', 'dnd')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertIn('do-not-disturb is off', weechat.prnt.call_args[0][1])
+
+    def test_history_prints_error_when_history_is_disabled(self):
+        rc = command_callback('', 'buffer', 'history')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_ERROR)
+        self.assertIn('history is disabled', weechat.prnt.call_args[0][1])
+
+    def test_history_prints_notifications_that_contain_given_text(self):
+        history = self.open_history(5)
+        history.append(0.0, 1, 'irc.libera.#weechat', 'john', 'hello')
+        history.append(0.0, 2, 'irc.libera.#python', 'jane', 'HI there')
+        history.append(0.0, 3, 'irc.libera.#weechat', 'jane', 'bye')
+
+        with mock.patch('notify_send.NOTIFICATION_HISTORY', history):
+            rc = command_callback('', 'buffer', 'history hi')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(weechat.prnt.call_count, 1)
+        self.assertIn('irc.libera.#python  jane: HI there', weechat.prnt.call_args[0][1])
+
+    def test_why_prints_error_when_count_is_invalid(self):
+        with mock.patch('notify_send.DECISION_TRACE', DecisionTrace(5)):
+            rc = command_callback('', 'buffer', 'why xxx')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_ERROR)
+
+    def test_stats_prints_notification_delays_of_buffers(self):
+        weechat.hdata_get_list.return_value = 'buffer1'
+        next_buffers = {'buffer1': 'buffer2', 'buffer2': 'buffer3'}
+        weechat.hdata_move.side_effect = \
+            lambda hdata, buffer, count: next_buffers.get(buffer, '')
+        set_buffer_string('buffer1', 'full_name', 'irc.libera.#busy')
+        set_buffer_string('buffer1', 'localvar_notify_send_last_notification_time', '90.0')
+        set_buffer_string('buffer1', 'localvar_notify_send_notification_delay', '8.0')
+        set_buffer_string('buffer3', 'full_name', 'irc.libera.#quiet')
+        set_buffer_string('buffer3', 'localvar_notify_send_last_notification_time', '40.0')
+        set_config_option('min_notification_delay', '500')
+        set_config_option('max_notification_delay', '60000')
+        self.time.return_value = 100.0
+
+        rc = command_callback('', 'buffer', 'stats')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(weechat.prnt.call_args_list, [
+            mock.call('', 'irc.libera.#busy: delay 8s (adaptive, 0.5s to 60s), '
+                          'last notification 10s ago'),
+            mock.call('', 'irc.libera.#quiet: delay 0.5s (adaptive, 0.5s to 60s), '
+                          'last notification 60s ago'),
+        ])
+
+    def test_stats_prints_fixed_delay_when_adaptive_delay_is_disabled(self):
+        weechat.hdata_get_list.return_value = 'buffer1'
+        weechat.hdata_move.return_value = ''
+        set_buffer_string('buffer1', 'full_name', 'irc.libera.#chan')
+        set_buffer_string('buffer1', 'localvar_notify_send_last_notification_time', '99.0')
+        set_config_option('min_notification_delay', '500')
+        self.time.return_value = 100.0
+
+        command_callback('', 'buffer', 'stats')
+
+        weechat.prnt.assert_called_once_with(
+            '', 'irc.libera.#chan: delay 0.5s (fixed), last notification 1s ago'
+        )
+
+    def test_stats_prints_message_when_no_notification_was_sent(self):
+        weechat.hdata_get_list.return_value = ''
+
+        command_callback('', 'buffer', 'stats')
+
+        weechat.prnt.assert_called_once_with('', 'notify_send: no notifications sent yet')
+
+
+class IsBelowMinNotificationDelayTests(TestsBase):
+    """Tests for is_below_min_notification_delay()."""
+
+    def test_returns_false_when_min_notification_delay_is_zero(self):
+        BUFFER = 'buffer'
+        set_buffer_string(
+            BUFFER,
+            'localvar_notify_send_last_notification_time',
+            '1.0'
+        )
+        self.time.return_value = 1.0
+        set_config_option('min_notification_delay', 0)
+
+        self.assertFalse(is_below_min_notification_delay(BUFFER))
+
+    def test_returns_false_when_last_time_is_not_below_min_notification_delay(self):
+        BUFFER = 'buffer'
+        set_buffer_string(
+            BUFFER,
+            'localvar_notify_send_last_notification_time',
+            '0.4'
+        )
+        self.time.return_value = 1.0
+        set_config_option('min_notification_delay', 500)
+
+        self.assertFalse(is_below_min_notification_delay(BUFFER))
+
+    def test_returns_true_when_last_time_is_below_min_notification_delay(self):
+        BUFFER = 'buffer'
+        set_buffer_string(
+            BUFFER,
+            'localvar_notify_send_last_notification_time',
+            '1.4'
+        )
+        self.time.return_value = 1.0
+        set_config_option('min_notification_delay', 500)
+
+        self.assertTrue(is_below_min_notification_delay(BUFFER))
+
+    def test_updates_last_notification_time(self):
+        CURRENT_TIME = 1.0
+        self.time.return_value = CURRENT_TIME
+        BUFFER = 'buffer'
+
+        is_below_min_notification_delay(BUFFER)
+
+        weechat.buffer_set.assert_called_once_with(
+            BUFFER,
+            'localvar_set_notify_send_last_notification_time',
+            str(CURRENT_TIME)
+        )
+
+    def test_adaptive_delay_grows_while_notifications_keep_coming(self):
+        BUFFER = 'buffer'
+        set_config_option('min_notification_delay', '500')
+        set_config_option('max_notification_delay', '4000')
+        set_buffer_string(BUFFER, 'localvar_notify_send_last_notification_time', '10.0')
+        set_buffer_string(BUFFER, 'localvar_notify_send_notification_delay', '0.5')
+        self.time.return_value = 10.6
+
+        self.assertFalse(is_below_min_notification_delay(BUFFER))
+
+        weechat.buffer_set.assert_has_calls([
+            mock.call(BUFFER, 'localvar_set_notify_send_notification_delay', '1.0'),
+            mock.call(BUFFER, 'localvar_set_notify_send_last_notification_time', '10.6'),
+        ])
+
+    def test_adaptive_delay_does_not_update_buffer_when_below_delay(self):
+        BUFFER = 'buffer'
+        set_config_option('min_notification_delay', '500')
+        set_config_option('max_notification_delay', '4000')
+        set_buffer_string(BUFFER, 'localvar_notify_send_last_notification_time', '10.0')
+        set_buffer_string(BUFFER, 'localvar_notify_send_notification_delay', '2.0')
+        self.time.return_value = 11.5
+
+        self.assertTrue(is_below_min_notification_delay(BUFFER))
+
+        self.assertFalse(weechat.buffer_set.called)
+
+    def test_adaptive_delay_is_limited_by_current_options(self):
+        BUFFER = 'buffer'
+        set_config_option('min_notification_delay', '500')
+        set_config_option('max_notification_delay', '1000')
+        set_buffer_string(BUFFER, 'localvar_notify_send_last_notification_time', '10.0')
+        set_buffer_string(BUFFER, 'localvar_notify_send_notification_delay', '8.0')
+        self.time.return_value = 11.5
+
+        self.assertFalse(is_below_min_notification_delay(BUFFER))
+
+
+class NextNotificationDelayTests(unittest.TestCase):
+    """Tests for next_notification_delay()."""
+
+    def test_doubles_delay_when_notifications_keep_coming(self):
+        self.assertEqual(next_notification_delay(1.0, 1.5, 0.5, 60.0), 2.0)
+
+    def test_does_not_exceed_max_delay(self):
+        self.assertEqual(next_notification_delay(40.0, 50.0, 0.5, 60.0), 60.0)
+
+    def test_halves_delay_for_every_quiet_period(self):
+        self.assertEqual(next_notification_delay(8.0, 16.0, 0.5, 60.0), 4.0)
+        self.assertEqual(next_notification_delay(8.0, 33.0, 0.5, 60.0), 1.0)
+
+    def test_decays_back_to_min_delay_after_long_quiet_period(self):
+        self.assertEqual(next_notification_delay(8.0, 1e9, 0.5, 60.0), 0.5)
+
+
+class NamesForBufferTests(TestsBase):
+    """Tests for names_for_buffer()."""
+
+    def test_returns_correct_list_when_buffer_has_both_names(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+
+        self.assertEqual(
+            names_for_buffer(BUFFER),
+            ['network.#buffer', '#buffer']
+        )
+
+    def test_includes_short_name_with_hash_when_short_name_starts_with_gt(self):
+        # This may happen with the wee_slack script, see the comment in
+        # names_for_buffer().
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '>buffer')
+
+        self.assertEqual(
+            names_for_buffer(BUFFER),
+            ['network.#buffer', '>buffer', '#buffer']
+        )
+
+    def test_returns_empty_list_when_buffer_has_no_name(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', '')
+        set_buffer_string(BUFFER, 'short_name', '')
+
+        self.assertEqual(names_for_buffer(BUFFER), [])
+
+
+class IgnoreNotificationsFromMessagesTaggedWith(TestsBase):
+    """Tests for ignore_notifications_from_messages_tagged_with()."""
+
+    def test_returns_false_when_no_tags_are_ignored(self):
+        set_config_option('ignore_messages_tagged_with', '')
+
+        self.assertFalse(
+            ignore_notifications_from_messages_tagged_with(['tag1', 'tag2'])
+        )
+
+    def test_returns_false_when_no_tag_is_between_ignored(self):
+        set_config_option('ignore_messages_tagged_with', 'tagA,tagB')
+
+        self.assertFalse(
+            ignore_notifications_from_messages_tagged_with(['tag1', 'tag2'])
+        )
+
+    def test_returns_true_when_tag_is_between_ignored(self):
+        set_config_option('ignore_messages_tagged_with', 'tag3,tag4,tag5')
+
+        self.assertTrue(
+            ignore_notifications_from_messages_tagged_with(['tag0', 'tag2', 'tag3'])
+        )
+
+
+class IgnoreNotificationsFromBufferTests(TestsBase):
+    """Tests for ignore_notifications_from_buffer()."""
+
+    def test_returns_false_when_nothing_is_ignored(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers', '')
+        set_config_option('ignore_buffers_starting_with', '')
+
+        self.assertFalse(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_false_when_buffer_has_no_name(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', '')
+        set_buffer_string(BUFFER, 'short_name', '')
+        set_config_option('ignore_buffers', '')
+        set_config_option('ignore_buffers_starting_with', '')
+
+        self.assertFalse(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_false_when_buffer_is_not_between_ignored(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers', '#buffer1,#buffer2,#buffer3')
+
+        self.assertFalse(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_true_when_buffer_is_ignored_by_short_name(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers', '#buffer')
+
+        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_true_when_buffer_is_ignored_by_full_name(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers', 'network.#buffer')
+
+        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_true_when_buffer_is_between_ignored_by_short_name(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers', '#aaa,#buffer,#bbb')
+
+        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_true_when_buffer_is_between_ignored_by_full_name(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers', '#aaa,network.#buffer,#bbb')
+
+        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+
+    def test_strips_beginning_and_trailing_whitespace_from_ignored_buffers(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers', '  #buffer  ')
+
+        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_false_when_buffer_is_not_prefixed_with_ignored_prefix(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers_starting_with', 'some_prefix')
+
+        self.assertFalse(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_true_when_buffer_full_name_is_prefixed_with_ignored_prefix(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers_starting_with', '#aaa,network.,#bbb')
+
+        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+
+    def test_returns_true_when_buffer_short_name_is_prefixed_with_ignored_prefix(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers_starting_with', '#aaa,#buf,#bbb')
+
+        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+
+    def test_strips_beginning_and_trailing_whitespace_from_ignored_prefixes(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'name', 'network.#buffer')
+        set_buffer_string(BUFFER, 'short_name', '#buffer')
+        set_config_option('ignore_buffers_starting_with', '  network.  ')
+
+        self.assertTrue(ignore_notifications_from_buffer(BUFFER))
+
+
+class IgnoreNotificationsFromNickTests(TestsBase):
+    """Tests for ignore_notifications_from_nick()."""
+
+    def test_returns_false_when_nothing_is_ignored(self):
+        set_config_option('ignore_nicks', '')
+        set_config_option('ignore_nicks_starting_with', '')
+
+        self.assertFalse(ignore_notifications_from_nick('nick'))
+
+    def test_returns_false_when_nick_is_not_between_ignored(self):
+        set_config_option('ignore_nicks', 'nick1,nick2,nick3')
+
+        self.assertFalse(ignore_notifications_from_nick('wizard'))
+
+    def test_returns_true_when_nick_is_ignored(self):
         set_config_option('ignore_nicks', 'nick')
 
         self.assertTrue(ignore_notifications_from_nick('nick'))
@@ -757,25 +2800,140 @@ class IgnoreNotificationsFromNickTests(TestsBase):
 class NotifyOnMessagesThatMatchTests(TestsBase):
     """Tests for notify_on_messages_that_match()."""
 
-    def test_returns_false_when_list_has_no_patterns(self):
-        set_config_option('notify_on_messages_that_match', '')
+    def test_returns_false_when_list_has_no_patterns(self):
+        set_config_option('notify_on_messages_that_match', '')
+
+        self.assertFalse(notify_on_messages_that_match('foobar'))
+
+    def test_returns_false_when_no_pattern_matches(self):
+        set_config_option('notify_on_messages_that_match', 'xyz')
+
+        self.assertFalse(notify_on_messages_that_match('foobar'))
+
+    def test_returns_true_when_message_matches(self):
+        set_config_option('notify_on_messages_that_match', 'foo')
+
+        self.assertTrue(notify_on_messages_that_match('foobar'))
+
+    def test_re_search_is_used_for_matching(self):
+        set_config_option('notify_on_messages_that_match', 'bar')
+
+        self.assertTrue(notify_on_messages_that_match('foobar'))
+
+
+class PatternSearchTests(TestsBase):
+    """Tests for pattern_search() and regex_time_budget."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('notify_send.time.perf_counter')
+        self.perf_counter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_searches_without_timing_when_there_is_no_budget(self):
+        self.assertTrue(pattern_search('b+', 'abc'))
+        self.perf_counter.assert_not_called()
+
+    def test_disables_pattern_that_takes_longer_than_budget(self):
+        set_config_option('regex_time_budget', '10')
+        apply_regex_time_budget_config()
+        self.perf_counter.side_effect = [0.0, 0.02]
+
+        self.assertTrue(pattern_search('b+', 'abc'))
+
+        self.assertEqual(notify_send.SLOW_PATTERNS, {'b+'})
+        self.assertTrue(weechat.prnt.called)
+        self.assertIsNone(pattern_search('b+', 'abc'))
+
+    def test_keeps_pattern_that_is_within_budget(self):
+        set_config_option('regex_time_budget', '10')
+        apply_regex_time_budget_config()
+        self.perf_counter.side_effect = [0.0, 0.001, 0.0, 0.001]
+
+        pattern_search('b+', 'abc')
+
+        self.assertTrue(pattern_search('b+', 'abc'))
+        self.assertEqual(notify_send.SLOW_PATTERNS, set())
+
+    def test_turning_budget_off_enables_disabled_patterns(self):
+        notify_send.SLOW_PATTERNS.add('b+')
+
+        apply_regex_time_budget_config()
+
+        self.assertEqual(notify_send.SLOW_PATTERNS, set())
+
+    def test_disabled_pattern_does_not_notify(self):
+        set_config_option('notify_on_messages_that_match', 'b+')
+        notify_send.REGEX_TIME_BUDGET = 0.01
+        notify_send.SLOW_PATTERNS.add('b+')
+
+        self.assertFalse(notify_on_messages_that_match('abc'))
+
+
+class LintTests(TestsBase):
+    """Tests for /notify_send lint."""
+
+    def printed(self):
+        return '\n'.join(str(call[0][1]) for call in weechat.prnt.call_args_list)
+
+    def test_finds_nested_quantifiers(self):
+        self.assertEqual(pattern_risks(r'^(\s*,?)*$'),
+                         ['nested quantifiers (e.g. (a+)+)'])
+
+    def test_finds_quantified_alternatives_that_overlap(self):
+        self.assertEqual(
+            pattern_risks(r'(.|a)*b'),
+            ['quantified alternatives that can match the same text (e.g. (.|a)*)']
+        )
+
+    def test_accepts_safe_patterns(self):
+        for pattern in [r'\bdeploy\b', r'(foo|bar)+', r'^irc\.libera\.', r'(a{1,3}){1,3}',
+                        r'(?:ab|ac)*']:
+            self.assertEqual(pattern_risks(pattern), [], pattern)
+
+    def test_reports_cost_of_every_pattern(self):
+        set_config_option('notify_on_messages_that_match', 'deploy,build')
+        set_config_option('hide_messages_in_buffers_that_match', '^irc')
+
+        rc = command_callback('', '', 'lint')
+
+        self.assertEqual(rc, weechat.WEECHAT_RC_OK)
+        self.assertEqual(weechat.prnt.call_count, 3)
+        self.assertIn('hide_messages_in_buffers_that_match: ^irc: ', self.printed())
+        self.assertIn(' us per message', self.printed())
+
+    def test_reports_risks_and_slowness_on_crafted_texts(self):
+        set_config_option('notify_on_messages_that_match', '(a+)+$')
+
+        command_callback('', '', 'lint')
+
+        self.assertIn('nested quantifiers', self.printed())
+        self.assertIn('on a crafted text of', self.printed())
+
+    def test_does_not_hang_on_catastrophic_pattern_and_long_sample_text(self):
+        # The pattern backtracks catastrophically on the lorem ipsum sample.
+        set_config_option('notify_on_messages_that_match', r'(\w+\s?)+$')
+        thread = threading.Thread(target=command_callback, args=('', '', 'lint'))
+        thread.daemon = True
 
-        self.assertFalse(notify_on_messages_that_match('foobar'))
+        thread.start()
+        thread.join(5)
 
-    def test_returns_false_when_no_pattern_matches(self):
-        set_config_option('notify_on_messages_that_match', 'xyz')
+        self.assertFalse(thread.is_alive())
+        self.assertIn('nested quantifiers', self.printed())
+        self.assertIn('not measured on sample texts', self.printed())
 
-        self.assertFalse(notify_on_messages_that_match('foobar'))
+    def test_reports_invalid_patterns(self):
+        set_config_option('notify_on_messages_that_match', '(')
 
-    def test_returns_true_when_message_matches(self):
-        set_config_option('notify_on_messages_that_match', 'foo')
+        command_callback('', '', 'lint')
 
-        self.assertTrue(notify_on_messages_that_match('foobar'))
+        self.assertIn('invalid regular expression', self.printed())
 
-    def test_re_search_is_used_for_matching(self):
-        set_config_option('notify_on_messages_that_match', 'bar')
+    def test_reports_when_there_are_no_patterns(self):
+        command_callback('', '', 'lint')
 
-        self.assertTrue(notify_on_messages_that_match('foobar'))
+        self.assertIn('no regular expressions', self.printed())
 
 
 class NotifyOnAllMessagesInBufferTests(TestsBase):
@@ -874,6 +3032,64 @@ class EscapeHtmlTests(TestsBase):
         )
 
 
+class FormatMessageTests(TestsBase):
+    """Tests for format_message()."""
+
+    def test_escapes_slashes_and_html_characters(self):
+        self.assertEqual(
+            format_message(r'<a> & \n', 0, '', True),
+            r'&lt;a&gt; &amp; \\n'
+        )
+
+    def test_does_not_escape_html_characters_when_html_is_false(self):
+        self.assertEqual(format_message('<a> &', 0, '', False), '<a> &')
+
+    def test_removes_control_characters_except_for_tabs_and_newlines(self):
+        self.assertEqual(
+            format_message('a\x01b\x02c\x7fd\te\nf', 0, '', False),
+            'abcd\te\nf'
+        )
+
+    def test_does_not_shorten_message_whose_escaped_form_fits(self):
+        self.assertEqual(format_message('a&b', 7, '..', True), 'a&amp;b')
+
+    def test_shortens_message_based_on_escaped_length(self):
+        self.assertEqual(format_message('a&bcdef', 8, '..', True), 'a&amp;..')
+
+    def test_does_not_cut_html_escape_sequence(self):
+        self.assertEqual(format_message('ab&cdef', 6, '..', True), 'ab..')
+
+    def test_does_not_cut_escaped_backslash(self):
+        self.assertEqual(format_message('ab\\cdef', 4, '.', False), 'ab.')
+
+    def test_does_not_leave_lone_high_surrogate(self):
+        self.assertEqual(
+            format_message('a\ud83d\ude00bcd', 3, '.', False),
+            'a.'
+        )
+
+    def test_escapes_ellipsis(self):
+        self.assertEqual(format_message('abcdef', 5, '<', True), 'a&lt;')
+
+    def test_returns_part_of_ellipsis_when_max_length_is_too_short(self):
+        self.assertEqual(format_message('abcdef', 3, '[..]', False), '[..')
+
+    def test_looks_only_at_beginning_of_long_message(self):
+        message = mock.MagicMock()
+        message.__getitem__.return_value = 'abcdef'
+        message.__len__.return_value = 10 ** 9
+
+        self.assertEqual(format_message(message, 5, '..', False), 'abc..')
+        message.__getitem__.assert_called_once_with(
+            slice(None, notify_send.message_window(5))
+        )
+
+    def test_shortens_message_whose_end_is_outside_window(self):
+        message = 'a' + '\x01' * notify_send.message_window(5)
+
+        self.assertEqual(format_message(message, 5, '..', False), 'a..')
+
+
 class EscapeSlashesTests(TestsBase):
     """Tests for escape_slashes()."""
 
@@ -1005,6 +3221,27 @@ class PrepareNotificationTests(TestsBase):
 
         self.assertEqual(notification.message, '<>')
 
+    def test_shortens_message_to_max_length_after_escaping_html(self):
+        set_config_option('escape_html', 'on')
+        set_config_option('max_length', 10)
+        set_config_option('ellipsis', '[..]')
+
+        notification = self.prepare_notification(message='<<<<<<<<<<<<')
+
+        self.assertEqual(notification.message, '&lt;[..]')
+
+    def test_shortens_huge_message_in_ordinary_buffer(self):
+        set_config_option('max_length', 10)
+        set_config_option('ellipsis', '[..]')
+        set_config_option('nick_separator', ': ')
+
+        notification = self.prepare_notification(
+            message=10 ** 6 * 'a',
+            is_private_message=False
+        )
+
+        self.assertEqual(notification.message, 'nick: [..]')
+
     def test_hides_message_when_buffer_name_matches_regex_in_option(self):
         BUFFER = 'defghijk'
         set_buffer_string(BUFFER, 'short_name', '#' + BUFFER)
@@ -1059,6 +3296,211 @@ class PrepareNotificationTests(TestsBase):
         self.assertEqual(notification.replace_id, '0')
 
 
+class TemplateTests(TestsBase):
+    """Tests for templates of notifications."""
+
+    def setUp(self):
+        super().setUp()
+        set_buffer_string('buffer', 'name', 'libera.#chan')
+        set_buffer_string('buffer', 'short_name', '#chan')
+        set_buffer_string('buffer', 'localvar_server', 'libera')
+
+    def set_templates(self, summary='', body=''):
+        set_config_option('summary_template', summary)
+        set_config_option('body_template', body)
+        apply_templates_config()
+
+    def test_parses_template_into_literals_and_fields(self):
+        template = parse_template('$$ ${nick}$message! ${nick}')
+
+        self.assertEqual(len(template.pieces), 5)
+        self.assertEqual(template.pieces[0], '$ ')
+        self.assertEqual(template.pieces[3], '! ')
+        self.assertEqual(template.render('buffer', 'john', 'hi'), '$ johnhi! john')
+
+    def test_parse_template_raises_error_for_unknown_field(self):
+        with self.assertRaisesRegex(ValueError, 'unknown field: nic'):
+            parse_template('${nic}')
+
+    def test_parse_template_raises_error_for_invalid_placeholder(self):
+        with self.assertRaisesRegex(ValueError, 'invalid placeholder at position 3'):
+            parse_template('a: $')
+
+    def test_default_format_is_used_when_templates_are_empty(self):
+        self.set_templates()
+
+        self.assertIsNone(notify_send.SUMMARY_TEMPLATE)
+        self.assertIsNone(notify_send.BODY_TEMPLATE)
+
+    def test_invalid_template_is_reported_and_default_format_is_used(self):
+        self.set_templates(summary='${unknown}')
+
+        self.assertIsNone(notify_send.SUMMARY_TEMPLATE)
+        self.assertTrue(weechat.prnt.called)
+
+    def test_notification_uses_templates(self):
+        set_config_option('notify_on_messages_that_match', r'\bde\w+')
+        self.time.return_value = time.mktime((2024, 1, 2, 13, 45, 0, 0, 0, -1))
+        self.set_templates(summary='${server}/${buffer}',
+                           body='[${time}] <${nick}> ${message} (${matched_keyword})')
+
+        notification_decision('buffer', [], 'john', 1, 0, 'the deploy failed')
+        notification = prepare_notification('buffer', 'john', 'the deploy failed')
+
+        self.assertEqual(notification.source, 'libera/#chan')
+        self.assertEqual(notification.message,
+                         '[13:45] <john> the deploy failed (deploy)')
+
+    def test_matched_keyword_is_found_in_whole_message(self):
+        set_config_option('notify_on_messages_that_match', r'\bde\w+')
+        set_config_option('max_length', '10')
+        self.set_templates(summary='${matched_keyword}')
+        message = 'x' * 100 + ' deploy'
+
+        notification_decision('buffer', [], 'john', 1, 0, message)
+        notification = prepare_notification('buffer', 'john', message)
+
+        self.assertEqual(notification.source, 'deploy')
+
+    def test_matched_keyword_is_empty_when_pattern_did_not_decide_message(self):
+        set_config_option('notify_on_messages_that_match', r'\bde\w+')
+        self.set_templates(summary='${matched_keyword}')
+
+        notification_decision('buffer', [], 'john', 1, 1, 'the deploy failed')
+        notification = prepare_notification('buffer', 'john', 'the deploy failed')
+
+        self.assertEqual(notification.source, '')
+
+    def test_summary_is_shortened_to_max_length(self):
+        set_config_option('max_length', '10')
+        set_config_option('ellipsis', '..')
+        self.set_templates(summary='${nick}: ${message}')
+
+        notification = prepare_notification('buffer', 'john', 'a long message')
+
+        self.assertEqual(notification.source, 'john: a ..')
+
+    def test_time_is_taken_from_date_of_message(self):
+        self.time.return_value = time.mktime((2024, 1, 2, 13, 45, 0, 0, 0, -1))
+        date = str(int(time.mktime((2024, 1, 2, 8, 5, 0, 0, 0, -1))))
+        self.set_templates(body='[${time}] ${message}')
+
+        notification = prepare_notification('buffer', 'john', 'hello', date)
+
+        self.assertEqual(notification.message, '[08:05] hello')
+
+    def test_fields_are_computed_only_when_template_uses_them(self):
+        self.set_templates(summary='${nick}', body='${message}')
+
+        prepare_notification('buffer', 'john', 'hello')
+
+        self.assertNotIn(mock.call('notify_on_messages_that_match'),
+                         weechat.config_get_plugin.call_args_list)
+        self.assertNotIn(mock.call('buffer', 'localvar_server'),
+                         weechat.buffer_get_string.call_args_list)
+
+    def test_hidden_message_is_not_shown_by_templates(self):
+        set_config_option('hide_messages_in_buffers_that_match', 'chan')
+        self.set_templates(summary='${nick}: ${message}', body='${nick} says ${message}')
+
+        notification = prepare_notification('buffer', 'john', 'secret')
+
+        self.assertEqual(notification.source, 'john: ')
+        self.assertEqual(notification.message, '')
+
+
+class IconTests(TestsBase):
+    """Tests for icons from icon_dirs (see icon_for())."""
+
+    def setUp(self):
+        super().setUp()
+        self.icon_dir = self.create_temp_dir()
+        set_config_option('icon_dirs', self.icon_dir)
+        apply_icons_config()
+        set_buffer_string('buffer', 'localvar_server', 'libera')
+
+    def create_icon(self, *path):
+        path = os.path.join(self.icon_dir, *path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+        return path
+
+    def test_returns_avatar_of_nick_for_private_message(self):
+        set_buffer_string('buffer', 'localvar_type', 'private')
+        avatar = self.create_icon('libera', 'john.png')
+        self.create_icon('libera.png')
+
+        self.assertEqual(icon_for('buffer', 'john'), avatar)
+
+    def test_returns_network_icon_for_private_message_without_avatar(self):
+        set_buffer_string('buffer', 'localvar_type', 'private')
+        network_icon = self.create_icon('libera.svg')
+
+        self.assertEqual(icon_for('buffer', 'john'), network_icon)
+
+    def test_returns_network_icon_for_channel_message(self):
+        set_buffer_string('buffer', 'localvar_type', 'channel')
+        self.create_icon('libera', 'john.png')
+        network_icon = self.create_icon('libera.png')
+
+        self.assertEqual(icon_for('buffer', 'john'), network_icon)
+
+    def test_returns_empty_string_when_there_is_no_icon(self):
+        self.assertEqual(icon_for('buffer', 'john'), '')
+
+    def test_nick_cannot_point_outside_of_directory(self):
+        set_buffer_string('buffer', 'localvar_type', 'private')
+        self.create_icon('libera', '..png')
+
+        self.assertEqual(icon_for('buffer', '.'), '')
+
+    def test_is_safe_file_name_rejects_separators_and_parent_directory(self):
+        self.assertTrue(is_safe_file_name('john'))
+        for name in ['', '.john', 'a..b', 'a' + os.sep + 'b']:
+            self.assertFalse(is_safe_file_name(name), name)
+        with mock.patch('notify_send.os.altsep', '/'):
+            self.assertFalse(is_safe_file_name('a/b'))
+
+    def test_resolved_icons_are_cached(self):
+        set_buffer_string('buffer', 'localvar_type', 'private')
+        self.create_icon('libera', 'john.png')
+        icon_for('buffer', 'john')
+        icon_for('buffer', 'jane')
+
+        with mock.patch('notify_send.os.listdir') as listdir, \
+                mock.patch('notify_send.os.stat') as stat:
+            icon_for('buffer', 'john')
+            icon_for('buffer', 'jane')
+
+        self.assertFalse(listdir.called)
+        self.assertFalse(stat.called)
+
+    def test_missing_icon_is_found_after_directory_changes(self):
+        set_buffer_string('buffer', 'localvar_type', 'private')
+        self.assertEqual(icon_for('buffer', 'john'), '')
+        avatar = self.create_icon('libera', 'john.png')
+
+        self.assertEqual(icon_for('buffer', 'john'), '')
+        self.time.return_value = notify_send.ICON_DIRS_CHECK_INTERVAL
+        self.assertEqual(icon_for('buffer', 'john'), avatar)
+
+    def test_prepare_notification_uses_icon_from_icon_dirs(self):
+        set_config_option('icon', 'weechat.png')
+        set_buffer_string('buffer', 'localvar_type', 'private')
+        avatar = self.create_icon('libera', 'john.png')
+
+        notification = prepare_notification('buffer', 'john', 'message')
+
+        self.assertEqual(notification.icon, avatar)
+
+    def test_prepare_notification_uses_icon_option_when_there_is_no_icon(self):
+        set_config_option('icon', 'weechat.png')
+
+        notification = prepare_notification('buffer', 'john', 'message')
+
+        self.assertEqual(notification.icon, 'weechat.png')
+
+
 class NickSeparatorTests(TestsBase):
     """Tests for nick_separator()."""
 
@@ -1124,6 +3566,13 @@ class ShortenMessageTests(TestsBase):
 class SendNotificationTests(TestsBase):
     """Tests for send_notification()."""
 
+    def saved_notification_ids(self, buffer):
+        """Returns notification IDs saved for the given buffer."""
+        return [
+            args[2] for args, _ in weechat.buffer_set.call_args_list
+            if args[:2] == (buffer, 'localvar_set_notify_send_notification_id')
+        ]
+
     def setUp(self):
         super(SendNotificationTests, self).setUp()
 
@@ -1172,6 +3621,18 @@ class SendNotificationTests(TestsBase):
             universal_newlines=True
         )
 
+    def test_only_most_recently_used_command_parts_are_cached(self):
+        for i in range(notify_send.NOTIFY_CMD_PARTS_SIZE + 1):
+            send_notification('buffer', new_notification(icon='{}.png'.format(i)))
+        send_notification('buffer', new_notification(icon='1.png'))
+        send_notification('buffer', new_notification(icon='new.png'))
+
+        icons = [key[0] for key in notify_send.NOTIFY_CMD_PARTS]
+        self.assertEqual(len(icons), notify_send.NOTIFY_CMD_PARTS_SIZE)
+        self.assertNotIn('0.png', icons)
+        self.assertNotIn('2.png', icons)
+        self.assertEqual(icons[-2:], ['1.png', 'new.png'])
+
     def test_source_is_set_to_hyphen_when_source_is_empty(self):
         BUFFER = 'buffer'
         notification = new_notification(source='')
@@ -1235,6 +3696,67 @@ class SendNotificationTests(TestsBase):
         notify_cmd = self.subprocess.check_output.call_args[0][0]
         self.assertNotIn('--replace-id', notify_cmd)
 
+    def test_calls_dunstify_with_its_arguments_when_command_is_dunstify(self):
+        set_config_option('command', '/usr/bin/dunstify')
+        notification = new_notification(replace_id='1234')
+
+        send_notification('buffer', notification)
+
+        self.subprocess.check_output.assert_called_once_with(
+            [
+                '/usr/bin/dunstify',
+                '--printid',
+                '--appname', 'weechat',
+                '--icon', 'icon.png',
+                '--hints', 'string:desktop-entry:weechat',
+                '--timeout', '5000',
+                '--hints', 'int:transient:1',
+                '--urgency', 'normal',
+                '--replace', '1234',
+                '--hints', 'string:category:im.received',
+                '--',
+                'source',
+                'message'
+            ],
+            stderr=self.subprocess.STDOUT,
+            universal_newlines=True
+        )
+
+    def test_includes_extra_arguments_from_command_option(self):
+        set_config_option('command', "notify-send --hint 'string:x-foo:a b'")
+
+        send_notification('buffer', new_notification())
+
+        notify_cmd = self.subprocess.check_output.call_args[0][0]
+        self.assertEqual(notify_cmd[:4],
+                         ['notify-send', '--hint', 'string:x-foo:a b', '--print-id'])
+
+    def test_uses_notify_send_when_command_option_is_invalid(self):
+        set_config_option('command', "notify-send 'xxx")
+
+        send_notification('buffer', new_notification())
+
+        notify_cmd = self.subprocess.check_output.call_args[0][0]
+        self.assertEqual(notify_cmd[:2], ['notify-send', '--print-id'])
+
+    def test_builds_configuration_dependent_parts_of_command_only_once(self):
+        send_notification('buffer', new_notification(source='a', message='b'))
+        set_config_option('command', 'dunstify')
+        send_notification('buffer', new_notification(source='c', message='d'))
+
+        notify_cmd = self.subprocess.check_output.call_args[0][0]
+        self.assertEqual(notify_cmd[0], 'notify-send')
+        self.assertEqual(notify_cmd[-2:], ['c', 'd'])
+
+    def test_rebuilds_parts_of_command_after_configuration_changes(self):
+        send_notification('buffer', new_notification())
+        set_config_option('command', 'dunstify')
+        apply_config()
+        send_notification('buffer', new_notification())
+
+        notify_cmd = self.subprocess.check_output.call_args[0][0]
+        self.assertEqual(notify_cmd[0], 'dunstify')
+
     def test_prints_error_message_when_notification_sending_fails(self):
         BUFFER = 'buffer'
         self.subprocess.check_output.side_effect = OSError(
@@ -1255,11 +3777,7 @@ class SendNotificationTests(TestsBase):
 
         send_notification(BUFFER, notification)
 
-        weechat.buffer_set.assert_called_once_with(
-            BUFFER,
-            'localvar_set_notify_send_notification_id',
-            '4321'
-        )
+        self.assertEqual(self.saved_notification_ids(BUFFER), ['4321'])
 
     def test_notification_id_is_not_saved_when_replace_id_matches(self):
         BUFFER = 'buffer'
@@ -1268,7 +3786,7 @@ class SendNotificationTests(TestsBase):
 
         send_notification(BUFFER, notification)
 
-        weechat.buffer_set.assert_not_called()
+        self.assertEqual(self.saved_notification_ids(BUFFER), [])
 
     def test_notification_id_is_reset_when_an_error_occurs(self):
         BUFFER = 'buffer'
@@ -1277,12 +3795,232 @@ class SendNotificationTests(TestsBase):
 
         send_notification(BUFFER, notification)
 
-        weechat.buffer_set.assert_called_once_with(
-            BUFFER,
-            'localvar_set_notify_send_notification_id',
-            '0'
+        self.assertEqual(self.saved_notification_ids(BUFFER), ['0'])
+
+    def test_expiration_is_saved_when_notification_has_timeout(self):
+        BUFFER = 'buffer'
+        self.time.return_value = 100.0
+        notification = new_notification(timeout='5000')
+
+        send_notification(BUFFER, notification)
+
+        weechat.buffer_set.assert_any_call(
+            BUFFER, 'localvar_set_notify_send_notification_expiration', '105.0'
+        )
+
+    def test_expiration_is_zero_when_notification_does_not_expire(self):
+        BUFFER = 'buffer'
+        notification = new_notification(timeout='0')
+
+        send_notification(BUFFER, notification)
+
+        weechat.buffer_set.assert_any_call(
+            BUFFER, 'localvar_set_notify_send_notification_expiration', '0'
+        )
+
+
+class ActionsTests(TestsBase):
+    """Tests for notifications with actions."""
+
+    def setUp(self):
+        super().setUp()
+        set_config_option('actions', 'on')
+        weechat.WEECHAT_HOOK_PROCESS_RUNNING = -1
+        weechat.hook_process_hashtable.return_value = 'process_hook'
+        set_buffer_string('buffer', 'full_name', 'irc.libera.#weechat')
+
+        # Mock subprocess.
+        patcher = mock.patch('notify_send.subprocess')
+        self.subprocess = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.subprocess.check_output.return_value = '(uint32 42,)\n'
+
+    def test_sends_notification_with_actions_via_dbus(self):
+        notification = new_notification(
+            source='source',
+            message="it's \\\\ok",
+            icon='icon.png',
+            desktop_entry='weechat',
+            timeout='5000',
+            transient=True,
+            urgency='critical',
+            replace_id='666'
+        )
+
+        send_notification('buffer', notification)
+
+        self.subprocess.check_output.assert_called_once_with(
+            [
+                'gdbus', 'call',
+                '--session',
+                '--dest', 'org.freedesktop.Notifications',
+                '--object-path', '/org/freedesktop/Notifications',
+                '--method', 'org.freedesktop.Notifications.Notify',
+                '--',
+                "'weechat'",
+                'uint32 666',
+                "'icon.png'",
+                "'source'",
+                "'it\\'s \\\\ok'",
+                "['default', 'Open', 'open', 'Open', 'read', 'Mark read']",
+                "{'category': <'im.received'>, 'desktop-entry': <'weechat'>, "
+                "'transient': <true>, 'urgency': <byte 2>}",
+                'int32 5000',
+            ],
+            stderr=self.subprocess.STDOUT,
+            universal_newlines=True
+        )
+
+    def test_stores_notification_id_from_dbus_output(self):
+        notification_id = send_notification('buffer', new_notification(replace_id='0'))
+
+        self.assertEqual(notification_id, '42')
+        weechat.buffer_set.assert_any_call(
+            'buffer', 'localvar_set_notify_send_notification_id', '42'
+        )
+
+    def test_starts_single_monitor_for_many_notifications(self):
+        send_notification('buffer', new_notification())
+        self.subprocess.check_output.return_value = '(uint32 43,)\n'
+        send_notification('buffer', new_notification())
+
+        weechat.hook_process_hashtable.assert_called_once_with(
+            'gdbus monitor --session --dest org.freedesktop.Notifications '
+            '--object-path /org/freedesktop/Notifications',
+            {'buffer_flush': '1'},
+            0,
+            'action_monitor_callback',
+            ''
+        )
+        self.assertEqual(
+            notify_send.ACTION_NOTIFICATIONS,
+            {'42': 'irc.libera.#weechat', '43': 'irc.libera.#weechat'}
         )
 
+    def test_forgets_oldest_notification_when_there_are_too_many(self):
+        with mock.patch('notify_send.MAX_ACTION_NOTIFICATIONS', 2):
+            for notification_id in ('1', '2', '3'):
+                self.subprocess.check_output.return_value = \
+                    '(uint32 {},)'.format(notification_id)
+                send_notification('buffer', new_notification())
+
+        self.assertEqual(list(notify_send.ACTION_NOTIFICATIONS), ['2', '3'])
+
+    def test_open_action_switches_to_buffer(self):
+        send_notification('buffer', new_notification())
+        weechat.buffer_search.return_value = 'buffer'
+
+        action_monitor_callback(
+            '', 'gdbus', -1,
+            "/org/freedesktop/Notifications: "
+            "org.freedesktop.Notifications.ActionInvoked (uint32 42, 'open')\n",
+            ''
+        )
+
+        weechat.buffer_search.assert_called_once_with('==', 'irc.libera.#weechat')
+        weechat.buffer_set.assert_called_with('buffer', 'display', '1')
+
+    def test_mark_read_action_removes_buffer_from_hotlist(self):
+        send_notification('buffer', new_notification())
+        weechat.buffer_search.return_value = 'buffer'
+
+        action_monitor_callback(
+            '', 'gdbus', -1,
+            "/org/freedesktop/Notifications: "
+            "org.freedesktop.Notifications.ActionInvoked (uint32 42, 'read')\n",
+            ''
+        )
+
+        weechat.buffer_set.assert_called_with('buffer', 'hotlist', '-1')
+
+    def test_handles_lines_split_between_callbacks(self):
+        send_notification('buffer', new_notification())
+        weechat.buffer_search.return_value = 'buffer'
+
+        action_monitor_callback(
+            '', 'gdbus', -1,
+            "/org/freedesktop/Notifications: org.freedesktop.Notifications.Act", ''
+        )
+        weechat.buffer_search.assert_not_called()
+        action_monitor_callback(
+            '', 'gdbus', -1, "ionInvoked (uint32 42, 'default')\n", ''
+        )
+
+        weechat.buffer_set.assert_called_with('buffer', 'display', '1')
+
+    def test_ignores_actions_of_other_notifications(self):
+        action_monitor_callback(
+            '', 'gdbus', -1,
+            "/org/freedesktop/Notifications: "
+            "org.freedesktop.Notifications.ActionInvoked (uint32 7, 'open')\n",
+            ''
+        )
+
+        weechat.buffer_search.assert_not_called()
+
+    def test_forgets_closed_notification(self):
+        send_notification('buffer', new_notification())
+
+        action_monitor_callback(
+            '', 'gdbus', -1,
+            "/org/freedesktop/Notifications: "
+            "org.freedesktop.Notifications.NotificationClosed (uint32 42, uint32 2)\n",
+            ''
+        )
+
+        self.assertEqual(notify_send.ACTION_NOTIFICATIONS, {})
+
+    def test_notification_closed_by_daemon_is_not_closed_again(self):
+        send_notification('buffer', new_notification())
+        weechat.buffer_search.return_value = 'buffer'
+        set_buffer_string('buffer', 'localvar_notify_send_notification_id', '42')
+
+        action_monitor_callback(
+            '', 'gdbus', -1,
+            "/org/freedesktop/Notifications: "
+            "org.freedesktop.Notifications.NotificationClosed (uint32 42, uint32 2)\n",
+            ''
+        )
+
+        weechat.buffer_set.assert_called_with(
+            'buffer', 'localvar_set_notify_send_notification_id', '0'
+        )
+
+    def test_monitor_is_started_again_after_it_ends(self):
+        send_notification('buffer', new_notification())
+
+        action_monitor_callback('', 'gdbus', 1, '', '')
+        send_notification('buffer', new_notification())
+
+        self.assertEqual(weechat.hook_process_hashtable.call_count, 2)
+
+    def test_closes_notification_via_dbus(self):
+        set_buffer_string('buffer', 'localvar_notify_send_notification_id', '42')
+
+        close_notification('buffer')
+
+        self.subprocess.check_output.assert_called_once_with(
+            [
+                'gdbus', 'call',
+                '--session',
+                '--dest', 'org.freedesktop.Notifications',
+                '--object-path', '/org/freedesktop/Notifications',
+                '--method', 'org.freedesktop.Notifications.CloseNotification',
+                '42',
+            ],
+            stderr=self.subprocess.STDOUT,
+            universal_newlines=True
+        )
+
+    def test_monitor_is_stopped_when_actions_are_turned_off(self):
+        apply_config()
+        set_config_option('actions', 'off')
+
+        apply_config()
+
+        weechat.unhook.assert_called_with('process_hook')
+        self.assertEqual(notify_send.ACTION_MONITOR_HOOK, '')
+
 
 class CloseNotificationTests(TestsBase):
     """Tests for close_notification()."""
@@ -1338,6 +4076,40 @@ class CloseNotificationTests(TestsBase):
 
         self.subprocess.check_output.assert_not_called()
 
+    def test_forgets_notification_id_after_closing_notification(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'localvar_notify_send_notification_id', '5678')
+        self.subprocess.check_output.return_value = '5678\n'
+
+        close_notification(BUFFER)
+
+        weechat.buffer_set.assert_called_with(
+            BUFFER, 'localvar_set_notify_send_notification_id', '0'
+        )
+
+    def test_does_not_close_expired_notification(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'localvar_notify_send_notification_id', '5678')
+        set_buffer_string(BUFFER, 'localvar_notify_send_notification_expiration', '10.0')
+        self.time.return_value = 10.5
+
+        close_notification(BUFFER)
+
+        self.subprocess.check_output.assert_not_called()
+        weechat.buffer_set.assert_called_once_with(
+            BUFFER, 'localvar_set_notify_send_notification_id', '0'
+        )
+
+    def test_closes_notification_that_has_not_expired_yet(self):
+        BUFFER = 'buffer'
+        set_buffer_string(BUFFER, 'localvar_notify_send_notification_id', '5678')
+        set_buffer_string(BUFFER, 'localvar_notify_send_notification_expiration', '10.0')
+        self.time.return_value = 9.5
+
+        close_notification(BUFFER)
+
+        self.subprocess.check_output.assert_called_once()
+
     def test_prints_error_message_when_closing_notification_fails(self):
         BUFFER = 'buffer'
         set_buffer_string(BUFFER, 'localvar_notify_send_notification_id', '5678')